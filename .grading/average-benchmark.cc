@@ -1,10 +1,21 @@
 #include <algorithm>
 #include <cassert>
+#include <chrono>
+#include <functional>
 #include <iomanip>
 #include <iostream>
+#include <memory>
 #include <random>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+
+#include <sys/resource.h>
 
 #include "average.h"
+#include "bandwidth.h"
+#include "image.h"
+#include "numa.h"
 #include "timer.h"
 
 [[noreturn]] static void error(const std::string &msg) {
@@ -38,35 +49,553 @@ static std::pair<int, int> random_interval(std::mt19937 rng, int n, int s) {
   }
 }
 
-static void benchmark(int ny, int nx, int sy, int sx) {
-  std::mt19937 rng;
+static void fill_random(std::mt19937 &rng, int ny, int nx, float *data) {
   std::uniform_real_distribution<float> u(0.0f, 1.0f);
-  std::vector<float> data(3 * ny * nx);
   for (int i = 0; i < 3 * ny * nx; ++i) {
     data[i] = u(rng);
   }
+}
+
+static std::vector<float> random_image(std::mt19937 &rng, int ny, int nx) {
+  std::vector<float> data(3 * ny * nx);
+  fill_random(rng, ny, nx, data.data());
+  return data;
+}
+
+// Kernel name as printed in benchmark output, with the instruction set of
+// the simd kernels.
+static std::string kernel_label() {
+  std::string label = kernel_name(default_kernel());
+  if (default_kernel() == Kernel::simd ||
+      default_kernel() == Kernel::blocked) {
+    label += std::string("/") + simd_target();
+  }
+  return label;
+}
+
+// Bandwidth of reading the pixel data of a sy x sx rectangle once, with
+// values of the given size, float32 by default.
+static double gb_per_s(int sy, int sx, double seconds,
+                       std::size_t value_size = sizeof(float)) {
+  return double(sy) * sx * 3 * value_size / seconds / 1e9;
+}
+
+// Peak bandwidth of this host in GB/s, or 0 if it is not known. Measuring
+// it takes longer than the time limit of a graded run, so under
+// PPC_BENCHMARK only a cached value is used; grading measures it first with
+// average-benchmark peak.
+static double peak_gb_per_s() {
+  if (std::getenv("PPC_BENCHMARK") != nullptr) {
+    return ppc::peak_bandwidth::cached();
+  }
+  return ppc::peak_bandwidth::get();
+}
+
+static double peak_percent(double gb_per_s) {
+  const double peak = peak_gb_per_s();
+  return peak > 0.0 ? 100.0 * gb_per_s / peak : 0.0;
+}
+
+// Benchmark on the given image, or on a random one if data is null, and
+// report the bandwidth achieved against the peak of this host. With type
+// uint8 or half, the image is converted to that pixel type first and
+// averaged with the matching entry point. With planar, the image is
+// rearranged into RRR...GGG...BBB planes and averaged through an ImageView.
+// The random image is placed in an ImageBuffer, first touched by the
+// threads that sum the rectangle, unless serial asks for a vector written
+// by this thread alone; with placement, where the pages of the rectangle
+// are is reported as well.
+static void benchmark(int ny, int nx, int sy, int sx, const float *data,
+                      const std::string &type, bool planar, bool serial,
+                      bool placement) {
+  std::mt19937 rng;
+  // The rectangle is chosen first, as the buffer is placed for it
   auto [x0, x1] = random_interval(rng, nx, sx);
   auto [y0, y1] = random_interval(rng, ny, sy);
+  std::vector<float> random_data;
+  std::unique_ptr<ImageBuffer> buffer;
+  if (data == nullptr && serial) {
+    random_data = random_image(rng, ny, nx);
+    data = random_data.data();
+  } else if (data == nullptr) {
+    buffer = std::make_unique<ImageBuffer>(ny, nx, y0, y1);
+    fill_random(rng, ny, nx, buffer->data());
+    data = buffer->data();
+  }
+  const std::size_t size = std::size_t(3) * ny * nx;
+  std::vector<std::uint8_t> u8;
+  std::vector<std::uint16_t> half;
+  std::vector<float> planes;
+  std::size_t value_size = sizeof(float);
+  std::string label = kernel_label();
+  if (planar) {
+    planes.resize(size);
+    for (std::size_t i = 0; i < size / 3; i++) {
+      for (int c = 0; c < 3; c++) {
+        planes[c * (size / 3) + i] = data[3 * i + c];
+      }
+    }
+    label = std::string("planar/") + simd_target();
+  } else if (type == "uint8") {
+    u8.resize(size);
+    for (std::size_t i = 0; i < size; i++) {
+      u8[i] = std::uint8_t(std::min(std::max(data[i], 0.0f), 1.0f) * 255.0f);
+    }
+    value_size = sizeof(std::uint8_t);
+    label = type + "/" + simd_target();
+  } else if (type == "half") {
+    half.resize(size);
+    for (std::size_t i = 0; i < size; i++) {
+      half[i] = float_to_half(data[i]);
+    }
+    value_size = sizeof(std::uint16_t);
+    label = type + "/" + simd_target();
+  }
+  const double peak = peak_gb_per_s();
 
   std::cout << "average\t" << ny << "\t" << nx << "\t" << sy << "\t" << sx
+            << "\t" << label << "\t" << thread_count() << "\t" << std::flush;
+  double seconds;
+  {
+    ppc::timer t(&seconds);
+    if (!u8.empty()) {
+      calculate(ny, nx, u8.data(), y0, x0, y1, x1);
+    } else if (!half.empty()) {
+      calculate_half(ny, nx, half.data(), y0, x0, y1, x1);
+    } else if (!planes.empty()) {
+      calculate(ImageView{planes.data(), ny, nx, planar_layout(ny, nx)}, y0,
+                x0, y1, x1);
+    } else {
+      calculate(ny, nx, data, y0, x0, y1, x1);
+    }
+  }
+  const double achieved = gb_per_s(y1 - y0, x1 - x0, seconds, value_size);
+  std::cout << std::setprecision(2) << std::fixed << achieved << " GB/s";
+  if (peak > 0.0) {
+    std::cout << "\t" << std::setprecision(1) << 100.0 * achieved / peak
+              << "% of " << std::setprecision(2) << peak << " GB/s peak";
+  }
+  std::cout << std::endl;
+  if (placement) {
+    const PagePlacement pages = page_placement(nx, data, y0, y1);
+    std::cout << "placement\t" << pages.local << " local\t" << pages.remote
+              << " remote\t" << pages.unknown << " unknown pages"
+              << std::endl;
+  }
+}
+
+// Benchmark calculate_banded() with bands read from a raw image file, or
+// generated on the fly if path is null, so that the image never has to fit
+// in memory.
+static void benchmark_banded(int ny, int nx, int sy, int sx, int band_rows,
+                             const char *path) {
+  std::mt19937 rng;
+  auto [x0, x1] = random_interval(rng, nx, sx);
+  auto [y0, y1] = random_interval(rng, ny, sy);
+  std::unique_ptr<RawFileBands> file;
+  BandLoader load;
+  if (path != nullptr) {
+    file = std::make_unique<RawFileBands>(path, ny, nx);
+    load = std::ref(*file);
+  } else {
+    load = [nx](int ya, int yb, float *buf) {
+      std::uniform_real_distribution<float> u(0.0f, 1.0f);
+      for (int y = ya; y < yb; y++) {
+        std::mt19937 row_rng(y);
+        for (int i = 0; i < 3 * nx; i++) {
+          *buf++ = u(row_rng);
+        }
+      }
+    };
+  }
+
+  std::cout << "average-banded\t" << ny << "\t" << nx << "\t" << sy << "\t"
+            << sx << "\t" << band_rows << "\t" << std::flush;
+  {
+    ppc::timer t;
+    calculate_banded(ny, nx, band_rows, load, y0, x0, y1, x1);
+  }
+  struct rusage usage;
+  getrusage(RUSAGE_SELF, &usage);
+  std::cout << std::setprecision(1) << std::fixed << usage.ru_maxrss / 1024.0
+            << " MiB peak RSS" << std::endl;
+}
+
+static void benchmark_batch(int ny, int nx, int sy, int sx, int count) {
+  std::mt19937 rng;
+  std::vector<float> data = random_image(rng, ny, nx);
+  std::vector<Rect> rects(count);
+  for (int i = 0; i < count; ++i) {
+    std::mt19937 rect_rng(i + 1);
+    auto [x0, x1] = random_interval(rect_rng, nx, sx);
+    rect_rng.discard(2);
+    auto [y0, y1] = random_interval(rect_rng, ny, sy);
+    rects[i] = {y0, x0, y1, x1};
+  }
+  std::vector<Result> results(count);
+  const bool table = batch_strategy(ny, nx, count, rects.data()) ==
+                     BatchStrategy::table;
+
+  std::cout << "average-batch\t" << ny << "\t" << nx << "\t" << sy << "\t"
+            << sx << "\t" << count << "\t" << (table ? "table" : "direct")
             << "\t" << std::flush;
+  const auto start = std::chrono::high_resolution_clock::now();
   {
     ppc::timer t;
-    calculate(ny, nx, data.data(), y0, x0, y1, x1);
+    calculate_batch(ny, nx, data.data(), count, rects.data(), results.data());
+  }
+  const std::chrono::duration<double> seconds =
+      std::chrono::high_resolution_clock::now() - start;
+  std::cout << std::setprecision(0) << std::fixed << count / seconds.count()
+            << " rects/s" << std::endl;
+}
+
+// Build a BlockPyramid with the given block size and answer count random
+// rectangles from it, reporting the build time, the memory of the pyramid
+// next to that of the image, and the time per query.
+static void benchmark_pyramid(int ny, int nx, int sy, int sx, int count,
+                              int block) {
+  std::mt19937 rng;
+  std::vector<float> data = random_image(rng, ny, nx);
+  std::vector<Rect> rects(count);
+  for (int i = 0; i < count; ++i) {
+    std::mt19937 rect_rng(i + 1);
+    auto [x0, x1] = random_interval(rect_rng, nx, sx);
+    rect_rng.discard(2);
+    auto [y0, y1] = random_interval(rect_rng, ny, sy);
+    rects[i] = {y0, x0, y1, x1};
+  }
+
+  std::cout << "average-pyramid\t" << ny << "\t" << nx << "\t" << sy << "\t"
+            << sx << "\t" << count << "\t" << block << "\t" << std::flush;
+  const auto start = std::chrono::high_resolution_clock::now();
+  const BlockPyramid pyramid(ny, nx, data.data(), block);
+  const std::chrono::duration<double> build_seconds =
+      std::chrono::high_resolution_clock::now() - start;
+  double query_seconds;
+  {
+    ppc::timer t(&query_seconds);
+    for (const Rect &r : rects) {
+      pyramid.calculate(r.y0, r.x0, r.y1, r.x1);
+    }
+  }
+  const double image_bytes = double(ny) * nx * 3 * sizeof(float);
+  std::cout << std::setprecision(3) << std::fixed
+            << build_seconds.count() * 1e3 << " ms build\t"
+            << pyramid.memory() / 1048576.0 << " MiB\t"
+            << std::setprecision(2) << 100.0 * pyramid.memory() / image_bytes
+            << " % of image\t" << std::setprecision(3)
+            << query_seconds / count * 1e6 << " us/query" << std::endl;
+}
+
+// Mean, variance, min and max of every channel of an interleaved image with
+// the given number of channels, in one pass.
+static void benchmark_stats(int ny, int nx, int sy, int sx, int channels) {
+  std::mt19937 rng;
+  std::uniform_real_distribution<float> u(0.0f, 1.0f);
+  std::vector<float> data(std::size_t(channels) * ny * nx);
+  for (float &v : data) {
+    v = u(rng);
+  }
+  auto [x0, x1] = random_interval(rng, nx, sx);
+  auto [y0, y1] = random_interval(rng, ny, sy);
+  const ImageView image = {data.data(), ny, nx,
+                           interleaved_layout(nx, channels)};
+
+  std::cout << "average-stats\t" << ny << "\t" << nx << "\t" << sy << "\t"
+            << sx << "\t" << channels << "\t" << thread_count() << "\t"
+            << std::flush;
+  double seconds;
+  {
+    ppc::timer t(&seconds);
+    calculate_stats(image, y0, x0, y1, x1);
+  }
+  const double achieved =
+      double(y1 - y0) * (x1 - x0) * channels * sizeof(float) / seconds / 1e9;
+  std::cout << std::setprecision(2) << std::fixed << achieved << " GB/s"
+            << std::endl;
+}
+
+// Sweep a sy x sx window over the whole image in a serpentine order, moving
+// it by step pixels at a time.
+static void benchmark_sliding(int ny, int nx, int sy, int sx, int step) {
+  std::mt19937 rng;
+  std::vector<float> data = random_image(rng, ny, nx);
+
+  std::cout << "average-sliding\t" << ny << "\t" << nx << "\t" << sy << "\t"
+            << sx << "\t" << step << "\t" << std::flush;
+  long long windows = 0;
+  const auto start = std::chrono::high_resolution_clock::now();
+  {
+    ppc::timer t;
+    SlidingWindow window(ny, nx, data.data(), 0, 0, sy, sx);
+    int dx = step;
+    while (true) {
+      window.average();
+      windows++;
+      const int x = window.left() + dx;
+      if (0 <= x && x <= nx - sx) {
+        window.move(0, dx);
+      } else if (window.top() + step <= ny - sy) {
+        window.move(step, 0);
+        dx = -dx;
+      } else {
+        break;
+      }
+    }
+  }
+  const std::chrono::duration<double> seconds =
+      std::chrono::high_resolution_clock::now() - start;
+  std::cout << windows << " windows\t" << std::setprecision(0) << std::fixed
+            << windows / seconds.count() << " windows/s" << std::endl;
+}
+
+// Best time of calculate() on one rectangle, repeated at least three times
+// and for at least SWEEP_MIN_SECONDS in total.
+static constexpr double SWEEP_MIN_SECONDS = 0.05;
+
+static double best_time(int ny, int nx, const float *data, int y0, int x0,
+                        int y1, int x1) {
+  double best = 0.0;
+  double total = 0.0;
+  for (int i = 0; i < 3 || total < SWEEP_MIN_SECONDS; i++) {
+    const auto start = std::chrono::high_resolution_clock::now();
+    calculate(ny, nx, data, y0, x0, y1, x1);
+    const std::chrono::duration<double> seconds =
+        std::chrono::high_resolution_clock::now() - start;
+    best = i == 0 ? seconds.count() : std::min(best, seconds.count());
+    total += seconds.count();
+  }
+  return best;
+}
+
+// Benchmark square images of several sizes, each with rectangles of the
+// whole image, half and an eighth of its side, with the current kernel and
+// thread count. One row per point is written in CSV or as a JSON object per
+// line; bytes are the float32 pixel data of the rectangle, and peak_percent
+// compares them with the peak bandwidth of the host.
+static void benchmark_sweep(bool json) {
+  const std::string kernel = kernel_label();
+  const int threads = thread_count();
+  if (!json) {
+    std::cout << "ny,nx,sy,sx,kernel,threads,seconds,gb_per_s,pixels_per_s,"
+                 "peak_percent"
+              << std::endl;
+  }
+  for (int n : {500, 1000, 2000, 4000}) {
+    std::mt19937 rng;
+    const std::vector<float> data = random_image(rng, n, n);
+    for (int s : {n, n / 2, n / 8}) {
+      auto [x0, x1] = random_interval(rng, n, s);
+      auto [y0, y1] = random_interval(rng, n, s);
+      const double seconds = best_time(n, n, data.data(), y0, x0, y1, x1);
+      const double achieved = gb_per_s(s, s, seconds);
+      const double pixels_per_s = double(s) * s / seconds;
+      std::ostringstream row;
+      row << std::setprecision(6);
+      if (json) {
+        row << "{\"ny\": " << n << ", \"nx\": " << n << ", \"sy\": " << s
+            << ", \"sx\": " << s << ", \"kernel\": \"" << kernel
+            << "\", \"threads\": " << threads << ", \"seconds\": " << seconds
+            << ", \"gb_per_s\": " << achieved
+            << ", \"pixels_per_s\": " << pixels_per_s
+            << ", \"peak_percent\": " << peak_percent(achieved) << "}";
+      } else {
+        row << n << ',' << n << ',' << s << ',' << s << ',' << kernel << ','
+            << threads << ',' << seconds << ',' << achieved << ','
+            << pixels_per_s << ',' << peak_percent(achieved);
+      }
+      std::cout << row.str() << std::endl;
+    }
   }
-  std::cout << std::endl;
 }
 
 int main(int argc, const char **argv) {
+  try {
+    default_kernel();
+    thread_count();
+    simd_target();
+  } catch (const std::invalid_argument &e) {
+    error(e.what());
+  }
+  if (argc >= 2 && std::string(argv[1]) == "batch") {
+    if (argc != 7 && argc != 8) {
+      error("Usage:\n  average-benchmark batch <ny> <nx> <sy> <sx> <count> "
+            "[iterations]");
+    }
+    int ny = std::stoi(argv[2]);
+    int nx = std::stoi(argv[3]);
+    int sy = std::stoi(argv[4]);
+    int sx = std::stoi(argv[5]);
+    int count = std::stoi(argv[6]);
+    int iter = argc == 8 ? std::stoi(argv[7]) : 1;
+    for (int i = 0; i < iter; i++) {
+      benchmark_batch(ny, nx, sy, sx, count);
+    }
+    return 0;
+  }
+  if (argc >= 2 && std::string(argv[1]) == "pyramid") {
+    if (argc != 7 && argc != 8) {
+      error("Usage:\n  average-benchmark pyramid <ny> <nx> <sy> <sx> <count> "
+            "[block]");
+    }
+    int ny = std::stoi(argv[2]);
+    int nx = std::stoi(argv[3]);
+    int sy = std::stoi(argv[4]);
+    int sx = std::stoi(argv[5]);
+    int count = std::stoi(argv[6]);
+    if (count < 1) {
+      error("pyramid needs at least one rectangle");
+    }
+    // Without a block size, compare the usual ones
+    std::vector<int> blocks = {4, 8, 16, 32, 64};
+    if (argc == 8) {
+      blocks = {std::stoi(argv[7])};
+      if (blocks[0] < 1) {
+        error("pyramid needs block >= 1");
+      }
+    }
+    for (int block : blocks) {
+      benchmark_pyramid(ny, nx, sy, sx, count, block);
+    }
+    return 0;
+  }
+  if (argc >= 2 && std::string(argv[1]) == "sliding") {
+    if (argc != 6 && argc != 7) {
+      error("Usage:\n  average-benchmark sliding <ny> <nx> <sy> <sx> [step]");
+    }
+    int ny = std::stoi(argv[2]);
+    int nx = std::stoi(argv[3]);
+    int sy = std::stoi(argv[4]);
+    int sx = std::stoi(argv[5]);
+    int step = argc == 7 ? std::stoi(argv[6]) : 1;
+    if (sy < 1 || sy > ny || sx < 1 || sx > nx || step < 1) {
+      error("sliding needs 1 <= sy <= ny, 1 <= sx <= nx and step >= 1");
+    }
+    benchmark_sliding(ny, nx, sy, sx, step);
+    return 0;
+  }
+  if (argc >= 2 && std::string(argv[1]) == "stats") {
+    if (argc != 6 && argc != 7) {
+      error("Usage:\n  average-benchmark stats <ny> <nx> <sy> <sx> "
+            "[channels]");
+    }
+    int ny = std::stoi(argv[2]);
+    int nx = std::stoi(argv[3]);
+    int sy = std::stoi(argv[4]);
+    int sx = std::stoi(argv[5]);
+    int channels = argc == 7 ? std::stoi(argv[6]) : 3;
+    if (channels < 1) {
+      error("stats needs at least one channel");
+    }
+    benchmark_stats(ny, nx, sy, sx, channels);
+    return 0;
+  }
+  if (argc == 2 && std::string(argv[1]) == "peak") {
+    // Measure the peak bandwidth of this host, if it is not cached yet
+    std::cout << "peak\t" << std::setprecision(2) << std::fixed
+              << ppc::peak_bandwidth::get() << " GB/s" << std::endl;
+    return 0;
+  }
+  if (argc >= 2 && std::string(argv[1]) == "sweep") {
+    const std::string format = argc >= 3 ? argv[2] : "csv";
+    if (argc > 3 || (format != "csv" && format != "json")) {
+      error("Usage:\n  average-benchmark sweep [csv|json]");
+    }
+    benchmark_sweep(format == "json");
+    return 0;
+  }
+  const char *image_path = nullptr;
+  int band_rows = 0;
+  std::string type = "float";
+  bool planar = false;
+  bool serial = false;
+  bool pin = false;
+  bool placement = false;
+  while (argc >= 3 && std::string(argv[1]).rfind("--", 0) == 0) {
+    const std::string option = argv[1];
+    if (option == "--image") {
+      image_path = argv[2];
+    } else if (option == "--bands") {
+      band_rows = std::stoi(argv[2]);
+    } else if (option == "--type") {
+      type = argv[2];
+      if (type != "float" && type != "uint8" && type != "half") {
+        error("--type should be float, uint8 or half");
+      }
+    } else if (option == "--layout") {
+      const std::string layout = argv[2];
+      if (layout != "interleaved" && layout != "planar") {
+        error("--layout should be interleaved or planar");
+      }
+      planar = layout == "planar";
+    } else if (option == "--numa") {
+      std::istringstream modes(argv[2]);
+      std::string mode;
+      while (std::getline(modes, mode, ',')) {
+        if (mode == "serial") {
+          serial = true;
+        } else if (mode == "pin") {
+          pin = true;
+        } else if (mode == "report") {
+          placement = true;
+        } else {
+          error("--numa should be a list of serial, pin and report");
+        }
+      }
+    } else {
+      error("unknown option " + option);
+    }
+    argc -= 2;
+    argv += 2;
+  }
   if (argc != 5 && argc != 6) {
-    error("Usage:\n  average-benchmark <ny> <nx> <sy> <sx> [iterations]");
+    error("Usage:\n  average-benchmark [--image <file>] [--bands <rows>] "
+          "[--type <float|uint8|half>]\n"
+          "    [--layout <interleaved|planar>] [--numa <serial,pin,report>] "
+          "<ny> <nx> <sy> <sx> [iterations]\n"
+          "  average-benchmark batch <ny> <nx> <sy> <sx> <count> "
+          "[iterations]\n"
+          "  average-benchmark pyramid <ny> <nx> <sy> <sx> <count> [block]\n"
+          "  average-benchmark sliding <ny> <nx> <sy> <sx> [step]\n"
+          "  average-benchmark stats <ny> <nx> <sy> <sx> [channels]\n"
+          "  average-benchmark sweep [csv|json]\n"
+          "  average-benchmark peak");
+  }
+  if (planar && type != "float") {
+    error("--layout planar is only for float images");
+  }
+  if (placement && (planar || type != "float")) {
+    error("--numa report is only for interleaved float images");
+  }
+  if (pin && !pin_threads()) {
+    error("--numa pin could not set the thread affinity");
   }
   int ny = std::stoi(argv[1]);
   int nx = std::stoi(argv[2]);
   int sy = std::stoi(argv[3]);
   int sx = std::stoi(argv[4]);
   int iter = argc == 6 ? std::stoi(argv[5]) : 1;
+  if (band_rows > 0) {
+    try {
+      for (int i = 0; i < iter; i++) {
+        benchmark_banded(ny, nx, sy, sx, band_rows, image_path);
+      }
+    } catch (const std::runtime_error &e) {
+      error(e.what());
+    }
+    return 0;
+  }
+  std::unique_ptr<MappedImage> image;
+  if (image_path != nullptr) {
+    try {
+      image = std::make_unique<MappedImage>(image_path, ny, nx);
+    } catch (const std::runtime_error &e) {
+      error(e.what());
+    }
+  }
   for (int i = 0; i < iter; i++) {
-    benchmark(ny, nx, sy, sx);
+    benchmark(ny, nx, sy, sx, image ? image->data() : nullptr, type, planar,
+              serial, placement);
   }
 }
\ No newline at end of file
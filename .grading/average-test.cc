@@ -1,20 +1,38 @@
 #include <algorithm>
+#include <array>
 #include <cassert>
+#include <cmath>
+#include <condition_variable>
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <filesystem>
+#include <fstream>
 #include <iomanip>
 #include <iostream>
+#include <limits>
+#include <memory>
+#include <mutex>
 #include <random>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+#include <thread>
+#include <utility>
+
+#include <unistd.h>
 
 #include "average.h"
+#include "image.h"
+#include "index.h"
+#include "numa.h"
 #include "timer.h"
 
 static constexpr float THRESHOLD = 1e-6;
 
-struct Rect {
-  int y0;
-  int x0;
-  int y1;
-  int x1;
-};
+// Stamp of the test case generators, part of the name of every cached test
+// case. Increase it whenever a generator changes what it generates.
+static constexpr int GENERATOR_VERSION = 1;
 
 struct TestCase {
   float expected[3];
@@ -33,64 +51,65 @@ struct TestCase {
   std::exit(EXIT_FAILURE);
 }
 
-static void print_color(const float color[3]) {
-  std::cout << '(' << std::setprecision(7) << std::setw(9) << std::fixed
+static void print_color(std::ostream &out, const float color[3]) {
+  out << '(' << std::setprecision(7) << std::setw(9) << std::fixed
             << color[0] << ", " << std::setprecision(7) << std::setw(9)
             << std::fixed << color[1] << ", " << std::setprecision(7)
             << std::setw(9) << std::fixed << color[2] << ')';
 }
 
-static void print(int ny, int nx, Rect rect, const float *data) {
+static void print(std::ostream &out, int ny, int nx, Rect rect,
+                  const float *data) {
   for (int y = 0; y <= ny; y++) {
     if (y == rect.y0) {
       for (int x = 0; x <= nx; x++) {
         if (x < rect.x0) {
-          std::cout << "                                    ";
+          out << "                                    ";
         } else if (x == rect.x0) {
-          std::cout << " ┌──────────────────────────────────";
+          out << " ┌──────────────────────────────────";
         } else if (x < rect.x1) {
-          std::cout << "────────────────────────────────────";
+          out << "────────────────────────────────────";
         } else if (x == rect.x1) {
-          std::cout << "─┐";
+          out << "─┐";
         }
       }
     } else if (rect.y0 < y && y < rect.y1) {
       for (int x = 0; x <= nx; x++) {
         if (x < rect.x0) {
-          std::cout << "                                    ";
+          out << "                                    ";
         } else if (x == rect.x0) {
-          std::cout << " │                                  ";
+          out << " │                                  ";
         } else if (x < rect.x1) {
-          std::cout << "                                    ";
+          out << "                                    ";
         } else if (x == rect.x1) {
-          std::cout << " │";
+          out << " │";
         }
       }
     } else if (y == rect.y1) {
       for (int x = 0; x <= nx; x++) {
         if (x < rect.x0) {
-          std::cout << "                                    ";
+          out << "                                    ";
         } else if (x == rect.x0) {
-          std::cout << " └──────────────────────────────────";
+          out << " └──────────────────────────────────";
         } else if (x < rect.x1) {
-          std::cout << "────────────────────────────────────";
+          out << "────────────────────────────────────";
         } else if (x == rect.x1) {
-          std::cout << "─┘";
+          out << "─┘";
         }
       }
     }
-    std::cout << '\n';
+    out << '\n';
     if (y == ny)
       break;
     for (int x = 0; x <= nx; x++) {
       if (x == rect.x0 || x == rect.x1) {
         if (rect.y0 <= y && y < rect.y1) {
-          std::cout << " │ ";
+          out << " │ ";
         } else {
-          std::cout << "   ";
+          out << "   ";
         }
       } else {
-        std::cout << "   ";
+        out << "   ";
       }
       if (x == nx)
         break;
@@ -99,9 +118,9 @@ static void print(int ny, int nx, Rect rect, const float *data) {
           data[(y * nx + x) * 3 + 1],
           data[(y * nx + x) * 3 + 2],
       };
-      print_color(color);
+      print_color(out, color);
     }
-    std::cout << '\n';
+    out << '\n';
   }
 }
 
@@ -316,7 +335,55 @@ static TestCase generate_color_rects(int ny, int nx, int sy, int sx) {
   };
 }
 
-static bool test(int ny, int nx, int mode, int sy, int sx, bool verbose) {
+// Walk a window of the rectangle's size one pixel at a time to the right
+// and bottom edges of the image and then back to the rectangle, so that
+// every direction of incremental update is used.
+static Result slide_to(int ny, int nx, const float *data, Rect rect) {
+  const int height = rect.y1 - rect.y0;
+  const int width = rect.x1 - rect.x0;
+  SlidingWindow window(ny, nx, data, 0, 0, height, width);
+  while (window.left() < nx - width)
+    window.move(0, 1);
+  while (window.top() < ny - height)
+    window.move(1, 0);
+  while (window.left() > rect.x0)
+    window.move(0, -1);
+  while (window.top() > rect.y0)
+    window.move(-1, 0);
+  return window.average();
+}
+
+// Worst error seen so far for each variant and mode, in first-seen order.
+static std::vector<std::pair<std::string, std::array<float, 4>>> worst_errors;
+
+static void record_error(const std::string &variant, int mode, float error) {
+  auto it = std::find_if(worst_errors.begin(), worst_errors.end(),
+                         [&](const auto &e) { return e.first == variant; });
+  if (it == worst_errors.end()) {
+    worst_errors.emplace_back(variant, std::array<float, 4>{});
+    it = worst_errors.end() - 1;
+  }
+  it->second[mode - 1] = std::max(it->second[mode - 1], error);
+}
+
+static void print_worst_errors() {
+  std::cout << "Worst error / threshold per mode:\n";
+  std::cout << std::setw(16) << "";
+  for (int mode = 1; mode <= 4; mode++) {
+    std::cout << std::setw(8) << mode;
+  }
+  std::cout << '\n';
+  for (const auto &[variant, errors] : worst_errors) {
+    std::cout << std::setw(16) << std::left << variant << std::right;
+    for (float error : errors) {
+      std::cout << std::setw(8) << std::setprecision(4) << std::fixed
+                << error / THRESHOLD;
+    }
+    std::cout << '\n';
+  }
+}
+
+static TestCase generate(int ny, int nx, int mode, int sy, int sx) {
   TestCase test_case;
   switch (mode) {
   case 1:
@@ -334,39 +401,470 @@ static bool test(int ny, int nx, int mode, int sy, int sx, bool verbose) {
   default:
     error("unknown MODE");
   }
+  return test_case;
+}
+
+// A test case stored on disk is a raw image file (see image.h) with the
+// rest of the TestCase in a one-line text file next to it.
+static std::string meta_path(const std::string &path) {
+  return path + ".meta";
+}
+
+static void write_test_case(const std::string &path, int mode,
+                            const TestCase &test_case) {
+  write_image(path, test_case.ny, test_case.nx, test_case.input.data());
+  std::ofstream meta(meta_path(path));
+  meta << std::setprecision(std::numeric_limits<float>::max_digits10)
+       << test_case.ny << ' ' << test_case.nx << ' ' << mode << ' '
+       << test_case.rect.y0 << ' ' << test_case.rect.x0 << ' '
+       << test_case.rect.y1 << ' ' << test_case.rect.x1 << ' '
+       << test_case.expected[0] << ' ' << test_case.expected[1] << ' '
+       << test_case.expected[2] << '\n';
+  if (!meta) {
+    error("cannot write " + meta_path(path));
+  }
+}
+
+// Reads everything except the input, which the caller maps separately.
+// Returns false if the file is missing or not a valid test case.
+static bool try_read_test_case(const std::string &path, TestCase &test_case,
+                               int &mode) {
+  std::ifstream meta(meta_path(path));
+  meta >> test_case.ny >> test_case.nx >> mode >> test_case.rect.y0 >>
+      test_case.rect.x0 >> test_case.rect.y1 >> test_case.rect.x1 >>
+      test_case.expected[0] >> test_case.expected[1] >> test_case.expected[2];
+  return meta && mode >= 1 && mode <= 4;
+}
+
+static TestCase read_test_case(const std::string &path, int &mode) {
+  TestCase test_case;
+  if (!try_read_test_case(path, test_case, mode)) {
+    error("cannot read " + meta_path(path));
+  }
+  return test_case;
+}
 
-  const Result result =
-      calculate(ny, nx, test_case.input.data(), test_case.rect.y0,
-                test_case.rect.x0, test_case.rect.y1, test_case.rect.x1);
+// A generated test case whose input is either held in memory or mapped
+// from the test case cache.
+struct LoadedTestCase {
+  TestCase test_case;
+  std::unique_ptr<MappedImage> image;
 
-  const float error =
-      std::max({std::abs(result.avg[0] - test_case.expected[0]),
-                std::abs(result.avg[1] - test_case.expected[1]),
-                std::abs(result.avg[2] - test_case.expected[2])});
+  const float *input() const {
+    return image ? image->data() : test_case.input.data();
+  }
+};
+
+// Generated test cases are cached in the directory named by PPC_TEST_CACHE,
+// if it is set, in the format of --write.
+static std::string cache_path(int ny, int nx, int mode, int sy, int sx) {
+  const char *dir = std::getenv("PPC_TEST_CACHE");
+  if (dir == nullptr || *dir == '\0') {
+    return {};
+  }
+  std::ostringstream path;
+  path << dir << "/v" << GENERATOR_VERSION << '-' << ny << '-' << nx << '-'
+       << mode << '-' << sy << '-' << sx;
+  return path.str();
+}
+
+static bool load_cached(const std::string &path, int ny, int nx, int mode,
+                        LoadedTestCase &loaded) {
+  int cached_mode;
+  TestCase &test_case = loaded.test_case;
+  if (!try_read_test_case(path, test_case, cached_mode) ||
+      test_case.ny != ny || test_case.nx != nx || cached_mode != mode) {
+    return false;
+  }
+  try {
+    loaded.image = std::make_unique<MappedImage>(path, ny, nx);
+  } catch (const std::runtime_error &) {
+    return false;
+  }
+  return true;
+}
+
+// Several processes and threads may store the same test case at once, so
+// it is written under a unique name and renamed into place, the meta file
+// last, as that is what readers look at first.
+static void store_cached(const std::string &path, int mode,
+                         const TestCase &test_case) {
+  std::ostringstream tmp;
+  tmp << path << ".tmp" << getpid() << '-' << std::this_thread::get_id();
+  try {
+    std::filesystem::create_directories(
+        std::filesystem::path(path).parent_path());
+    write_test_case(tmp.str(), mode, test_case);
+  } catch (const std::exception &e) {
+    error(e.what());
+  }
+  if (std::rename(tmp.str().c_str(), path.c_str()) != 0 ||
+      std::rename(meta_path(tmp.str()).c_str(), meta_path(path).c_str()) !=
+          0) {
+    error("cannot store " + path);
+  }
+}
+
+// Generate a test case, or map it from the cache if it has already been
+// generated.
+static LoadedTestCase load(int ny, int nx, int mode, int sy, int sx) {
+  LoadedTestCase loaded;
+  const std::string path = cache_path(ny, nx, mode, sy, sx);
+  if (!path.empty() && load_cached(path, ny, nx, mode, loaded)) {
+    return loaded;
+  }
+  loaded.image.reset();
+  loaded.test_case = generate(ny, nx, mode, sy, sx);
+  if (!path.empty()) {
+    store_cached(path, mode, loaded.test_case);
+  }
+  return loaded;
+}
+
+using VariantErrors = std::vector<std::pair<std::string, float>>;
+
+// The input of a test case converted to another pixel type, with the
+// expected average of the rectangle computed from the converted values.
+template <typename T> struct TypedInput {
+  std::vector<T> input;
+  float expected[3];
+};
+
+// 8-bit pixels, v * 255 rounded; the expected average is in units of 255
+// like the results of calculate().
+static TypedInput<std::uint8_t> to_uint8(const TestCase &test_case,
+                                         const float *input) {
+  const int nx = test_case.nx;
+  const Rect &rect = test_case.rect;
+  TypedInput<std::uint8_t> typed;
+  typed.input.resize(std::size_t(3) * test_case.ny * nx);
+  for (std::size_t i = 0; i < typed.input.size(); i++) {
+    const float v = std::min(std::max(input[i], 0.0f), 1.0f);
+    typed.input[i] = std::uint8_t(std::lround(v * 255.0f));
+  }
+  std::uint64_t sum[3] = {0, 0, 0};
+  for (int y = rect.y0; y < rect.y1; y++) {
+    for (int x = rect.x0; x < rect.x1; x++) {
+      for (int c = 0; c < 3; c++) {
+        sum[c] += typed.input[c + 3 * x + std::size_t(3) * nx * y];
+      }
+    }
+  }
+  const double area = double(rect.y1 - rect.y0) * (rect.x1 - rect.x0);
+  for (int c = 0; c < 3; c++) {
+    typed.expected[c] = float(sum[c] / area);
+  }
+  return typed;
+}
+
+static TypedInput<std::uint16_t> to_half(const TestCase &test_case,
+                                         const float *input) {
+  const int nx = test_case.nx;
+  const Rect &rect = test_case.rect;
+  TypedInput<std::uint16_t> typed;
+  typed.input.resize(std::size_t(3) * test_case.ny * nx);
+  for (std::size_t i = 0; i < typed.input.size(); i++) {
+    typed.input[i] = float_to_half(input[i]);
+  }
+  double sum[3] = {0.0, 0.0, 0.0};
+  for (int y = rect.y0; y < rect.y1; y++) {
+    for (int x = rect.x0; x < rect.x1; x++) {
+      for (int c = 0; c < 3; c++) {
+        sum[c] +=
+            half_to_float(typed.input[c + 3 * x + std::size_t(3) * nx * y]);
+      }
+    }
+  }
+  const double area = double(rect.y1 - rect.y0) * (rect.x1 - rect.x0);
+  for (int c = 0; c < 3; c++) {
+    typed.expected[c] = float(sum[c] / area);
+  }
+  return typed;
+}
+
+// The input copied into other layouts: RRR...GGG...BBB planes, the middle
+// of an interleaved image with a border of 1 row and 2 columns, whose row
+// pitch is still a multiple of 3, and RGBA pixels, 4 values apart.
+static std::vector<float> to_planar(int ny, int nx, const float *input) {
+  std::vector<float> planar(std::size_t(3) * ny * nx);
+  for (std::size_t i = 0; i < std::size_t(ny) * nx; i++) {
+    for (int c = 0; c < 3; c++) {
+      planar[c * std::size_t(ny) * nx + i] = input[3 * i + c];
+    }
+  }
+  return planar;
+}
+
+static std::vector<float> to_bordered(int ny, int nx, const float *input) {
+  const int pitch = 3 * (nx + 4);
+  std::vector<float> bordered(std::size_t(pitch) * (ny + 2), -1.0f);
+  for (int y = 0; y < ny; y++) {
+    std::copy(input + std::size_t(3) * nx * y,
+              input + std::size_t(3) * nx * (y + 1),
+              bordered.begin() + std::size_t(pitch) * (y + 1) + 3 * 2);
+  }
+  return bordered;
+}
+
+static std::vector<float> to_rgba(int ny, int nx, const float *input) {
+  std::vector<float> rgba(std::size_t(4) * ny * nx, -1.0f);
+  for (std::size_t i = 0; i < std::size_t(ny) * nx; i++) {
+    std::copy(input + 3 * i, input + 3 * i + 3, rgba.begin() + 4 * i);
+  }
+  return rgba;
+}
+
+struct Variant {
+  std::string name;
+  Result result;
+  Result expected;
+  // Error in anything else than the averages
+  float other_error;
+};
+
+// Write an index file of the input with the given block size to a
+// temporary file, map it back and answer the rectangle from it, reading the
+// input only where the index asks for it. A checksum other than that of the
+// input counts as an error of 1.
+static Variant index_variant(const std::string &name, const TestCase &test_case,
+                             const float *input, int block) {
+  const int ny = test_case.ny;
+  const int nx = test_case.nx;
+  const Rect &rect = test_case.rect;
+  std::ostringstream name_stream;
+  name_stream << "average-test-" << getpid() << '-'
+              << std::this_thread::get_id() << ".index";
+  const std::string path =
+      (std::filesystem::temp_directory_path() / name_stream.str()).string();
+  write_index(path, ny, nx, input, block);
+  const IndexFile index(path);
+  std::remove(path.c_str());
+  const Result expected = {
+      {test_case.expected[0], test_case.expected[1], test_case.expected[2]}};
+  const bool same = index.checksum() == image_checksum(ny, nx, input);
+  return {name,
+          index.calculate(rect.y0, rect.x0, rect.y1, rect.x1,
+                          block > 1 ? input : nullptr),
+          expected, same ? 0.0f : 1.0f};
+}
+
+// Largest error of calculate_stats() in the variance, minimum and maximum,
+// against a plain two-pass computation over the RGB channels, and in all
+// four statistics of the constant alpha channel of the RGBA copy if there
+// is one.
+static float stats_error(const TestCase &test_case, const float *input,
+                         const std::vector<ChannelStats> &stats) {
+  const int nx = test_case.nx;
+  const Rect &rect = test_case.rect;
+  const double area = double(rect.y1 - rect.y0) * (rect.x1 - rect.x0);
+  float error = 0.0f;
+  for (int c = 0; c < 3; c++) {
+    double sum = 0.0;
+    float min = input[c + 3 * rect.x0 + std::size_t(3) * nx * rect.y0];
+    float max = min;
+    for (int y = rect.y0; y < rect.y1; y++) {
+      for (int x = rect.x0; x < rect.x1; x++) {
+        const float v = input[c + 3 * x + std::size_t(3) * nx * y];
+        sum += v;
+        min = std::min(min, v);
+        max = std::max(max, v);
+      }
+    }
+    const double mean = sum / area;
+    double squares = 0.0;
+    for (int y = rect.y0; y < rect.y1; y++) {
+      for (int x = rect.x0; x < rect.x1; x++) {
+        const double d = input[c + 3 * x + std::size_t(3) * nx * y] - mean;
+        squares += d * d;
+      }
+    }
+    error = std::max(error,
+                     float(std::abs(stats[c].variance - squares / area)));
+    error = std::max(error, std::abs(stats[c].min - min));
+    error = std::max(error, std::abs(stats[c].max - max));
+  }
+  if (stats.size() == 4) {
+    error = std::max(error, float(std::abs(stats[3].mean + 1.0)));
+    error = std::max(error, float(stats[3].variance));
+    error = std::max(error, std::abs(stats[3].min + 1.0f));
+    error = std::max(error, std::abs(stats[3].max + 1.0f));
+  }
+  return error;
+}
+
+static void record_errors(int mode, const VariantErrors &errors) {
+  for (const auto &[variant, error] : errors) {
+    record_error(variant, mode, error);
+  }
+}
+
+// Check every calculation variant on one test case, writing the report to
+// out and the error of each variant to errors.
+static bool check(std::ostream &out, const TestCase &test_case,
+                  const float *input, bool verbose, VariantErrors &errors) {
+  const int ny = test_case.ny;
+  const int nx = test_case.nx;
+  const Rect &rect = test_case.rect;
+  const Result expected = {
+      {test_case.expected[0], test_case.expected[1], test_case.expected[2]}};
+  std::vector<std::pair<std::string, Result>> results;
+  results.emplace_back("calculate",
+                       calculate(ny, nx, input, rect.y0, rect.x0, rect.y1,
+                                 rect.x1));
+  for (Kernel kernel : KERNELS) {
+    results.emplace_back(kernel_name(kernel),
+                         calculate(kernel, ny, nx, input, rect.y0, rect.x0,
+                                   rect.y1, rect.x1));
+  }
+  results.emplace_back("integral image",
+                       IntegralImage(ny, nx, input)
+                           .calculate(rect.y0, rect.x0, rect.y1, rect.x1));
+  results.emplace_back("block pyramid",
+                       BlockPyramid(ny, nx, input, 3)
+                           .calculate(rect.y0, rect.x0, rect.y1, rect.x1));
+  results.emplace_back("sliding window", slide_to(ny, nx, input, rect));
+  results.emplace_back(
+      "banded", calculate_banded(
+                    ny, nx, 7,
+                    [&](int y0, int y1, float *buf) {
+                      std::copy(input + std::size_t(3) * nx * y0,
+                                input + std::size_t(3) * nx * y1, buf);
+                    },
+                    rect.y0, rect.x0, rect.y1, rect.x1));
+  ImageBuffer buffer(ny, nx, rect.y0, rect.y1);
+  std::copy(input, input + std::size_t(3) * ny * nx, buffer.data());
+  results.emplace_back("image buffer",
+                       calculate(ny, nx, buffer.data(), rect.y0, rect.x0,
+                                 rect.y1, rect.x1));
+  const std::vector<float> planar = to_planar(ny, nx, input);
+  results.emplace_back("planar",
+                       calculate(ImageView{planar.data(), ny, nx,
+                                           planar_layout(ny, nx)},
+                                 rect.y0, rect.x0, rect.y1, rect.x1));
+  const std::vector<float> bordered = to_bordered(ny, nx, input);
+  const ImageView bordered_view = {bordered.data(), ny + 2, nx + 4,
+                                   interleaved_layout(nx + 4)};
+  results.emplace_back("cropped view",
+                       calculate(bordered_view.crop(1, 2, ny + 1, nx + 2),
+                                 rect.y0, rect.x0, rect.y1, rect.x1));
+  const std::vector<float> rgba = to_rgba(ny, nx, input);
+  results.emplace_back("rgba", calculate(ImageView{rgba.data(), ny, nx,
+                                                   interleaved_layout(nx, 4)},
+                                         rect.y0, rect.x0, rect.y1, rect.x1));
+  std::vector<Variant> variants;
+  for (const auto &[name, result] : results) {
+    variants.push_back({name, result, expected, 0.0f});
+  }
+  variants.push_back(index_variant("index file", test_case, input, 1));
+  variants.push_back(index_variant("block index file", test_case, input, 7));
+  const std::pair<std::string, ImageView> stats_views[] = {
+      {"stats", {input, ny, nx, interleaved_layout(nx)}},
+      {"rgba stats", {rgba.data(), ny, nx, interleaved_layout(nx, 4)}},
+      {"planar stats", {planar.data(), ny, nx, planar_layout(ny, nx)}},
+  };
+  for (const auto &[name, view] : stats_views) {
+    const std::vector<ChannelStats> stats =
+        calculate_stats(view, rect.y0, rect.x0, rect.y1, rect.x1);
+    variants.push_back({name, to_result(stats), expected,
+                        stats_error(test_case, input, stats)});
+  }
+
+  // The other pixel types have expected values of their own, and uint8 is
+  // compared in units of 255 so that the same threshold applies.
+  const TypedInput<std::uint8_t> u8 = to_uint8(test_case, input);
+  const auto u8_average = [&] {
+    Result result =
+        calculate(ny, nx, u8.input.data(), rect.y0, rect.x0, rect.y1, rect.x1);
+    for (int c = 0; c < 3; c++) {
+      result.avg[c] /= 255.0f;
+    }
+    return result;
+  };
+  const Result u8_expected = {
+      {u8.expected[0] / 255.0f, u8.expected[1] / 255.0f,
+       u8.expected[2] / 255.0f}};
+  variants.push_back({"uint8", u8_average(), u8_expected, 0.0f});
+  const TypedInput<std::uint16_t> half = to_half(test_case, input);
+  const auto half_average = [&] {
+    return calculate_half(ny, nx, half.input.data(), rect.y0, rect.x0,
+                          rect.y1, rect.x1);
+  };
+  const Result half_expected = {
+      {half.expected[0], half.expected[1], half.expected[2]}};
+  variants.push_back({"half", half_average(), half_expected, 0.0f});
+
+  // Everything that depends on the instruction set once more with each one
+  // this machine supports, not only the best one used above.
+  for (const std::string &target : simd_targets()) {
+    set_simd_target(target);
+    for (Kernel kernel : {Kernel::simd, Kernel::blocked}) {
+      variants.push_back({std::string(kernel_name(kernel)) + "/" + target,
+                          calculate(kernel, ny, nx, input, rect.y0, rect.x0,
+                                    rect.y1, rect.x1),
+                          expected, 0.0f});
+    }
+    variants.push_back(
+        {"planar/" + target,
+         calculate(ImageView{planar.data(), ny, nx, planar_layout(ny, nx)},
+                   rect.y0, rect.x0, rect.y1, rect.x1),
+         expected, 0.0f});
+    variants.push_back({"uint8/" + target, u8_average(), u8_expected, 0.0f});
+    variants.push_back(
+        {"half/" + target, half_average(), half_expected, 0.0f});
+  }
+  set_simd_target("");
+
+  float error = 0.0f;
+  for (const Variant &variant : variants) {
+    float variant_error = variant.other_error;
+    for (int c = 0; c < 3; c++) {
+      variant_error =
+          std::max(variant_error, std::abs(variant.result.avg[c] -
+                                           variant.expected.avg[c]));
+    }
+    errors.emplace_back(variant.name, variant_error);
+    error = std::max(error, variant_error);
+  }
 
   const bool pass = error <= THRESHOLD;
-  std::cout << std::setw(6) << std::setprecision(4) << std::fixed
+  out << std::setw(6) << std::setprecision(4) << std::fixed
             << error / THRESHOLD << ' ';
 
   if (verbose) {
     if (ny < 25 && nx < 25) {
-      std::cout << "\ninput:\n";
-      print(ny, nx, test_case.rect, test_case.input.data());
-      std::cout << "\n  y0: " << test_case.rect.y0 << '\n';
-      std::cout << "  x0: " << test_case.rect.x0 << '\n';
-      std::cout << "  y1: " << test_case.rect.y1 << '\n';
-      std::cout << "  x1: " << test_case.rect.x1 << '\n';
+      out << "\ninput:\n";
+      print(out, ny, nx, test_case.rect, input);
+      out << "\n  y0: " << test_case.rect.y0 << '\n';
+      out << "  x0: " << test_case.rect.x0 << '\n';
+      out << "  y1: " << test_case.rect.y1 << '\n';
+      out << "  x1: " << test_case.rect.x1 << '\n';
     }
-    std::cout << "\nexpected:\n  ";
-    print_color(test_case.expected);
-    std::cout << "\n\ngot:\n  ";
-    print_color(result.avg);
-    std::cout << "\n\n";
+    out << "\nexpected:\n  ";
+    print_color(out, test_case.expected);
+    out << "\n";
+    for (const Variant &variant : variants) {
+      if (!std::equal(variant.expected.avg, variant.expected.avg + 3,
+                      expected.avg)) {
+        out << "\nexpected (" << variant.name << "):\n  ";
+        print_color(out, variant.expected.avg);
+        out << "\n";
+      }
+      out << "\ngot (" << variant.name << "):\n  ";
+      print_color(out, variant.result.avg);
+      out << "\n";
+    }
+    out << "\n";
   }
 
   return pass;
 }
 
+static bool test(std::ostream &out, int ny, int nx, int mode, int sy, int sx,
+                 bool verbose, VariantErrors &errors) {
+  const LoadedTestCase loaded = load(ny, nx, mode, sy, sx);
+  return check(out, loaded.test_case, loaded.input(), verbose, errors);
+}
+
 static bool has_fails = false;
 static struct {
   int ny;
@@ -376,12 +874,12 @@ static struct {
 static int passcount = 0;
 static int testcount = 0;
 
-static void run_test(int ny, int nx, int mode, int sy, int sx, bool verbose) {
-  std::cout << "average-test " << std::setw(4) << ny << ' ' << std::setw(4)
-            << nx << ' ' << std::setw(1) << mode << ' ' << std::flush;
-  const bool pass = test(ny, nx, mode, sy, sx, verbose);
+static void print_test_name(std::ostream &out, int ny, int nx, int mode) {
+  out << "average-test " << std::setw(4) << ny << ' ' << std::setw(4) << nx
+      << ' ' << std::setw(1) << mode << ' ';
+}
 
-  std::cout << (pass ? "OK\n" : "ERR\n");
+static void count_test(int ny, int nx, int mode, bool pass) {
   if (pass) {
     passcount++;
   } else if (!has_fails) {
@@ -393,18 +891,142 @@ static void run_test(int ny, int nx, int mode, int sy, int sx, bool verbose) {
   testcount++;
 }
 
+static void run_test(int ny, int nx, int mode, int sy, int sx, bool verbose) {
+  print_test_name(std::cout, ny, nx, mode);
+  std::cout << std::flush;
+  VariantErrors errors;
+  const bool pass = test(std::cout, ny, nx, mode, sy, sx, verbose, errors);
+  std::cout << (pass ? "OK\n" : "ERR\n");
+  record_errors(mode, errors);
+  count_test(ny, nx, mode, pass);
+}
+
+struct SuiteCase {
+  int ny;
+  int nx;
+  int mode;
+  bool done;
+  bool pass;
+  std::string output;
+  VariantErrors errors;
+};
+
+// Run the suite cases on a pool of worker threads. Each case writes its
+// report into a buffer, and the buffers are printed in suite order as soon
+// as all earlier cases have finished, so the output is the same as for a
+// sequential run.
+static void run_suite_parallel(std::vector<SuiteCase> &cases, int jobs) {
+  std::mutex mutex;
+  std::condition_variable finished;
+  std::size_t next = 0;
+  auto worker = [&] {
+    // The cases run side by side, each on a single thread
+    set_thread_limit(1);
+    while (true) {
+      std::size_t i;
+      {
+        std::lock_guard<std::mutex> lock(mutex);
+        if (next == cases.size()) {
+          return;
+        }
+        i = next++;
+      }
+      SuiteCase &c = cases[i];
+      std::ostringstream out;
+      VariantErrors errors;
+      const bool pass = test(out, c.ny, c.nx, c.mode, -1, -1, false, errors);
+      out << (pass ? "OK\n" : "ERR\n");
+      {
+        std::lock_guard<std::mutex> lock(mutex);
+        c.pass = pass;
+        c.output = out.str();
+        c.errors = std::move(errors);
+        c.done = true;
+      }
+      finished.notify_all();
+    }
+  };
+  std::vector<std::thread> threads;
+  for (int j = 0; j < jobs; j++) {
+    threads.emplace_back(worker);
+  }
+  for (SuiteCase &c : cases) {
+    {
+      std::unique_lock<std::mutex> lock(mutex);
+      finished.wait(lock, [&] { return c.done; });
+    }
+    print_test_name(std::cout, c.ny, c.nx, c.mode);
+    std::cout << c.output << std::flush;
+    record_errors(c.mode, c.errors);
+    count_test(c.ny, c.nx, c.mode, c.pass);
+    c.output.clear();
+  }
+  for (std::thread &thread : threads) {
+    thread.join();
+  }
+}
+
+static bool run_file_test(const std::string &path) {
+  int mode;
+  const TestCase test_case = read_test_case(path, mode);
+  std::cout << "average-test --image " << path << ' ' << std::flush;
+  bool pass;
+  try {
+    const MappedImage image(path, test_case.ny, test_case.nx);
+    VariantErrors errors;
+    pass = check(std::cout, test_case, image.data(), true, errors);
+  } catch (const std::runtime_error &e) {
+    error(e.what());
+  }
+  std::cout << (pass ? "OK\n" : "ERR\n");
+  return pass;
+}
+
 int main(int argc, const char **argv) {
-  if (argc == 1) {
-    // Run the whole suite
+  if (argc >= 2 && std::string(argv[1]) == "--write") {
+    // Generate a test case and store it for --image
+    if (argc != 6 && argc != 8) {
+      error("Usage:\n  average-test --write <file> <ny> <nx> <mode> "
+            "[<sy> <sx>]");
+    }
+    int ny = std::stoi(argv[3]);
+    int nx = std::stoi(argv[4]);
+    int mode = std::stoi(argv[5]);
+    int sy = argc == 8 ? std::stoi(argv[6]) : -1;
+    int sx = argc == 8 ? std::stoi(argv[7]) : -1;
+    try {
+      write_test_case(argv[2], mode, generate(ny, nx, mode, sy, sx));
+    } catch (const std::runtime_error &e) {
+      error(e.what());
+    }
+  } else if (argc == 3 && std::string(argv[1]) == "--image") {
+    // Run a stored test case, reading the image through a memory mapping
+    if (!run_file_test(argv[2])) {
+      exit(EXIT_FAILURE);
+    }
+  } else if (argc == 1 || (argc == 3 && std::string(argv[1]) == "-j")) {
+    // Run the whole suite, on a pool of threads with -j
+    const int jobs = argc == 3 ? std::stoi(argv[2]) : 1;
+    if (jobs < 1) {
+      error("-j needs at least one job");
+    }
+    std::vector<SuiteCase> cases;
     for (int ny : {1, 2, 3, 5, 10, 50, 100, 1000}) {
       for (int nx : {1, 2, 3, 5, 10, 50, 100, 1000}) {
-        run_test(ny, nx, 1, -1, -1, false);
-        run_test(ny, nx, 2, -1, -1, false);
-        run_test(ny, nx, 3, -1, -1, false);
-        run_test(ny, nx, 4, -1, -1, false);
+        for (int mode : {1, 2, 3, 4}) {
+          cases.push_back({ny, nx, mode, false, false, {}, {}});
+        }
+      }
+    }
+    if (jobs == 1) {
+      for (const SuiteCase &c : cases) {
+        run_test(c.ny, c.nx, c.mode, -1, -1, false);
       }
+    } else {
+      run_suite_parallel(cases, jobs);
     }
 
+    print_worst_errors();
     std::cout << passcount << '/' << testcount << " tests passed.\n";
     if (has_fails) {
       std::cout << "To repeat the first failed test with more output, run:\n"
@@ -433,7 +1055,12 @@ int main(int argc, const char **argv) {
       exit(EXIT_FAILURE);
     }
   } else {
-    std::cout << "Usage:\n  average-test\n  average-test <ny> <nx> <mode>\n  "
-                 "average-test <ny> <nx> <mode> <sy> <sx>\n";
+    std::cout << "Usage:\n  average-test [-j <jobs>]\n  "
+                 "average-test <ny> <nx> <mode>\n  "
+                 "average-test <ny> <nx> <mode> <sy> <sx>\n  "
+                 "average-test --write <file> <ny> <nx> <mode> [<sy> <sx>]\n  "
+                 "average-test --image <file>\n"
+                 "Generated test cases are cached in the directory "
+                 "PPC_TEST_CACHE, if set.\n";
   }
 }
\ No newline at end of file
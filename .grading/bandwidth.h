@@ -0,0 +1,113 @@
+#ifndef BANDWIDTH_H
+#define BANDWIDTH_H
+
+#include <algorithm>
+#include <chrono>
+#include <cstdint>
+#include <cstdlib>
+#include <fstream>
+#include <memory>
+#include <string>
+
+#include <sys/stat.h>
+#include <unistd.h>
+
+namespace ppc
+{
+
+// Peak streaming read bandwidth of this host in GB/s, to report how close a
+// memory-bound kernel gets to the limit of the machine. It is measured once
+// by summing a buffer much larger than the caches on every core, and the
+// result is cached in a file per host name in the directory
+// PPC_BANDWIDTH_CACHE (by default ~/.cache/ppc). Delete the file to measure
+// again. Unoptimised builds measure but do not cache, as their loop is not
+// representative.
+class peak_bandwidth {
+public:
+    static double get() {
+        static const double gb_per_s = load_or_measure();
+        return gb_per_s;
+    }
+
+    // The cached peak without measuring it, or 0 if this host has not been
+    // measured yet. For timed runs, which cannot afford the measurement.
+    static double cached() {
+        const std::string path = cache_path();
+        double gb_per_s = 0.0;
+        if (!path.empty()) {
+            std::ifstream in(path);
+            if (in >> gb_per_s && gb_per_s > 0.0) {
+                return gb_per_s;
+            }
+        }
+        return 0.0;
+    }
+
+private:
+    // 256 MiB
+    static constexpr std::size_t WORDS = std::size_t(1) << 25;
+    static constexpr int REPEAT = 5;
+
+    static double load_or_measure() {
+        double gb_per_s = cached();
+        if (gb_per_s > 0.0) {
+            return gb_per_s;
+        }
+        gb_per_s = measure();
+#ifdef __OPTIMIZE__
+        const std::string path = cache_path();
+        if (!path.empty()) {
+            std::ofstream out(path);
+            out << gb_per_s << '\n';
+        }
+#endif
+        return gb_per_s;
+    }
+
+    static std::string cache_path() {
+        std::string dir;
+        if (const char *env = std::getenv("PPC_BANDWIDTH_CACHE")) {
+            dir = env;
+        } else if (const char *home = std::getenv("HOME")) {
+            dir = std::string(home) + "/.cache";
+            mkdir(dir.c_str(), 0777);
+            dir += "/ppc";
+        } else {
+            return {};
+        }
+        mkdir(dir.c_str(), 0777);
+        char host[256] = {};
+        if (gethostname(host, sizeof(host) - 1) != 0) {
+            return {};
+        }
+        return dir + "/bandwidth-" + host;
+    }
+
+    static double measure() {
+        std::unique_ptr<std::uint64_t[]> buf(new std::uint64_t[WORDS]);
+        // Touched by the threads that read it, for NUMA placement
+        #pragma omp parallel for schedule(static)
+        for (std::size_t i = 0; i < WORDS; ++i) {
+            buf[i] = i;
+        }
+        double best = 0.0;
+        volatile std::uint64_t sink = 0;
+        for (int r = 0; r < REPEAT; ++r) {
+            const auto start = std::chrono::high_resolution_clock::now();
+            std::uint64_t sum = 0;
+            #pragma omp parallel for schedule(static) reduction(+:sum)
+            for (std::size_t i = 0; i < WORDS; ++i) {
+                sum += buf[i];
+            }
+            const std::chrono::duration<double> seconds =
+                std::chrono::high_resolution_clock::now() - start;
+            sink = sink + sum;
+            best = std::max(best, WORDS * sizeof(std::uint64_t) / seconds.count() / 1e9);
+        }
+        return best;
+    }
+};
+
+}
+
+#endif
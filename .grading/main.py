@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import datetime
+import glob
+import hashlib
 import json
+import multiprocessing
 import os
+import math
 import platform
+import shutil
 import socket
+import statistics
 import subprocess
 import sys
 import textwrap
@@ -34,16 +41,42 @@ REPORT = 'report.pdf'
 class default:
     MAX = [5,3]
 
-    # Before each test iteration, a command list from here is run
-    TEST_DEBUG_COMMAND_LISTS_CPU = [
-        [['make', 'clean'], ['make', '-j', 'DEBUG=2']],
-        [['make', 'clean'], ['make', '-j']],
+    # Each test configuration is built with these make arguments in its own
+    # directory under BUILD_ROOT and tested there, all configurations at the
+    # same time. Build directories are kept between runs, so make only
+    # rebuilds what changed. The last configuration is used for benchmarking.
+    TEST_DEBUG_BUILDS_CPU = [
+        ['debug', ['DEBUG=2']],
+        ['release', []],
     ]
 
-    TEST_DEBUG_COMMAND_LISTS_GPU = [
-        [['make', 'clean'], ['make', '-j']],
+    TEST_DEBUG_BUILDS_GPU = [
+        ['release', []],
     ]
 
+    BUILD_ROOT = 'build'
+
+    # Binaries of built configurations are kept here, named by a hash of
+    # everything that goes into the build, and reused instead of building
+    # again. The least recently used ones are removed when the cache grows
+    # over PPC_BUILD_CACHE_MB megabytes.
+    BUILD_CACHE = os.path.join('build', 'cache')
+    BUILD_CACHE_MB = 256
+
+    # Generated test cases are kept here by the tests, shared by all
+    # configurations and runs
+    TEST_CACHE = os.path.join('build', 'test-cache')
+
+    # grading sweep writes its rows to SWEEP_OUTPUT, and compares them with
+    # SWEEP_BASELINE if it exists; a point more than SWEEP_TOLERANCE slower
+    # than in the baseline is a regression
+    SWEEP_OUTPUT = 'sweep.json'
+    SWEEP_BASELINE = 'sweep-baseline.json'
+    SWEEP_TOLERANCE = 0.1
+
+    # Files that a build depends on, relative to the root directory
+    BUILD_INPUTS = ['Makefile', 'Makefile.dep', '*.cc', '*.h', '.grading/*.cc', '.grading/*.h', 'tools/*.cc', 'tools/*.h']
+
 CPU_BASELINE = 'Implement a simple *sequential* baseline solution. Make sure it works correctly. Do not use any form of parallelism yet.'
 CPU_FAST = 'Using all resources that you have in the CPU, solve the task *as fast as possible*. You are encouraged to exploit instruction-level parallelism, multithreading, and vector instructions whenever possible, and also to optimize the memory access pattern.'
 GPU_BASELINE = 'Implement a simple baseline solution for the *GPU*. Make sure it works correctly and that it is reasonably efficient. Make sure that all performance-critical parts are executed on the GPU; you can do some lightweight preprocessing and postprocessing also on the CPU.'
@@ -63,6 +96,8 @@ TASKS = [
         ],
         'benchmark': ['./average-benchmark', '2000', '2000', '1500', '1500'],
         'benchmarktest': ['./average-test', '2000', '2000', '4', '1500', '1500'],
+        'sweep': ['./average-benchmark', 'sweep', 'json'],
+        'peak': ['./average-benchmark', 'peak'],
         'max': [0, 0],
         'time': [0.2],
         'week': 1,
@@ -122,17 +157,77 @@ def print_run(c, output=False, timelimit=inf):
     except:
         error("Command '{}' failed".format(" ".join(c)))
 
+def print_counters(counters):
+    names = []
+    for c in counters:
+        names += [name for name in c if name not in names]
+    if not names:
+        return
+    median = {name: statistics.median(c[name] for c in counters if name in c) for name in names}
+    print()
+    print("Performance counters (median of {}):".format(plural(len(counters), "run")))
+    for name in names:
+        print("  {:14s} {b}{:>16,.0f}{n}".format(name, median[name], b=col.bold, n=col.reset))
+    if 'cycles' in median and 'instructions' in median and median['cycles'] > 0:
+        print("  {:14s} {b}{:>16.2f}{n}".format("IPC", median['instructions'] / median['cycles'], b=col.bold, n=col.reset))
+
+# Each line of "benchmark.run" is a time, optionally followed by performance
+# counters as name=value fields
 def read_benchmarkfile():
+    times = []
+    counters = []
     with open("benchmark.run", "r") as benchmarksfile:
-        ret = [float(x) for x in benchmarksfile.read().split('\n') if len(x) > 0]
-    return ret
+        for line in benchmarksfile.read().split('\n'):
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+            times.append(float(fields[0]))
+            counters.append({name: float(value) for name, value in (f.split('=', 1) for f in fields[1:])})
+    print_counters(counters)
+    return times
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        error("{} should be an integer, not '{}'".format(name, value))
+
+# Repetitions of the benchmark command and which statistic is graded, from
+# the environment: PPC_WARMUP untimed runs are done first, then PPC_REPEAT
+# timed runs, and the running time is their PPC_GRADE_ON statistic.
+class timing:
+    WARMUP = env_int("PPC_WARMUP", 0)
+    REPEAT = env_int("PPC_REPEAT", 1)
+    GRADE_ON = os.environ.get("PPC_GRADE_ON", "last")
+    GRADE_CHOICES = ['last', 'min', 'median']
+
+def timing_stats(times):
+    s = sorted(times)
+    return {
+        'last': times[-1],
+        'min': s[0],
+        'median': statistics.median(s),
+        'p95': s[max(0, math.ceil(0.95 * len(s)) - 1)],
+        'stddev': statistics.stdev(s) if len(s) > 1 else 0.0,
+    }
+
+def print_timing_stats(stats, n):
+    print()
+    print("{} timed runs: min {b}{:.6f}{n}  median {b}{:.6f}{n}  p95 {b}{:.6f}{n}  stddev {b}{:.6f}{n}".format(
+        n, stats['min'], stats['median'], stats['p95'], stats['stddev'],
+        b=col.bold, n=col.reset,
+    ))
 
 # Runs command and retuns the results of "benchmarks.run" file as array of float
-def run_timed(c, timelimit=inf):
+def run_timed(c, timelimit=inf, warmup=0):
     print()
     pcmd(c)
     ppc_env = os.environ
     ppc_env["PPC_BENCHMARK"] = "1"
+    ppc_env["PPC_WARMUP"] = str(warmup)
     try:
         subprocess.check_call(c, timeout=timelimit, env=ppc_env)
         ret = read_benchmarkfile();
@@ -147,6 +242,174 @@ def run_timed(c, timelimit=inf):
 
 
 
+# The same command, but running the binary from directory d
+def in_dir(c, d):
+    return [os.path.join(d, os.path.basename(c[0]))] + c[1:]
+
+# Hash of the sources, make arguments, compiler version and host of a
+# build. The Makefile builds with -march=native, so the options that it
+# expands to and the host name are part of the key, and a cache shared
+# between hosts never hands out binaries for another CPU.
+def build_key(make_args):
+    h = hashlib.sha256()
+    for pattern in default.BUILD_INPUTS:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, 'rb') as f:
+                h.update(path.encode() + b'\0' + f.read() + b'\0')
+    for arg in make_args:
+        h.update(arg.encode() + b'\0')
+    for var in ['CXX', 'CXXFLAGS', 'LDFLAGS']:
+        h.update(os.environ.get(var, '').encode() + b'\0')
+    cxx = os.environ.get('CXX', 'g++')
+    try:
+        version = subprocess.run([cxx, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+    except OSError:
+        version = b''
+    h.update(version)
+    try:
+        target = subprocess.run([cxx, '-march=native', '-Q', '--help=target'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        target = b''
+    h.update(target)
+    h.update(platform.machine().encode() + b'\0' + platform.node().encode())
+    return h.hexdigest()
+
+def cache_size_limit():
+    return env_int('PPC_BUILD_CACHE_MB', default.BUILD_CACHE_MB) * 2**20
+
+def dir_size(d):
+    return sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+
+# Copy the binaries of a cached build to builddir, if there is one
+def restore_build(key, builddir):
+    entry = os.path.join(default.BUILD_CACHE, key)
+    if cache_size_limit() <= 0 or not os.path.isdir(entry):
+        return False
+    os.makedirs(builddir, exist_ok=True)
+    for f in os.listdir(entry):
+        shutil.copy2(os.path.join(entry, f), builddir)
+    # Marks the entry as recently used
+    os.utime(entry)
+    return True
+
+# Store the binaries of builddir in the cache, then evict the least
+# recently used entries until the cache fits in its size limit
+def store_build(key, builddir):
+    limit = cache_size_limit()
+    if limit <= 0:
+        return
+    os.makedirs(default.BUILD_CACHE, exist_ok=True)
+    entry = os.path.join(default.BUILD_CACHE, key)
+    tmp = entry + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp)
+    for f in os.listdir(builddir):
+        path = os.path.join(builddir, f)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            shutil.copy2(path, tmp)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    entries = []
+    for e in os.listdir(default.BUILD_CACHE):
+        path = os.path.join(default.BUILD_CACHE, e)
+        try:
+            entries.append((os.path.getmtime(path), dir_size(path), path))
+        except OSError:
+            # Being removed or stored by another worker
+            pass
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if path != entry:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+# Build one test configuration and run the tests with it, in a worker
+# process. Returns whether it succeeded, everything it printed, and the
+# command that failed if any.
+def build_and_test(name, make_args, test_command):
+    builddir = os.path.join(default.BUILD_ROOT, name)
+    key = build_key(make_args)
+    env = dict(os.environ)
+    env.setdefault('PPC_TEST_CACHE', default.TEST_CACHE)
+    log = []
+    commands = [in_dir(test_command, builddir)]
+    if restore_build(key, builddir):
+        log.append("\nUsing cached build {} in {}\n".format(key[:12], builddir))
+    else:
+        commands.insert(0, ['make', '-j', 'O=' + builddir] + make_args)
+    for i, c in enumerate(commands):
+        log.append("\n" + col.cmd + " ".join(c) + col.reset + "\n")
+        try:
+            r = subprocess.run(c, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=600, env=env)
+        except subprocess.TimeoutExpired:
+            log.append("Command {} took too long\n".format(" ".join(c)))
+            return False, "".join(log), c
+        log.append(r.stdout.decode('utf-8', 'replace'))
+        if r.returncode != 0:
+            return False, "".join(log), c
+        if len(commands) == 2 and i == 0:
+            store_build(key, builddir)
+    return True, "".join(log), None
+
+# Thread counts of a sweep: powers of two up to the number of cores, and
+# the number of cores
+def sweep_thread_counts():
+    cores = os.cpu_count() or 1
+    counts = []
+    t = 1
+    while t < cores:
+        counts.append(t)
+        t *= 2
+    return counts + [cores]
+
+# Run the sweep command once per thread count, returning its rows
+def run_sweep(c):
+    rows = []
+    for threads in sweep_thread_counts():
+        env = dict(os.environ)
+        env["PPC_THREADS"] = str(threads)
+        print()
+        pcmd(["PPC_THREADS={}".format(threads)] + c)
+        try:
+            output = subprocess.check_output(c, env=env, timeout=600).decode('utf-8')
+        except subprocess.TimeoutExpired:
+            error("Command {} took too long".format(" ".join(c)))
+        except:
+            error("Command '{}' failed".format(" ".join(c)))
+        rows += [json.loads(line) for line in output.splitlines() if line.strip()]
+    return rows
+
+def sweep_key(row):
+    return (row['ny'], row['nx'], row['sy'], row['sx'], row['kernel'], row['threads'])
+
+# Print the rows with their change from the baseline, returning the rows
+# that are slower than the baseline by more than the tolerance
+def print_sweep(rows, baseline):
+    base = {sweep_key(r): r for r in baseline}
+    regressions = []
+    print()
+    print("{:>11} {:>11} {:<14} {:>7} {:>11} {:>8} {:>7} {:>9} {:>8}".format(
+        'image', 'rectangle', 'kernel', 'threads', 'seconds', 'GB/s', '% peak', 'Gpixel/s', 'change'))
+    for r in rows:
+        b = base.get(sweep_key(r))
+        change = ''
+        regression = False
+        if b is not None:
+            ratio = r['seconds'] / b['seconds']
+            change = '{:+.1f}%'.format(100 * (ratio - 1))
+            regression = ratio > 1 + default.SWEEP_TOLERANCE
+            if regression:
+                regressions.append(r)
+        line = "{:>11} {:>11} {:<14} {:>7} {:>11.6f} {:>8.2f} {:>7.1f} {:>9.3f} {:>8}".format(
+            "{}x{}".format(r['ny'], r['nx']), "{}x{}".format(r['sy'], r['sx']),
+            r['kernel'], r['threads'], r['seconds'], r['gb_per_s'],
+            r['peak_percent'], r['pixels_per_s'] / 1e9, change)
+        print(col.error + line + col.reset if regression else line)
+    return regressions
+
 def dnone(x, s=""):
     return s if x is None else "{:d}".format(x)
 
@@ -193,6 +456,8 @@ class Task:
             self.gpu = t.get('gpu', False)
             self.benchmark = t['benchmark']
             self.benchmarktest = t.get('benchmarktest', None)
+            self.sweep = t.get('sweep', None)
+            self.peak = t.get('peak', None)
             self.time = t['time']
             self.timelimit = t.get('timelimit', self.time[-1] * 2.5)
         self.max = t.get('max', default.MAX)
@@ -208,6 +473,11 @@ class Task:
         else:
             self.url = URL_BASE + self.family + "/"
         self.path = grading.root
+        # Directory of the binaries to benchmark and test, the last build
+        # configuration
+        builds = default.TEST_DEBUG_BUILDS_GPU if t.get('gpu', False) else default.TEST_DEBUG_BUILDS_CPU
+        self.bindir = os.path.join(default.BUILD_ROOT, builds[-1][0])
+        self.make_args = builds[-1][1]
 
         if self.report:
             self.filename = os.path.join(self.path, REPORT)
@@ -282,41 +552,59 @@ class Task:
         return 0
 
 
-    # Run tests for a task
-    def test(self):
+    # Command that runs the tests for a task
+    def test_command(self):
         if self.family == "cp":
-            print_run(['./cp-test'])
+            return ['./cp-test']
         elif self.family == "mf":
-            print_run(['./mf-test'])
+            return ['./mf-test']
         elif self.family == "is":
             if self.id == "is6a" or self.id == "is6b":
-                print_run(['./is-test', 'binary'])
+                return ['./is-test', 'binary']
             else:
-                print_run(['./is-test'])
+                return ['./is-test']
         elif self.family == "so":
-            print_run(['./so-test'])
+            return ['./so-test']
         elif self.family == "nn":
-            print_run(['./nn-test'])
+            return ['./nn-test']
         elif self.family == "prereq":
-            print_run(['./average-test'])
+            return ['./average-test', '-j', str(os.cpu_count() or 1)]
         else:
             error("Tests for task not found")
+
+    # Build the binaries in bindir if they are not there yet, for the
+    # commands that run without re-compiling
+    def ensure_built(self):
+        if not os.path.isdir(self.bindir):
+            print_run(['make', '-j', 'O=' + self.bindir] + self.make_args)
+
+    # Run tests for a task
+    def test(self):
+        self.ensure_built()
+        print_run(in_dir(self.test_command(), self.bindir))
         print(col.good + "Test OK" + col.reset)
 
 
 
-    # Run tests with all debug combinations
+    # Build and run tests with all debug combinations in parallel
     def test_with_debug(self):
-        command_list_array = default.TEST_DEBUG_COMMAND_LISTS_GPU if self.gpu else default.TEST_DEBUG_COMMAND_LISTS_CPU
-        for command_list in command_list_array:
-            for command in command_list:
-                print_run(command)
-            self.test()
+        builds = default.TEST_DEBUG_BUILDS_GPU if self.gpu else default.TEST_DEBUG_BUILDS_CPU
+        test_command = self.test_command()
+        # fork, because this script does its work at import time
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(builds), mp_context=context) as pool:
+            futures = [pool.submit(build_and_test, name, make_args, test_command) for name, make_args in builds]
+            for future in futures:
+                ok, log, failed = future.result()
+                print(log, end='')
+                if not ok:
+                    error("Command '{}' failed".format(" ".join(failed)))
+                print(col.good + "Test OK" + col.reset)
 
     def run_benchmarktest(self):
         if self.benchmarktest != None:
             print("\nRunning test with benchmark size:")
-            print_run(self.benchmarktest)
+            print_run(in_dir(self.benchmarktest, self.bindir))
             print(col.good + "Test OK" + col.reset)
 
 
@@ -648,11 +936,23 @@ class Grading:
                 if not skiptest:
                     task.test_with_debug()
                     task.run_benchmarktest()
-
-                output = run_timed(task.benchmark, timelimit=task.timelimit)
-                time = output[-1]
+                else:
+                    task.ensure_built()
+
+                # Measured outside the time limit of the benchmark, which
+                # only reads the cached value
+                if task.peak is not None:
+                    print_run(in_dir(task.peak, task.bindir))
+
+                runs = timing.WARMUP + timing.REPEAT
+                command = in_dir(task.benchmark, task.bindir) + ([str(runs)] if runs > 1 else [])
+                output = run_timed(command, timelimit=task.timelimit * runs, warmup=timing.WARMUP)
+                stats = timing_stats(output)
+                if len(output) > 1:
+                    print_timing_stats(stats, len(output))
+                time = stats[timing.GRADE_ON]
                 print()
-                print("Success! Your running time: {}{}{}".format(col.bold, time, col.reset))
+                print("Success! Your running time ({}): {}{}{}".format(timing.GRADE_ON, col.bold, time, col.reset))
                 # print("The grading thresholds are:")
                 # print()
                 # self.task_table(task, time)
@@ -668,6 +968,37 @@ class Grading:
         if high_load:
             warning("System load was fairly high when you started grading, careful!")
 
+    # Run the scaling sweep of each task without re-compiling, and compare
+    # it with the baseline; with save, the results become the new baseline
+    def sweep(self, tasks, save=False):
+        for taskid in tasks:
+            task = self.task_map[taskid]
+            ptask(task)
+            if task.report or task.sweep is None:
+                print("No sweep for this task, skipping.")
+                continue
+            try:
+                os.chdir(task.path)
+            except:
+                error("Could not enter directory {}".format(task.path))
+            task.ensure_built()
+            rows = run_sweep(in_dir(task.sweep, task.bindir))
+            output = default.SWEEP_BASELINE if save else default.SWEEP_OUTPUT
+            with open(output, 'w') as f:
+                json.dump(rows, f, indent=1)
+            baseline = []
+            if not save and os.path.exists(default.SWEEP_BASELINE):
+                with open(default.SWEEP_BASELINE) as f:
+                    baseline = json.load(f)
+            regressions = print_sweep(rows, baseline)
+            print()
+            print("Results written to {}".format(output))
+            if not save and not baseline:
+                print("No baseline to compare with; create one with 'grading sweep-save'")
+            if regressions:
+                error("{} of {} points are more than {:.0f}% slower than in {}".format(
+                    len(regressions), len(rows), 100 * default.SWEEP_TOLERANCE, default.SWEEP_BASELINE))
+
     def test(self, tasks):
         for taskid in tasks:
             task = self.task_map[taskid]
@@ -680,6 +1011,11 @@ class Grading:
             print(col.good + "Tests passed" + col.reset)
 
     def ui(self):
+        if timing.GRADE_ON not in timing.GRADE_CHOICES:
+            error("PPC_GRADE_ON should be one of: {}".format(", ".join(timing.GRADE_CHOICES)))
+        if timing.WARMUP < 0 or timing.REPEAT < 1:
+            error("PPC_WARMUP should be at least 0 and PPC_REPEAT at least 1")
+        cache_size_limit()
         args = sys.argv[1:]
         if len(args) == 0:
             self.help()
@@ -722,6 +1058,10 @@ class Grading:
         #     self.export_score(tasks)
         elif cmd == 'test':
             self.test(tasks)
+        elif cmd == 'sweep':
+            self.sweep(tasks)
+        elif cmd == 'sweep-save':
+            self.sweep(tasks, save=True)
         else:
             error("Unknown command: {}".format(cmd))
 
@@ -736,6 +1076,24 @@ Usage: grading COMMAND [TASK ...]
     grading dryrun    - Do grading but do not record the result
     grading benchmark - Run benchmark without re-compiling
     grading test      - Run tests without re-compiling
+    grading sweep     - Run the scaling benchmark sweep without re-compiling
+                        and compare it with {sweep_baseline}
+    grading sweep-save
+                      - Run the sweep and save it as {sweep_baseline}
+
+Environment:
+
+    PPC_WARMUP=n      - Untimed benchmark runs before the timed ones (default 0)
+    PPC_REPEAT=n      - Timed benchmark runs (default 1)
+    PPC_GRADE_ON=stat - Time to grade on: last, min or median (default last)
+    PPC_PERF=1        - Also record hardware performance counters, added up
+                        over the OpenMP threads
+    PPC_BANDWIDTH_CACHE=dir
+                      - Where the measured peak memory bandwidth of each host
+                        is kept (default ~/.cache/ppc)
+    PPC_BUILD_CACHE_MB=n
+                      - Size limit of the build cache in {cache} in MiB,
+                        0 disables it (default {cache_mb})
 
 Status:
 
@@ -753,6 +1111,9 @@ Cheatsheet: {url}workflow/cheatsheet/
             system=self.system,
             valid_host='valid' if self.valid_host else 'not valid',
             root=self.root,
+            cache=default.BUILD_CACHE,
+            cache_mb=default.BUILD_CACHE_MB,
+            sweep_baseline=default.SWEEP_BASELINE,
             week=self.week_label,
             l1=loads[0],
             l5=loads[1],
@@ -10,31 +10,242 @@
 #include <sys/stat.h>
 
 #include <chrono>
+#include <cstdint>
+#include <cstring>
+#include <string>
+#include <utility>
 #include <vector>
 
+#include <algorithm>
+#include <cerrno>
+#include <linux/perf_event.h>
+#include <sys/ioctl.h>
+#include <sys/syscall.h>
+#include <unistd.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 namespace ppc
 {
 
+using counter_values = std::vector<std::pair<std::string, std::uint64_t>>;
+
+// Hardware performance counters around the timed region, enabled with
+// PPC_PERF=1. Counters that cannot be opened (for example because of
+// kernel.perf_event_paranoid) are left out, and if none can be opened the
+// timer just measures time. A group of counters is opened on each thread of
+// an OpenMP team of PPC_THREADS threads (by default the OpenMP maximum),
+// which later parallel regions reuse, and the counts of all groups are
+// added up; counted-threads is the number of threads that were counted.
+class perf_counters {
+public:
+    static perf_counters& instance() {
+        static perf_counters counters;
+        return counters;
+    }
+
+    ~perf_counters() {
+        for (const auto& fds : m_groups) {
+            for (int fd : fds) {
+                close(fd);
+            }
+        }
+    }
+
+    void start() {
+        for (const auto& fds : m_groups) {
+            ioctl(fds[0], PERF_EVENT_IOC_RESET, PERF_IOC_FLAG_GROUP);
+            ioctl(fds[0], PERF_EVENT_IOC_ENABLE, PERF_IOC_FLAG_GROUP);
+        }
+    }
+
+    counter_values stop() {
+        counter_values values;
+        if (m_groups.empty()) {
+            return values;
+        }
+        for (const auto& fds : m_groups) {
+            ioctl(fds[0], PERF_EVENT_IOC_DISABLE, PERF_IOC_FLAG_GROUP);
+        }
+        std::vector<std::uint64_t> totals(m_names.size(), 0);
+        for (const auto& fds : m_groups) {
+            // Layout for PERF_FORMAT_GROUP with both time fields
+            std::vector<std::uint64_t> buf(3 + fds.size());
+            const ssize_t size = buf.size() * sizeof(std::uint64_t);
+            if (read(fds[0], buf.data(), size) != size) {
+                return values;
+            }
+            const std::uint64_t enabled = buf[1];
+            const std::uint64_t running = buf[2];
+            for (std::size_t i = 0; i < fds.size(); ++i) {
+                std::uint64_t value = buf[3 + i];
+                // Scale up if the counters had to be multiplexed
+                if (running > 0 && running < enabled) {
+                    value = std::uint64_t(double(value) * enabled / running);
+                }
+                totals[i] += value;
+            }
+        }
+        for (std::size_t i = 0; i < m_names.size(); ++i) {
+            values.emplace_back(m_names[i], totals[i]);
+        }
+        values.emplace_back("counted-threads", m_groups.size());
+        return values;
+    }
+
+private:
+    struct event {
+        const char* name;
+        std::uint32_t type;
+        std::uint64_t config;
+    };
+
+    perf_counters() {
+        if (std::getenv("PPC_PERF") == nullptr) {
+            return;
+        }
+        const std::uint64_t read_miss = PERF_COUNT_HW_CACHE_OP_READ << 8 |
+                                        PERF_COUNT_HW_CACHE_RESULT_MISS << 16;
+        const std::vector<event> events = {
+            {"cycles", PERF_TYPE_HARDWARE, PERF_COUNT_HW_CPU_CYCLES},
+            {"instructions", PERF_TYPE_HARDWARE, PERF_COUNT_HW_INSTRUCTIONS},
+            {"branch-misses", PERF_TYPE_HARDWARE, PERF_COUNT_HW_BRANCH_MISSES},
+            {"l1d-misses", PERF_TYPE_HW_CACHE,
+             PERF_COUNT_HW_CACHE_L1D | read_miss},
+            {"llc-misses", PERF_TYPE_HW_CACHE,
+             PERF_COUNT_HW_CACHE_LL | read_miss},
+        };
+        // The events that can be opened on this thread are counted on all
+        // of them; a thread where one of those fails is left out.
+        std::vector<int> fds = open_group(events, true);
+        if (fds.empty()) {
+            std::cerr << "PPC_PERF: performance counters are not available ("
+                      << m_error << "), measuring time only" << std::endl;
+            return;
+        }
+        close_group(fds);
+        std::vector<event> available;
+        for (const event& e : events) {
+            for (const std::string& name : m_names) {
+                if (name == e.name) {
+                    available.push_back(e);
+                }
+            }
+        }
+        std::vector<std::vector<int>> groups(team_size());
+        #pragma omp parallel num_threads(groups.size())
+        {
+#ifdef _OPENMP
+            const int thread = omp_get_thread_num();
+#else
+            const int thread = 0;
+#endif
+            groups[thread] = open_group(available, false);
+        }
+        for (auto& group : groups) {
+            if (group.size() == available.size()) {
+                m_groups.push_back(std::move(group));
+            } else {
+                close_group(group);
+            }
+        }
+    }
+
+    static int team_size() {
+        if (const char* threads = std::getenv("PPC_THREADS")) {
+            return std::max(std::atoi(threads), 1);
+        }
+#ifdef _OPENMP
+        return omp_get_max_threads();
+#else
+        return 1;
+#endif
+    }
+
+    // Open the events that can be opened as a group on the calling thread,
+    // recording their names if record is set. With record, an event that
+    // cannot be opened is skipped; otherwise the group stops there.
+    std::vector<int> open_group(const std::vector<event>& events, bool record) {
+        std::vector<int> fds;
+        for (const event& e : events) {
+            perf_event_attr attr;
+            std::memset(&attr, 0, sizeof(attr));
+            attr.size = sizeof(attr);
+            attr.type = e.type;
+            attr.config = e.config;
+            attr.disabled = fds.empty();
+            attr.exclude_kernel = 1;
+            attr.exclude_hv = 1;
+            attr.read_format = PERF_FORMAT_GROUP |
+                               PERF_FORMAT_TOTAL_TIME_ENABLED |
+                               PERF_FORMAT_TOTAL_TIME_RUNNING;
+            const int group = fds.empty() ? -1 : fds[0];
+            const int fd = syscall(SYS_perf_event_open, &attr, 0, -1, group, 0);
+            if (fd < 0) {
+                if (!record) {
+                    break;
+                }
+                m_error = std::strerror(errno);
+                continue;
+            }
+            fds.push_back(fd);
+            if (record) {
+                m_names.push_back(e.name);
+            }
+        }
+        return fds;
+    }
+
+    static void close_group(const std::vector<int>& fds) {
+        for (int fd : fds) {
+            close(fd);
+        }
+    }
+
+    std::vector<std::vector<int>> m_groups;
+    std::vector<std::string> m_names;
+    std::string m_error;
+};
+
 class benchmark_output {
 public:
 
+    // The first PPC_WARMUP times are warmup runs and are not written out
+    benchmark_output() {
+        const char *warmup = std::getenv("PPC_WARMUP");
+        m_skip = warmup != nullptr ? std::atoi(warmup) : 0;
+    }
+
+    // One line per run: the time, then any counters as name=value
     ~benchmark_output() {
         if (m_times.size() > 0) {
             std::ofstream outfile("benchmark.run");
-            for (auto time : m_times) {
-                outfile << time << '\n';
+            for (std::size_t i = 0; i < m_times.size(); ++i) {
+                outfile << m_times[i];
+                for (const auto& counter : m_counters[i]) {
+                    outfile << '\t' << counter.first << '=' << counter.second;
+                }
+                outfile << '\n';
             }
         }
     }
 
-    benchmark_output& operator<<(double time) {
-        m_times.push_back(time);
-        return *this;
+    void add(double time, const counter_values& counters) {
+        if (m_skip > 0) {
+            m_skip--;
+        } else {
+            m_times.push_back(time);
+            m_counters.push_back(counters);
+        }
     }
 
 
 private:
     std::vector<double> m_times;
+    std::vector<counter_values> m_counters;
+    int m_skip;
 };
 
 static benchmark_output result_output;
@@ -43,26 +254,36 @@ class timer {
 public:
     using time_point = decltype(std::chrono::high_resolution_clock::now());
 
-    timer()
+    // The elapsed time is also stored in *seconds if it is given
+    explicit timer(double* seconds = nullptr) : m_seconds(seconds)
     {
         write_out = std::getenv("PPC_BENCHMARK") != nullptr;
+        perf_counters::instance().start();
         start = std::chrono::high_resolution_clock::now();
     }
 
     ~timer() {
         const auto end = std::chrono::high_resolution_clock::now();
+        const counter_values counters = perf_counters::instance().stop();
         const double seconds = (end-start).count() / double(1E9);
         if (write_out) {
-            result_output << seconds;
+            result_output.add(seconds, counters);
+        }
+        if (m_seconds != nullptr) {
+            *m_seconds = seconds;
         }
-        print_formatted(seconds);
+        print_formatted(seconds, counters);
     }
 
 private:
-    void print_formatted(double sec) {
+    void print_formatted(double sec, const counter_values& counters) {
         std::ios_base::fmtflags oldf = std::cout.flags(std::ios::right | std::ios::fixed);
         std::streamsize oldp = std::cout.precision(3);
-        std::cout << sec << '\t' << std::flush;
+        std::cout << sec << '\t';
+        for (const auto& counter : counters) {
+            std::cout << counter.first << '=' << counter.second << '\t';
+        }
+        std::cout << std::flush;
         std::cout.flags(oldf);
         std::cout.precision(oldp);
         std::cout.copyfmt(std::ios(NULL));
@@ -70,6 +291,7 @@ private:
 
     bool write_out;
     time_point start;
+    double* m_seconds;
 };
 
 }
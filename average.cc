@@ -1,28 +1,1025 @@
-
 #include "average.h"
 
+#include <algorithm>
+#include <cmath>
+#include <limits>
+#include <cstddef>
+#include <cstdlib>
+#include <cstring>
+#include <stdexcept>
+
+#include <immintrin.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// Rows are summed in blocks of this many rows, each into its own partial
+// sums, and the partial sums are added up in block order afterwards.
+static constexpr int ROW_BLOCK = 16;
+
+// Rectangles smaller than this many pixels are not worth waking up threads.
+static constexpr double PARALLEL_MIN_AREA = 1 << 16;
+
+// The blocked kernels add this many values per float accumulator before
+// promoting to double. A tile sum of values in [0, 1] stays below 4, so its
+// rounding error is at most 3 * 2^-22 / 4 < 2e-7 per pixel, well inside the
+// 1e-6 test threshold even when the error is the same in every tile.
+static constexpr int TILE = 4;
+
+static void sum_naive(int nx, const float *data, int y0, int x0, int y1,
+                      int x1, double sum[3]) {
+  for (int c = 0; c < 3; c++) {
+    for (int x = x0; x < x1; x++) {
+      for (int y = y0; y < y1; y++) {
+        sum[c] += data[c + 3 * x + std::size_t(3) * nx * y];
+      }
+    }
+  }
+}
+
+static void sum_streaming(int nx, const float *data, int y0, int x0, int y1,
+                          int x1, double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + std::size_t(3) * nx * y + 3 * x0;
+    double row_sum[3] = {0.0, 0.0, 0.0};
+    for (int i = 0; i < n; i += 3) {
+      row_sum[0] += row[i + 0];
+      row_sum[1] += row[i + 1];
+      row_sum[2] += row[i + 2];
+    }
+    sum[0] += row_sum[0];
+    sum[1] += row_sum[1];
+    sum[2] += row_sum[2];
+  }
+}
+
+// The vector kernels walk each row in chunks of 16 or 8 pixels, widening the
+// floats straight into six double accumulators. A chunk always starts at
+// channel 0, so lane i of the j:th accumulator holds channel
+// (j * lanes + i) % 3. The channels are separated only when
+// the accumulators are reduced at the end.
+
+__attribute__((target("avx512f"))) static void
+sum_avx512(int nx, const float *data, int y0, int x0, int y1, int x1,
+           double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  __m512d acc[6];
+  for (int j = 0; j < 6; j++) {
+    acc[j] = _mm512_setzero_pd();
+  }
+  double tail[3] = {0.0, 0.0, 0.0};
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + std::size_t(3) * nx * y + 3 * x0;
+    int i = 0;
+    for (; i + 48 <= n; i += 48) {
+      for (int j = 0; j < 6; j++) {
+        const __m256 v = _mm256_loadu_ps(row + i + 8 * j);
+        // The maskz forms are used throughout because the plain intrinsics
+        // pass an undefined operand that trips -Wmaybe-uninitialized in
+        // GCC 12.
+        acc[j] = _mm512_add_pd(acc[j], _mm512_maskz_cvtps_pd(0xff, v));
+      }
+    }
+    for (; i < n; i += 3) {
+      tail[0] += row[i + 0];
+      tail[1] += row[i + 1];
+      tail[2] += row[i + 2];
+    }
+  }
+  alignas(64) double lanes[48];
+  for (int j = 0; j < 6; j++) {
+    _mm512_store_pd(lanes + 8 * j, acc[j]);
+  }
+  for (int i = 0; i < 48; i++) {
+    sum[i % 3] += lanes[i];
+  }
+  sum[0] += tail[0];
+  sum[1] += tail[1];
+  sum[2] += tail[2];
+}
+
+__attribute__((target("avx2"))) static void
+sum_avx2(int nx, const float *data, int y0, int x0, int y1, int x1,
+         double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  __m256d acc[6];
+  for (int j = 0; j < 6; j++) {
+    acc[j] = _mm256_setzero_pd();
+  }
+  double tail[3] = {0.0, 0.0, 0.0};
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + std::size_t(3) * nx * y + 3 * x0;
+    int i = 0;
+    for (; i + 24 <= n; i += 24) {
+      for (int j = 0; j < 6; j++) {
+        const __m128 v = _mm_loadu_ps(row + i + 4 * j);
+        acc[j] = _mm256_add_pd(acc[j], _mm256_cvtps_pd(v));
+      }
+    }
+    for (; i < n; i += 3) {
+      tail[0] += row[i + 0];
+      tail[1] += row[i + 1];
+      tail[2] += row[i + 2];
+    }
+  }
+  alignas(32) double lanes[24];
+  for (int j = 0; j < 6; j++) {
+    _mm256_store_pd(lanes + 4 * j, acc[j]);
+  }
+  for (int i = 0; i < 24; i++) {
+    sum[i % 3] += lanes[i];
+  }
+  sum[0] += tail[0];
+  sum[1] += tail[1];
+  sum[2] += tail[2];
+}
+
+static void sum_blocked_scalar(int nx, const float *data, int y0, int x0,
+                               int y1, int x1, double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + std::size_t(3) * nx * y + 3 * x0;
+    for (int i = 0; i < n; i += 3 * TILE) {
+      const int end = std::min(n, i + 3 * TILE);
+      float tile[3] = {0.0f, 0.0f, 0.0f};
+      for (int k = i; k < end; k += 3) {
+        tile[0] += row[k + 0];
+        tile[1] += row[k + 1];
+        tile[2] += row[k + 2];
+      }
+      sum[0] += tile[0];
+      sum[1] += tile[1];
+      sum[2] += tile[2];
+    }
+  }
+}
+
+__attribute__((target("avx512f"))) static void
+sum_blocked_avx512(int nx, const float *data, int y0, int x0, int y1, int x1,
+                   double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  __m512d acc[6];
+  for (int j = 0; j < 6; j++) {
+    acc[j] = _mm512_setzero_pd();
+  }
+  double tail[3] = {0.0, 0.0, 0.0};
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + std::size_t(3) * nx * y + 3 * x0;
+    int i = 0;
+    while (i + 48 <= n) {
+      __m512 tile[3];
+      for (int k = 0; k < 3; k++) {
+        tile[k] = _mm512_setzero_ps();
+      }
+      for (int t = 0; t < TILE && i + 48 <= n; t++, i += 48) {
+        for (int k = 0; k < 3; k++) {
+          tile[k] = _mm512_add_ps(tile[k], _mm512_loadu_ps(row + i + 16 * k));
+        }
+      }
+      for (int k = 0; k < 3; k++) {
+        const __m512d bits = _mm512_castps_pd(tile[k]);
+        const __m256 lo =
+            _mm256_castpd_ps(_mm512_maskz_extractf64x4_pd(0xff, bits, 0));
+        const __m256 hi =
+            _mm256_castpd_ps(_mm512_maskz_extractf64x4_pd(0xff, bits, 1));
+        acc[2 * k] = _mm512_add_pd(acc[2 * k], _mm512_maskz_cvtps_pd(0xff, lo));
+        acc[2 * k + 1] =
+            _mm512_add_pd(acc[2 * k + 1], _mm512_maskz_cvtps_pd(0xff, hi));
+      }
+    }
+    for (; i < n; i += 3) {
+      tail[0] += row[i + 0];
+      tail[1] += row[i + 1];
+      tail[2] += row[i + 2];
+    }
+  }
+  alignas(64) double lanes[48];
+  for (int j = 0; j < 6; j++) {
+    _mm512_store_pd(lanes + 8 * j, acc[j]);
+  }
+  for (int i = 0; i < 48; i++) {
+    sum[i % 3] += lanes[i];
+  }
+  sum[0] += tail[0];
+  sum[1] += tail[1];
+  sum[2] += tail[2];
+}
+
+__attribute__((target("avx2"))) static void
+sum_blocked_avx2(int nx, const float *data, int y0, int x0, int y1, int x1,
+                 double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  __m256d acc[6];
+  for (int j = 0; j < 6; j++) {
+    acc[j] = _mm256_setzero_pd();
+  }
+  double tail[3] = {0.0, 0.0, 0.0};
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + std::size_t(3) * nx * y + 3 * x0;
+    int i = 0;
+    while (i + 24 <= n) {
+      __m256 tile[3];
+      for (int k = 0; k < 3; k++) {
+        tile[k] = _mm256_setzero_ps();
+      }
+      for (int t = 0; t < TILE && i + 24 <= n; t++, i += 24) {
+        for (int k = 0; k < 3; k++) {
+          tile[k] = _mm256_add_ps(tile[k], _mm256_loadu_ps(row + i + 8 * k));
+        }
+      }
+      for (int k = 0; k < 3; k++) {
+        const __m128 lo = _mm256_castps256_ps128(tile[k]);
+        const __m128 hi = _mm256_extractf128_ps(tile[k], 1);
+        acc[2 * k] = _mm256_add_pd(acc[2 * k], _mm256_cvtps_pd(lo));
+        acc[2 * k + 1] = _mm256_add_pd(acc[2 * k + 1], _mm256_cvtps_pd(hi));
+      }
+    }
+    for (; i < n; i += 3) {
+      tail[0] += row[i + 0];
+      tail[1] += row[i + 1];
+      tail[2] += row[i + 2];
+    }
+  }
+  alignas(32) double lanes[24];
+  for (int j = 0; j < 6; j++) {
+    _mm256_store_pd(lanes + 4 * j, acc[j]);
+  }
+  for (int i = 0; i < 24; i++) {
+    sum[i % 3] += lanes[i];
+  }
+  sum[0] += tail[0];
+  sum[1] += tail[1];
+  sum[2] += tail[2];
+}
+
+// 8-bit pixels are summed exactly in 64-bit integers.
+
+static void sum_u8_scalar(int nx, const std::uint8_t *data, int y0, int x0,
+                          int y1, int x1, std::uint64_t sum[3]) {
+  const int n = 3 * (x1 - x0);
+  for (int y = y0; y < y1; y++) {
+    const std::uint8_t *row = data + std::size_t(3) * nx * y + 3 * x0;
+    std::uint64_t row_sum[3] = {0, 0, 0};
+    for (int i = 0; i < n; i += 3) {
+      row_sum[0] += row[i + 0];
+      row_sum[1] += row[i + 1];
+      row_sum[2] += row[i + 2];
+    }
+    sum[0] += row_sum[0];
+    sum[1] += row_sum[1];
+    sum[2] += row_sum[2];
+  }
+}
+
+// vpsadbw against zero adds up each group of 8 bytes into a 64-bit lane.
+// Keeping only the bytes of one channel before it separates the channels:
+// a row is walked in chunks of 96 bytes, three vectors, and channel c sits
+// at the bytes k of vector v with k % 3 == (c + v) % 3.
+__attribute__((target("avx2"))) static void
+sum_u8_avx2(int nx, const std::uint8_t *data, int y0, int x0, int y1, int x1,
+            std::uint64_t sum[3]) {
+  const int n = 3 * (x1 - x0);
+  alignas(32) std::uint8_t mask_bytes[3][32];
+  for (int c = 0; c < 3; c++) {
+    for (int k = 0; k < 32; k++) {
+      mask_bytes[c][k] = k % 3 == c ? 0xff : 0;
+    }
+  }
+  __m256i mask[3];
+  __m256i acc[3];
+  for (int c = 0; c < 3; c++) {
+    mask[c] =
+        _mm256_load_si256(reinterpret_cast<const __m256i *>(mask_bytes[c]));
+    acc[c] = _mm256_setzero_si256();
+  }
+  const __m256i zero = _mm256_setzero_si256();
+  std::uint64_t tail[3] = {0, 0, 0};
+  for (int y = y0; y < y1; y++) {
+    const std::uint8_t *row = data + std::size_t(3) * nx * y + 3 * x0;
+    int i = 0;
+    for (; i + 96 <= n; i += 96) {
+      for (int v = 0; v < 3; v++) {
+        const __m256i bytes = _mm256_loadu_si256(
+            reinterpret_cast<const __m256i *>(row + i + 32 * v));
+        for (int c = 0; c < 3; c++) {
+          const __m256i masked = _mm256_and_si256(bytes, mask[(c + v) % 3]);
+          acc[c] = _mm256_add_epi64(acc[c], _mm256_sad_epu8(masked, zero));
+        }
+      }
+    }
+    for (; i < n; i += 3) {
+      tail[0] += row[i + 0];
+      tail[1] += row[i + 1];
+      tail[2] += row[i + 2];
+    }
+  }
+  for (int c = 0; c < 3; c++) {
+    alignas(32) std::uint64_t lanes[4];
+    _mm256_store_si256(reinterpret_cast<__m256i *>(lanes), acc[c]);
+    sum[c] += lanes[0] + lanes[1] + lanes[2] + lanes[3] + tail[c];
+  }
+}
+
+static void sum_half_scalar(int nx, const std::uint16_t *data, int y0, int x0,
+                            int y1, int x1, double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  for (int y = y0; y < y1; y++) {
+    const std::uint16_t *row = data + std::size_t(3) * nx * y + 3 * x0;
+    double row_sum[3] = {0.0, 0.0, 0.0};
+    for (int i = 0; i < n; i += 3) {
+      row_sum[0] += half_to_float(row[i + 0]);
+      row_sum[1] += half_to_float(row[i + 1]);
+      row_sum[2] += half_to_float(row[i + 2]);
+    }
+    sum[0] += row_sum[0];
+    sum[1] += row_sum[1];
+    sum[2] += row_sum[2];
+  }
+}
+
+// Like sum_avx2, with vcvtph2ps widening 8 halves at a time to floats.
+__attribute__((target("avx2,f16c"))) static void
+sum_half_avx2(int nx, const std::uint16_t *data, int y0, int x0, int y1,
+              int x1, double sum[3]) {
+  const int n = 3 * (x1 - x0);
+  __m256d acc[6];
+  for (int j = 0; j < 6; j++) {
+    acc[j] = _mm256_setzero_pd();
+  }
+  double tail[3] = {0.0, 0.0, 0.0};
+  for (int y = y0; y < y1; y++) {
+    const std::uint16_t *row = data + std::size_t(3) * nx * y + 3 * x0;
+    int i = 0;
+    for (; i + 24 <= n; i += 24) {
+      for (int k = 0; k < 3; k++) {
+        const __m256 v = _mm256_cvtph_ps(_mm_loadu_si128(
+            reinterpret_cast<const __m128i *>(row + i + 8 * k)));
+        const __m128 lo = _mm256_castps256_ps128(v);
+        const __m128 hi = _mm256_extractf128_ps(v, 1);
+        acc[2 * k] = _mm256_add_pd(acc[2 * k], _mm256_cvtps_pd(lo));
+        acc[2 * k + 1] = _mm256_add_pd(acc[2 * k + 1], _mm256_cvtps_pd(hi));
+      }
+    }
+    for (; i < n; i += 3) {
+      tail[0] += half_to_float(row[i + 0]);
+      tail[1] += half_to_float(row[i + 1]);
+      tail[2] += half_to_float(row[i + 2]);
+    }
+  }
+  alignas(32) double lanes[24];
+  for (int j = 0; j < 6; j++) {
+    _mm256_store_pd(lanes + 4 * j, acc[j]);
+  }
+  for (int i = 0; i < 24; i++) {
+    sum[i % 3] += lanes[i];
+  }
+  sum[0] += tail[0];
+  sum[1] += tail[1];
+  sum[2] += tail[2];
+}
+
+// Planar kernels sum the rectangle of a single channel, whose rows start
+// pitch values apart.
+
+static void sum_plane_scalar(std::ptrdiff_t pitch, const float *data, int y0,
+                             int x0, int y1, int x1, double *sum) {
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + pitch * y;
+    double row_sum = 0.0;
+    for (int x = x0; x < x1; x++) {
+      row_sum += row[x];
+    }
+    *sum += row_sum;
+  }
+}
+
+__attribute__((target("avx512f"))) static void
+sum_plane_avx512(std::ptrdiff_t pitch, const float *data, int y0, int x0,
+                 int y1, int x1, double *sum) {
+  __m512d acc[4];
+  for (int j = 0; j < 4; j++) {
+    acc[j] = _mm512_setzero_pd();
+  }
+  double tail = 0.0;
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + pitch * y;
+    int x = x0;
+    for (; x + 32 <= x1; x += 32) {
+      for (int j = 0; j < 4; j++) {
+        const __m256 v = _mm256_loadu_ps(row + x + 8 * j);
+        acc[j] = _mm512_add_pd(acc[j], _mm512_maskz_cvtps_pd(0xff, v));
+      }
+    }
+    for (; x < x1; x++) {
+      tail += row[x];
+    }
+  }
+  alignas(64) double lanes[32];
+  for (int j = 0; j < 4; j++) {
+    _mm512_store_pd(lanes + 8 * j, acc[j]);
+  }
+  for (int i = 0; i < 32; i++) {
+    *sum += lanes[i];
+  }
+  *sum += tail;
+}
+
+__attribute__((target("avx2"))) static void
+sum_plane_avx2(std::ptrdiff_t pitch, const float *data, int y0, int x0,
+               int y1, int x1, double *sum) {
+  __m256d acc[4];
+  for (int j = 0; j < 4; j++) {
+    acc[j] = _mm256_setzero_pd();
+  }
+  double tail = 0.0;
+  for (int y = y0; y < y1; y++) {
+    const float *row = data + pitch * y;
+    int x = x0;
+    for (; x + 16 <= x1; x += 16) {
+      for (int j = 0; j < 4; j++) {
+        const __m128 v = _mm_loadu_ps(row + x + 4 * j);
+        acc[j] = _mm256_add_pd(acc[j], _mm256_cvtps_pd(v));
+      }
+    }
+    for (; x < x1; x++) {
+      tail += row[x];
+    }
+  }
+  alignas(32) double lanes[16];
+  for (int j = 0; j < 4; j++) {
+    _mm256_store_pd(lanes + 4 * j, acc[j]);
+  }
+  for (int i = 0; i < 16; i++) {
+    *sum += lanes[i];
+  }
+  *sum += tail;
+}
+
+using SumFunction = void (*)(int nx, const float *data, int y0, int x0,
+                             int y1, int x1, double sum[3]);
+using SumU8Function = void (*)(int nx, const std::uint8_t *data, int y0,
+                               int x0, int y1, int x1, std::uint64_t sum[3]);
+using SumHalfFunction = void (*)(int nx, const std::uint16_t *data, int y0,
+                                 int x0, int y1, int x1, double sum[3]);
+using SumPlaneFunction = void (*)(std::ptrdiff_t pitch, const float *data,
+                                  int y0, int x0, int y1, int x1, double *sum);
+
+struct SimdTarget {
+  const char *name;
+  SumFunction sum;
+  SumFunction blocked;
+  SumU8Function sum_u8;
+  SumHalfFunction sum_half;
+  SumPlaneFunction sum_plane;
+};
+
+// The targets this machine supports, best first.
+static const std::vector<SimdTarget> &supported_targets() {
+  static const std::vector<SimdTarget> targets = [] {
+    __builtin_cpu_init();
+    const SumHalfFunction sum_half =
+        __builtin_cpu_supports("avx2") && __builtin_cpu_supports("f16c")
+            ? sum_half_avx2
+            : sum_half_scalar;
+    std::vector<SimdTarget> list;
+    if (__builtin_cpu_supports("avx512f")) {
+      list.push_back({"avx512", sum_avx512, sum_blocked_avx512, sum_u8_avx2,
+                      sum_half, sum_plane_avx512});
+    }
+    if (__builtin_cpu_supports("avx2")) {
+      list.push_back({"avx2", sum_avx2, sum_blocked_avx2, sum_u8_avx2,
+                      sum_half, sum_plane_avx2});
+    }
+    list.push_back({"scalar", sum_streaming, sum_blocked_scalar,
+                    sum_u8_scalar, sum_half_scalar, sum_plane_scalar});
+    return list;
+  }();
+  return targets;
+}
+
+static const SimdTarget *find_target(const std::string &name) {
+  for (const SimdTarget &target : supported_targets()) {
+    if (name == target.name) {
+      return &target;
+    }
+  }
+  return nullptr;
+}
+
+static thread_local const SimdTarget *target_override = nullptr;
+
+// The target of the calling thread. Kernels look it up before they start
+// their threads, which use the same one.
+static const SimdTarget &simd() {
+  static const SimdTarget &target = []() -> const SimdTarget & {
+    const char *name = std::getenv("PPC_SIMD");
+    if (name == nullptr) {
+      return supported_targets().front();
+    }
+    const SimdTarget *found = find_target(name);
+    if (found == nullptr) {
+      throw std::invalid_argument(
+          std::string("PPC_SIMD is not supported on this machine: ") + name);
+    }
+    return *found;
+  }();
+  return target_override != nullptr ? *target_override : target;
+}
+
+const char *simd_target() { return simd().name; }
+
+std::vector<std::string> simd_targets() {
+  std::vector<std::string> names;
+  for (const SimdTarget &target : supported_targets()) {
+    names.push_back(target.name);
+  }
+  return names;
+}
+
+void set_simd_target(const std::string &name) {
+  if (name.empty()) {
+    target_override = nullptr;
+    return;
+  }
+  const SimdTarget *found = find_target(name);
+  if (found == nullptr) {
+    throw std::invalid_argument("simd target is not supported: " + name);
+  }
+  target_override = found;
+}
+
+const char *kernel_name(Kernel kernel) {
+  switch (kernel) {
+  case Kernel::naive:
+    return "naive";
+  case Kernel::streaming:
+    return "streaming";
+  case Kernel::simd:
+    return "simd";
+  case Kernel::blocked:
+    return "blocked";
+  }
+  return "unknown";
+}
+
+bool parse_kernel(const std::string &name, Kernel &kernel) {
+  for (Kernel k : KERNELS) {
+    if (name == kernel_name(k)) {
+      kernel = k;
+      return true;
+    }
+  }
+  return false;
+}
+
+Kernel default_kernel() {
+  static const Kernel kernel = [] {
+    Kernel k = Kernel::simd;
+    const char *name = std::getenv("PPC_KERNEL");
+    if (name != nullptr && !parse_kernel(name, k)) {
+      throw std::invalid_argument(std::string("unknown PPC_KERNEL: ") + name);
+    }
+    return k;
+  }();
+  return kernel;
+}
+
 Result calculate(int ny, int nx, const float *data, int y0, int x0, int y1,
-                 int x1)
- {
-	int area=(x1-x0)*(y1-y0);
-	double value[3]={0,0,0};
-	for (int c=0;c<3;c++)
-		{
-		for (int x=x0;x<x1;x++)
-		       	{
-			for (int y=y0;y<y1;y++)
- 				{ 
-					value[c]=value[c]+data[c+3*x+3*nx*y];
-                        	  }
-		         }
- 		 value[c]=value[c]/area;
-	 }
-//Result result{{1.0f, 0.0f, 1.0f}};
-Result result {{ float(value[0]),float(value[1]),float (value[2])}};
-result.avg[0]= value[0];
-result.avg[1]=value[1];
-result.avg[2]=value[2];
- return result;
+                 int x1) {
+  return calculate(default_kernel(), ny, nx, data, y0, x0, y1, x1);
+}
+
+static thread_local int thread_limit = 0;
+
+void set_thread_limit(int n) { thread_limit = n; }
+
+int thread_count() {
+  static const int threads = [] {
+    const char *value = std::getenv("PPC_THREADS");
+    if (value != nullptr) {
+      const int n = std::atoi(value);
+      if (n < 1) {
+        throw std::invalid_argument(std::string("invalid PPC_THREADS: ") +
+                                    value);
+      }
+      return n;
+    }
+#ifdef _OPENMP
+    return omp_get_max_threads();
+#else
+    return 1;
+#endif
+  }();
+  return thread_limit > 0 ? std::min(threads, thread_limit) : threads;
+}
+
+static void sum_rows(Kernel kernel, const SimdTarget &target, int nx,
+                     const float *data, int y0, int x0, int y1, int x1,
+                     double sum[3]) {
+  switch (kernel) {
+  case Kernel::naive:
+    sum_naive(nx, data, y0, x0, y1, x1, sum);
+    break;
+  case Kernel::streaming:
+    sum_streaming(nx, data, y0, x0, y1, x1, sum);
+    break;
+  case Kernel::simd:
+    target.sum(nx, data, y0, x0, y1, x1, sum);
+    break;
+  case Kernel::blocked:
+    target.blocked(nx, data, y0, x0, y1, x1, sum);
+    break;
+  }
+}
+
+// Number of threads that sum a rectangle of the given area.
+static int block_threads(double area) {
+  return area < PARALLEL_MIN_AREA ? 1 : thread_count();
+}
+
+// Sum the rectangle in blocks of ROW_BLOCK rows with sum_rows, in parallel,
+// and add up the partial sums of the blocks in order.
+template <typename Pixel, typename Sum, typename SumRows>
+static void sum_blocks(const SumRows &sum_rows, int nx, const Pixel *data,
+                       int y0, int x0, int y1, int x1, Sum sums[3]) {
+  const double area = double(y1 - y0) * double(x1 - x0);
+  const int blocks = (y1 - y0 + ROW_BLOCK - 1) / ROW_BLOCK;
+  const int threads = block_threads(area);
+  std::vector<Sum> partial(3 * blocks, Sum(0));
+#pragma omp parallel for schedule(static) num_threads(threads) if (threads > 1)
+  for (int b = 0; b < blocks; b++) {
+    const int by0 = y0 + b * ROW_BLOCK;
+    const int by1 = std::min(by0 + ROW_BLOCK, y1);
+    sum_rows(nx, data, by0, x0, by1, x1, &partial[3 * b]);
+  }
+  sums[0] = sums[1] = sums[2] = Sum(0);
+  for (int b = 0; b < blocks; b++) {
+    sums[0] += partial[3 * b + 0];
+    sums[1] += partial[3 * b + 1];
+    sums[2] += partial[3 * b + 2];
+  }
+}
+
+void for_each_row_block(int nx, int y0, int y1,
+                        const std::function<void(int y0, int y1)> &f) {
+  const int blocks = (y1 - y0 + ROW_BLOCK - 1) / ROW_BLOCK;
+  const int threads = block_threads(double(y1 - y0) * double(nx));
+#pragma omp parallel for schedule(static) num_threads(threads) if (threads > 1)
+  for (int b = 0; b < blocks; b++) {
+    const int by0 = y0 + b * ROW_BLOCK;
+    f(by0, std::min(by0 + ROW_BLOCK, y1));
+  }
+}
+
+void calculate_sums(Kernel kernel, int nx, const float *data, int y0, int x0,
+                    int y1, int x1, double sums[3]) {
+  const SimdTarget &target = simd();
+  sum_blocks(
+      [kernel, &target](int nx, const float *data, int y0, int x0, int y1,
+                        int x1, double sum[3]) {
+        sum_rows(kernel, target, nx, data, y0, x0, y1, x1, sum);
+      },
+      nx, data, y0, x0, y1, x1, sums);
+}
+
+Result calculate_tiled(int ny, int nx, int block, const float *data, int y0,
+                       int x0, int y1, int x1, const TileSums &tiles) {
+  // Whole tiles [i0, i1) x [j0, j1) inside the rectangle, covering the
+  // pixels [gy0, gy1) x [gx0, gx1)
+  const int i0 = (y0 + block - 1) / block;
+  const int i1 = y1 == ny ? (ny + block - 1) / block : y1 / block;
+  const int j0 = (x0 + block - 1) / block;
+  const int j1 = x1 == nx ? (nx + block - 1) / block : x1 / block;
+  const int gy0 = std::min(i0 * block, ny);
+  const int gy1 = std::min(i1 * block, ny);
+  const int gx0 = std::min(j0 * block, nx);
+  const int gx1 = std::min(j1 * block, nx);
+
+  double sum[3] = {0.0, 0.0, 0.0};
+  // Parts of the rectangle read from the image: everything if it contains
+  // no whole tile, otherwise the strips around the tiles
+  Rect strips[4];
+  int n = 0;
+  if (gy0 < gy1 && gx0 < gx1) {
+    tiles(i0, j0, i1, j1, sum);
+    strips[n++] = {y0, x0, gy0, x1};
+    strips[n++] = {gy1, x0, y1, x1};
+    strips[n++] = {gy0, x0, gy1, gx0};
+    strips[n++] = {gy0, gx1, gy1, x1};
+  } else {
+    strips[n++] = {y0, x0, y1, x1};
+  }
+  const Kernel kernel = default_kernel();
+  for (int k = 0; k < n; k++) {
+    const Rect &r = strips[k];
+    if (r.y0 == r.y1 || r.x0 == r.x1) {
+      continue;
+    }
+    if (data == nullptr) {
+      throw std::invalid_argument(
+          "query not aligned to the blocks needs the image data");
+    }
+    double part[3];
+    calculate_sums(kernel, nx, data, r.y0, r.x0, r.y1, r.x1, part);
+    sum[0] += part[0];
+    sum[1] += part[1];
+    sum[2] += part[2];
+  }
+  const double area = double(y1 - y0) * double(x1 - x0);
+  return {{float(sum[0] / area), float(sum[1] / area), float(sum[2] / area)}};
+}
+
+Result calculate(Kernel kernel, int ny, int nx, const float *data, int y0,
+                 int x0, int y1, int x1) {
+  double sum[3];
+  calculate_sums(kernel, nx, data, y0, x0, y1, x1, sum);
+  const double area = double(y1 - y0) * double(x1 - x0);
+  return {{float(sum[0] / area), float(sum[1] / area), float(sum[2] / area)}};
+}
+
+Result calculate_banded(int ny, int nx, int band_rows, const BandLoader &load,
+                        int y0, int x0, int y1, int x1) {
+  if (band_rows <= 0) {
+    throw std::invalid_argument("band size should be positive");
+  }
+  std::vector<float> band(std::size_t(3) * nx * band_rows);
+  const Kernel kernel = default_kernel();
+  double sum[3] = {0.0, 0.0, 0.0};
+  for (int by0 = y0 - y0 % band_rows; by0 < y1; by0 += band_rows) {
+    const int ya = std::max(by0, y0);
+    const int yb = std::min(by0 + band_rows, y1);
+    load(ya, yb, band.data());
+    double part[3];
+    calculate_sums(kernel, nx, band.data(), 0, x0, yb - ya, x1, part);
+    sum[0] += part[0];
+    sum[1] += part[1];
+    sum[2] += part[2];
+  }
+  const double area = double(y1 - y0) * double(x1 - x0);
+  return {{float(sum[0] / area), float(sum[1] / area), float(sum[2] / area)}};
+}
+
+Result calculate(int ny, int nx, const std::uint8_t *data, int y0, int x0,
+                 int y1, int x1) {
+  std::uint64_t sum[3];
+  sum_blocks(simd().sum_u8, nx, data, y0, x0, y1, x1, sum);
+  const double area = double(y1 - y0) * double(x1 - x0);
+  return {{float(sum[0] / area), float(sum[1] / area), float(sum[2] / area)}};
+}
+
+Result calculate_half(int ny, int nx, const std::uint16_t *data, int y0,
+                      int x0, int y1, int x1) {
+  double sum[3];
+  sum_blocks(simd().sum_half, nx, data, y0, x0, y1, x1, sum);
+  const double area = double(y1 - y0) * double(x1 - x0);
+  return {{float(sum[0] / area), float(sum[1] / area), float(sum[2] / area)}};
+}
+
+float half_to_float(std::uint16_t h) {
+  const std::uint32_t sign = std::uint32_t(h & 0x8000) << 16;
+  const std::uint32_t exponent = (h >> 10) & 0x1f;
+  const std::uint32_t mantissa = h & 0x3ff;
+  if (exponent == 0) {
+    // Zero or subnormal, exactly mantissa * 2^-24
+    const float value = mantissa * 0x1p-24f;
+    return sign ? -value : value;
+  }
+  const std::uint32_t bits =
+      exponent == 0x1f ? sign | 0x7f800000 | mantissa << 13
+                       : sign | (exponent + 127 - 15) << 23 | mantissa << 13;
+  float value;
+  std::memcpy(&value, &bits, sizeof(value));
+  return value;
+}
+
+std::uint16_t float_to_half(float value) {
+  std::uint32_t bits;
+  std::memcpy(&bits, &value, sizeof(bits));
+  const std::uint16_t sign = (bits >> 16) & 0x8000;
+  bits &= 0x7fffffff;
+  if (bits > 0x7f800000) {
+    return sign | 0x7e00;
+  }
+  if (bits >= 0x477ff000) {
+    // At least 65520, which rounds to infinity
+    return sign | 0x7c00;
+  }
+  if (bits < 0x38800000) {
+    // Below 2^-14, a subnormal half: a multiple of 2^-24, rounded to even
+    return sign | std::uint16_t(std::nearbyint(std::fabs(value) * 0x1p24f));
+  }
+  // Rebias the exponent and round the mantissa to 10 bits, to even on ties;
+  // a carry out of the mantissa correctly bumps the exponent.
+  bits -= (127 - 15) << 23;
+  bits += 0xfff + ((bits >> 13) & 1);
+  return sign | std::uint16_t(bits >> 13);
+}
+
+Layout interleaved_layout(int nx, int channels) {
+  return {channels, 1, channels, std::ptrdiff_t(channels) * nx};
+}
+
+Layout planar_layout(int ny, int nx, int channels) {
+  return {channels, std::ptrdiff_t(ny) * nx, 1, nx};
+}
 
+ImageView ImageView::crop(int y0, int x0, int y1, int x1) const {
+  return {data + y0 * layout.row_pitch + x0 * layout.pixel_stride, y1 - y0,
+          x1 - x0, layout};
 }
 
+static void sum_strided(const ImageView &image, int y0, int x0, int y1,
+                        int x1, double sum[3]) {
+  const Layout &layout = image.layout;
+  for (int y = y0; y < y1; y++) {
+    double row_sum[3] = {0.0, 0.0, 0.0};
+    for (int x = x0; x < x1; x++) {
+      const float *pixel =
+          image.data + y * layout.row_pitch + x * layout.pixel_stride;
+      for (int c = 0; c < 3; c++) {
+        row_sum[c] += pixel[c * layout.channel_stride];
+      }
+    }
+    sum[0] += row_sum[0];
+    sum[1] += row_sum[1];
+    sum[2] += row_sum[2];
+  }
+}
+
+Result calculate(const ImageView &image, int y0, int x0, int y1, int x1) {
+  const Layout &layout = image.layout;
+  if (layout.channels < 3) {
+    throw std::invalid_argument("calculate() needs at least 3 channels");
+  }
+  double sum[3];
+  if (layout.channel_stride == 1 && layout.pixel_stride == 3 &&
+      layout.row_pitch >= 0 && layout.row_pitch % 3 == 0) {
+    // Rows of interleaved RGB, as if the image were row_pitch / 3 pixels
+    // wide
+    calculate_sums(default_kernel(), int(layout.row_pitch / 3), image.data,
+                   y0, x0, y1, x1, sum);
+  } else if (layout.pixel_stride == 1) {
+    const SumPlaneFunction sum_plane = simd().sum_plane;
+    sum_blocks(
+        [&](int, const float *data, int by0, int x0, int by1, int x1,
+            double block_sum[3]) {
+          for (int c = 0; c < 3; c++) {
+            sum_plane(layout.row_pitch, data + c * layout.channel_stride, by0,
+                      x0, by1, x1, &block_sum[c]);
+          }
+        },
+        image.nx, image.data, y0, x0, y1, x1, sum);
+  } else {
+    sum_blocks(
+        [&](int, const float *, int by0, int x0, int by1, int x1,
+            double block_sum[3]) {
+          sum_strided(image, by0, x0, by1, x1, block_sum);
+        },
+        image.nx, image.data, y0, x0, y1, x1, sum);
+  }
+  const double area = double(y1 - y0) * double(x1 - x0);
+  return {{float(sum[0] / area), float(sum[1] / area), float(sum[2] / area)}};
+}
+
+// Per-channel sums of x - shift and (x - shift)^2 and the extremes of the
+// rows [y0, y1), for any layout.
+static void stats_rows(const ImageView &image, const double *shift, int y0,
+                       int x0, int y1, int x1, double *sum, double *squares,
+                       float *min, float *max) {
+  const Layout &layout = image.layout;
+  for (int y = y0; y < y1; y++) {
+    for (int x = x0; x < x1; x++) {
+      const float *pixel =
+          image.data + y * layout.row_pitch + x * layout.pixel_stride;
+      for (int c = 0; c < layout.channels; c++) {
+        const float v = pixel[c * layout.channel_stride];
+        const double d = v - shift[c];
+        sum[c] += d;
+        squares[c] += d * d;
+        min[c] = std::min(min[c], v);
+        max[c] = std::max(max[c], v);
+      }
+    }
+  }
+}
+
+// stats_rows() for interleaved pixels of a fixed number of channels. Each
+// row is walked in chunks of 8 pixels with separate accumulators for every
+// value of the chunk, which the compiler turns into vector lanes; the
+// channels are separated when the accumulators are reduced at the end.
+template <int CHANNELS>
+static void stats_rows_interleaved(const ImageView &image,
+                                   const double *shift, int y0, int x0,
+                                   int y1, int x1, double *sum,
+                                   double *squares, float *min, float *max) {
+  constexpr int K = 8 * CHANNELS;
+  double chunk_shift[K];
+  double chunk_sum[K];
+  double chunk_squares[K];
+  float chunk_min[K];
+  float chunk_max[K];
+  for (int k = 0; k < K; k++) {
+    chunk_shift[k] = shift[k % CHANNELS];
+    chunk_sum[k] = 0.0;
+    chunk_squares[k] = 0.0;
+    chunk_min[k] = min[k % CHANNELS];
+    chunk_max[k] = max[k % CHANNELS];
+  }
+  const int n = CHANNELS * (x1 - x0);
+  for (int y = y0; y < y1; y++) {
+    const float *row = image.data + y * image.layout.row_pitch + CHANNELS * x0;
+    int i = 0;
+    for (; i + K <= n; i += K) {
+      for (int k = 0; k < K; k++) {
+        const float v = row[i + k];
+        const double d = v - chunk_shift[k];
+        chunk_sum[k] += d;
+        chunk_squares[k] += d * d;
+        chunk_min[k] = std::min(chunk_min[k], v);
+        chunk_max[k] = std::max(chunk_max[k], v);
+      }
+    }
+    for (int k = 0; i < n; i++, k++) {
+      const float v = row[i];
+      const double d = v - chunk_shift[k];
+      chunk_sum[k] += d;
+      chunk_squares[k] += d * d;
+      chunk_min[k] = std::min(chunk_min[k], v);
+      chunk_max[k] = std::max(chunk_max[k], v);
+    }
+  }
+  for (int k = 0; k < K; k++) {
+    const int c = k % CHANNELS;
+    sum[c] += chunk_sum[k];
+    squares[c] += chunk_squares[k];
+    min[c] = std::min(min[c], chunk_min[k]);
+    max[c] = std::max(max[c], chunk_max[k]);
+  }
+}
+
+std::vector<ChannelStats> calculate_stats(const ImageView &image, int y0,
+                                          int x0, int y1, int x1) {
+  const Layout &layout = image.layout;
+  const int channels = layout.channels;
+  if (channels < 1) {
+    throw std::invalid_argument("calculate_stats() needs a channel");
+  }
+  std::vector<double> shift(channels);
+  for (int c = 0; c < channels; c++) {
+    shift[c] = image.data[y0 * layout.row_pitch + x0 * layout.pixel_stride +
+                          c * layout.channel_stride];
+  }
+  const bool interleaved = layout.channel_stride == 1 &&
+                           layout.pixel_stride == channels;
+  const auto rows = !interleaved   ? stats_rows
+                    : channels == 3 ? stats_rows_interleaved<3>
+                    : channels == 4 ? stats_rows_interleaved<4>
+                                    : stats_rows;
+
+  const double area = double(y1 - y0) * double(x1 - x0);
+  const int blocks = (y1 - y0 + ROW_BLOCK - 1) / ROW_BLOCK;
+  const int threads = area * channels < 3 * PARALLEL_MIN_AREA
+                          ? 1
+                          : thread_count();
+  const std::size_t n = std::size_t(blocks) * channels;
+  std::vector<double> sum(n, 0.0);
+  std::vector<double> squares(n, 0.0);
+  std::vector<float> min(n, std::numeric_limits<float>::infinity());
+  std::vector<float> max(n, -std::numeric_limits<float>::infinity());
+#pragma omp parallel for schedule(static) num_threads(threads) if (threads > 1)
+  for (int b = 0; b < blocks; b++) {
+    const int by0 = y0 + b * ROW_BLOCK;
+    const int by1 = std::min(by0 + ROW_BLOCK, y1);
+    const std::size_t i = std::size_t(b) * channels;
+    rows(image, shift.data(), by0, x0, by1, x1, &sum[i], &squares[i], &min[i],
+         &max[i]);
+  }
+
+  std::vector<ChannelStats> stats(channels);
+  for (int c = 0; c < channels; c++) {
+    double s = 0.0;
+    double q = 0.0;
+    float lo = std::numeric_limits<float>::infinity();
+    float hi = -std::numeric_limits<float>::infinity();
+    for (int b = 0; b < blocks; b++) {
+      const std::size_t i = std::size_t(b) * channels + c;
+      s += sum[i];
+      q += squares[i];
+      lo = std::min(lo, min[i]);
+      hi = std::max(hi, max[i]);
+    }
+    const double mean = s / area;
+    stats[c] = {shift[c] + mean, std::max(0.0, q / area - mean * mean), lo,
+                hi};
+  }
+  return stats;
+}
+
+Result to_result(const std::vector<ChannelStats> &stats) {
+  if (stats.size() < 3) {
+    throw std::invalid_argument("to_result() needs at least 3 channels");
+  }
+  return {{float(stats[0].mean), float(stats[1].mean), float(stats[2].mean)}};
+}
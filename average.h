@@ -1,8 +1,289 @@
 #pragma once
 
+#include <cstddef>
+#include <cstdint>
+#include <functional>
+#include <string>
+#include <vector>
+
 struct Result {
   float avg[3];
 };
 
+struct Rect {
+  int y0;
+  int x0;
+  int y1;
+  int x1;
+};
+
+enum class Kernel {
+  // Original loop order: channel outermost, y innermost, reading the
+  // rectangle once per channel with a stride of 3 * nx floats.
+  naive,
+  // A single pass over the rectangle in memory order, row by row,
+  // accumulating all three channels together.
+  streaming,
+  // Streaming with explicit AVX-512 or AVX2 vectors over the interleaved
+  // pixel data, chosen at run time, falling back to streaming otherwise.
+  simd,
+  // Like simd, but each vector lane first adds up a few pixels in single
+  // precision and only promotes that partial sum to double between tiles.
+  blocked,
+};
+
+static constexpr Kernel KERNELS[] = {Kernel::naive, Kernel::streaming,
+                                     Kernel::simd, Kernel::blocked};
+
+// Instruction set used for the simd and blocked kernels and the other pixel
+// types: "avx512", "avx2" or "scalar". The one named in the PPC_SIMD
+// environment variable, the best one this machine supports if it is unset,
+// or the one set with set_simd_target() on the calling thread. Throws
+// std::invalid_argument if PPC_SIMD names one that is not supported.
+const char *simd_target();
+
+// Instruction sets this machine supports, best first; "scalar" always is.
+std::vector<std::string> simd_targets();
+
+// Use the named instruction set of simd_targets() on the calling thread, or
+// the default one again with an empty name. Throws std::invalid_argument if
+// it is not supported.
+void set_simd_target(const std::string &name);
+
+const char *kernel_name(Kernel kernel);
+
+// Parse a name returned by kernel_name(), false if there is no such kernel.
+bool parse_kernel(const std::string &name, Kernel &kernel);
+
+// Kernel used by calculate(): the one named in the PPC_KERNEL environment
+// variable, simd if it is unset.
+Kernel default_kernel();
+
+// Number of threads used by calculate(): the PPC_THREADS environment
+// variable, or every available core if it is unset. Rows are summed in fixed
+// blocks and reduced in order, so results do not depend on the thread count.
+// At most the limit set with set_thread_limit() on the calling thread.
+int thread_count();
+
+// Limit thread_count() on the calling thread to n threads, or remove the
+// limit with 0. Threads of a pool of their own set 1, so that each of them
+// does not start another team of thread_count() threads.
+void set_thread_limit(int n);
+
 Result calculate(int ny, int nx, const float *data, int y0, int x0, int y1,
-                 int x1);
\ No newline at end of file
+                 int x1);
+
+Result calculate(Kernel kernel, int ny, int nx, const float *data, int y0,
+                 int x0, int y1, int x1);
+
+// calculate() for 8-bit RGB data in the same layout. The channel sums are
+// exact 64-bit integers; the averages are in the units of the input, 0 to
+// 255.
+Result calculate(int ny, int nx, const std::uint8_t *data, int y0, int x0,
+                 int y1, int x1);
+
+// calculate() for RGB data in IEEE half precision, each value given by its
+// 16-bit pattern as in _Float16. Halves are widened on the fly, so only 2
+// bytes per value are read.
+Result calculate_half(int ny, int nx, const std::uint16_t *data, int y0,
+                      int x0, int y1, int x1);
+
+// Conversions between float and the half precision bit pattern, rounding to
+// nearest even.
+float half_to_float(std::uint16_t h);
+std::uint16_t float_to_half(float value);
+
+// Where the values of an image are in memory, counted in values from the
+// start of its data: channel c of pixel (y, x) is at
+// c * channel_stride + x * pixel_stride + y * row_pitch.
+struct Layout {
+  int channels;
+  std::ptrdiff_t channel_stride;
+  std::ptrdiff_t pixel_stride;
+  std::ptrdiff_t row_pitch;
+};
+
+// Rows of nx pixels with their channels next to each other, RGBRGB..., the
+// layout that calculate() takes.
+Layout interleaved_layout(int nx, int channels = 3);
+
+// Each channel in an ny x nx plane of its own, RRR...GGG...BBB...
+Layout planar_layout(int ny, int nx, int channels = 3);
+
+// An ny x nx image in some layout. It does not own its data.
+struct ImageView {
+  const float *data;
+  int ny;
+  int nx;
+  Layout layout;
+
+  // Pixels [y0, y1) x [x0, x1) as an image of their own, sharing the data.
+  ImageView crop(int y0, int x0, int y1, int x1) const;
+};
+
+// calculate() for an image in any layout with at least three channels, of
+// which the first three are averaged; others, such as alpha, are skipped.
+// Interleaved RGB rows with a row pitch that is a multiple of 3 run on the
+// kernels of calculate(), and planar data with contiguous rows has a
+// vectorised path of its own, so views and crops are never copied.
+Result calculate(const ImageView &image, int y0, int x0, int y1, int x1);
+
+// Statistics of one channel over a rectangle.
+struct ChannelStats {
+  double mean;
+  // Population variance, the mean squared difference from the mean.
+  double variance;
+  float min;
+  float max;
+};
+
+// Mean, variance, minimum and maximum of every channel of the image, all
+// computed in a single pass over the rectangle. The variance is accumulated
+// around the first pixel of the rectangle to avoid cancellation, and rows
+// are reduced in fixed blocks, so the results do not depend on the thread
+// count either.
+std::vector<ChannelStats> calculate_stats(const ImageView &image, int y0,
+                                          int x0, int y1, int x1);
+
+// The means of the first three channels, as calculate() would return them.
+Result to_result(const std::vector<ChannelStats> &stats);
+
+// Per-channel sums of the rectangle rather than averages, for callers that
+// combine several parts in double precision.
+void calculate_sums(Kernel kernel, int nx, const float *data, int y0, int x0,
+                    int y1, int x1, double sums[3]);
+
+// Adds the sums of the whole tiles [i0, i1) x [j0, j1) to sum.
+using TileSums =
+    std::function<void(int i0, int j0, int i1, int j1, double sum[3])>;
+
+// Average of a rectangle of an ny x nx image with precomputed sums of its
+// block x block tiles, the last row and column of which may be smaller.
+// The tiles that fit in the rectangle come from tiles, and the strips along
+// its edges that do not cover whole tiles are summed from data, which may
+// be null if there are none. Throws std::invalid_argument if data is needed
+// but null.
+Result calculate_tiled(int ny, int nx, int block, const float *data, int y0,
+                       int x0, int y1, int x1, const TileSums &tiles);
+
+// Call f(by0, by1) for the blocks of the rows [y0, y1) of an image nx
+// pixels wide, on the threads and in the static partition that calculate()
+// uses to sum a rectangle of those rows, so that each block is handled by
+// the thread that would sum it. Narrower rectangles of the same rows are
+// partitioned the same way, unless they are small enough to be summed on a
+// single thread. f is called concurrently.
+void for_each_row_block(int nx, int y0, int y1,
+                        const std::function<void(int y0, int y1)> &f);
+
+// Fills buf with rows [y0, y1) of an image, 3 * nx * (y1 - y0) floats.
+using BandLoader = std::function<void(int y0, int y1, float *buf)>;
+
+// calculate() for images that are not in memory as a whole. The image is
+// split into bands of band_rows rows; only the rows of bands that overlap
+// the rectangle are loaded, one band at a time, so memory use is bounded by
+// a single band of band_rows * nx pixels. Throws std::invalid_argument if
+// band_rows is not positive.
+Result calculate_banded(int ny, int nx, int band_rows, const BandLoader &load,
+                        int y0, int x0, int y1, int x1);
+
+// Summed-area table of an ny x nx RGB image. Building it reads the image
+// once; after that the average of any rectangle is answered in O(1).
+class IntegralImage {
+public:
+  IntegralImage(int ny, int nx, const float *data);
+
+  Result calculate(int y0, int x0, int y1, int x1) const;
+
+  // Bytes held by the table.
+  std::size_t memory() const {
+    return sizeof(*this) + sums.capacity() * sizeof(double);
+  }
+
+private:
+  int ny;
+  int nx;
+  // (ny + 1) x (nx + 1) x 3 prefix sums, row 0 and column 0 are zero.
+  std::vector<double> sums;
+};
+
+// Sums of the block x block tiles of an ny x nx RGB image, and at each
+// further level of tiles twice as large, up to a single tile: about
+// 32 / block^2 bytes per pixel instead of the 24 of an IntegralImage. The
+// average of a rectangle adds up the largest tiles that fit in it, and
+// scans only the strips along its edges that do not cover whole tiles,
+// less than block pixels wide, in the image itself. Larger blocks make the
+// pyramid smaller and queries slower. The image has to stay alive as long
+// as the pyramid.
+class BlockPyramid {
+public:
+  BlockPyramid(int ny, int nx, const float *data, int block);
+
+  Result calculate(int y0, int x0, int y1, int x1) const;
+
+  // Bytes held by the pyramid, not counting the image.
+  std::size_t memory() const;
+
+private:
+  struct Level {
+    // Number of tile rows and columns
+    int ny;
+    int nx;
+    // ny x nx x 3 sums
+    std::vector<double> sums;
+  };
+
+  void add_tiles(std::size_t level, int r0, int c0, int r1, int c1,
+                 double sum[3]) const;
+
+  int ny;
+  int nx;
+  const float *data;
+  int block;
+  std::vector<Level> levels;
+};
+
+enum class BatchStrategy {
+  // Scan each rectangle separately, cheap for a few small rectangles.
+  direct,
+  // Build one IntegralImage and answer every rectangle from it.
+  table,
+};
+
+// Pick the cheaper strategy for the given batch by comparing the total
+// covered area against the cost of building an IntegralImage.
+BatchStrategy batch_strategy(int ny, int nx, int n, const Rect *rects);
+
+// Average of each of the n rectangles, written to results[0..n).
+void calculate_batch(int ny, int nx, const float *data, int n,
+                     const Rect *rects, Result *results);
+
+// A height x width window over an ny x nx image that keeps its channel sums
+// up to date as it moves: a move only reads the rows and columns that enter
+// and leave the window, unless it jumps further than the window size.
+class SlidingWindow {
+public:
+  SlidingWindow(int ny, int nx, const float *data, int y0, int x0, int height,
+                int width);
+
+  // Move the window by dy rows and dx columns. It has to stay inside the
+  // image.
+  void move(int dy, int dx);
+
+  Result average() const;
+
+  int top() const { return y0; }
+  int left() const { return x0; }
+
+private:
+  void add(int ya, int xa, int yb, int xb, double sign);
+  void reset();
+
+  int ny;
+  int nx;
+  const float *data;
+  int y0;
+  int x0;
+  int height;
+  int width;
+  double sum[3];
+};
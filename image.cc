@@ -0,0 +1,94 @@
+#include "image.h"
+
+#include <cerrno>
+#include <cstdio>
+#include <cstring>
+#include <stdexcept>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+static std::runtime_error io_error(const std::string &what,
+                                   const std::string &path) {
+  return std::runtime_error(what + " " + path + ": " + std::strerror(errno));
+}
+
+MappedImage::MappedImage(const std::string &path, int ny, int nx)
+    : addr(nullptr), size(std::size_t(3) * ny * nx * sizeof(float)) {
+  const int fd = open(path.c_str(), O_RDONLY);
+  if (fd < 0) {
+    throw io_error("cannot open", path);
+  }
+  struct stat st;
+  if (fstat(fd, &st) != 0) {
+    close(fd);
+    throw io_error("cannot stat", path);
+  }
+  if (std::size_t(st.st_size) != size) {
+    close(fd);
+    throw std::runtime_error(path + " has " + std::to_string(st.st_size) +
+                             " bytes, expected " + std::to_string(size) +
+                             " for a " + std::to_string(ny) + "x" +
+                             std::to_string(nx) + " image");
+  }
+  if (size > 0) {
+    addr = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, fd, 0);
+    if (addr == MAP_FAILED) {
+      close(fd);
+      throw io_error("cannot map", path);
+    }
+  }
+  close(fd);
+}
+
+MappedImage::~MappedImage() {
+  if (addr != nullptr) {
+    munmap(addr, size);
+  }
+}
+
+void write_image(const std::string &path, int ny, int nx, const float *data) {
+  std::FILE *f = std::fopen(path.c_str(), "wb");
+  if (f == nullptr) {
+    throw io_error("cannot create", path);
+  }
+  const std::size_t count = std::size_t(3) * ny * nx;
+  const bool ok = std::fwrite(data, sizeof(float), count, f) == count;
+  if (std::fclose(f) != 0 || !ok) {
+    throw io_error("cannot write", path);
+  }
+}
+
+RawFileBands::RawFileBands(const std::string &path, int ny, int nx)
+    : path(path), nx(nx), fd(open(path.c_str(), O_RDONLY)) {
+  if (fd < 0) {
+    throw io_error("cannot open", path);
+  }
+  struct stat st;
+  const std::size_t size = std::size_t(3) * ny * nx * sizeof(float);
+  if (fstat(fd, &st) != 0 || std::size_t(st.st_size) != size) {
+    close(fd);
+    throw std::runtime_error(path + " is not a " + std::to_string(ny) + "x" +
+                             std::to_string(nx) + " raw image");
+  }
+}
+
+RawFileBands::~RawFileBands() { close(fd); }
+
+void RawFileBands::operator()(int y0, int y1, float *buf) const {
+  const std::size_t row = std::size_t(3) * nx * sizeof(float);
+  char *out = reinterpret_cast<char *>(buf);
+  std::size_t left = row * (y1 - y0);
+  off_t offset = off_t(row) * y0;
+  while (left > 0) {
+    const ssize_t n = pread(fd, out, left, offset);
+    if (n <= 0) {
+      throw io_error("cannot read", path);
+    }
+    out += n;
+    left -= n;
+    offset += n;
+  }
+}
@@ -0,0 +1,44 @@
+#pragma once
+
+#include <cstddef>
+#include <string>
+
+// Raw image files hold the 3 * ny * nx float32 values of an RGB image in the
+// same order as calculate() expects them, with no header: the dimensions are
+// given by whoever opens the file. All functions throw std::runtime_error on
+// I/O errors and size mismatches.
+
+// A raw image file mapped read-only into memory; data() can be passed to
+// calculate() directly.
+class MappedImage {
+public:
+  MappedImage(const std::string &path, int ny, int nx);
+  ~MappedImage();
+  MappedImage(const MappedImage &) = delete;
+  MappedImage &operator=(const MappedImage &) = delete;
+
+  const float *data() const { return static_cast<const float *>(addr); }
+
+private:
+  void *addr;
+  std::size_t size;
+};
+
+void write_image(const std::string &path, int ny, int nx, const float *data);
+
+// BandLoader (see average.h) reading rows of a raw image file with pread(),
+// for images too large to map or hold in memory.
+class RawFileBands {
+public:
+  RawFileBands(const std::string &path, int ny, int nx);
+  ~RawFileBands();
+  RawFileBands(const RawFileBands &) = delete;
+  RawFileBands &operator=(const RawFileBands &) = delete;
+
+  void operator()(int y0, int y1, float *buf) const;
+
+private:
+  std::string path;
+  int nx;
+  int fd;
+};
@@ -0,0 +1,175 @@
+#include "index.h"
+
+#include <algorithm>
+#include <cerrno>
+#include <climits>
+#include <cstdio>
+#include <cstring>
+#include <stdexcept>
+#include <vector>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+static constexpr char MAGIC[8] = {'P', 'P', 'C', 'I', 'N', 'D', 'E', 'X'};
+static constexpr std::uint32_t VERSION = 1;
+
+struct IndexHeader {
+  char magic[8];
+  std::uint32_t version;
+  std::uint32_t block;
+  std::int32_t ny;
+  std::int32_t nx;
+  std::uint64_t checksum;
+};
+static_assert(sizeof(IndexHeader) == 32, "IndexHeader is padded");
+
+static std::runtime_error io_error(const std::string &what,
+                                   const std::string &path) {
+  return std::runtime_error(what + " " + path + ": " + std::strerror(errno));
+}
+
+// Number of grid lines after the first along a dimension of n pixels.
+static int grid_size(int n, int block) { return (n + block - 1) / block; }
+
+// Size of the file of an ny x nx index with the given block size.
+static std::size_t index_size(int ny, int nx, int block) {
+  return sizeof(IndexHeader) + std::size_t(3) * sizeof(double) *
+                                   (std::size_t(grid_size(ny, block)) + 1) *
+                                   (std::size_t(grid_size(nx, block)) + 1);
+}
+
+// FNV-1a over the bit patterns of the values.
+static constexpr std::uint64_t FNV_OFFSET = 14695981039346656037ull;
+static constexpr std::uint64_t FNV_PRIME = 1099511628211ull;
+
+static std::uint64_t checksum_values(std::uint64_t hash, const float *data,
+                                     std::size_t n) {
+  for (std::size_t i = 0; i < n; i++) {
+    std::uint32_t bits;
+    std::memcpy(&bits, data + i, sizeof(bits));
+    hash = (hash ^ bits) * FNV_PRIME;
+  }
+  return hash;
+}
+
+std::uint64_t image_checksum(int ny, int nx, const float *data) {
+  return checksum_values(FNV_OFFSET, data, std::size_t(3) * ny * nx);
+}
+
+void write_index(const std::string &path, int ny, int nx, const float *data,
+                 int block) {
+  if (block < 1) {
+    throw std::invalid_argument("index block size should be positive");
+  }
+  std::FILE *f = std::fopen(path.c_str(), "wb");
+  if (f == nullptr) {
+    throw io_error("cannot create", path);
+  }
+  IndexHeader header;
+  std::memcpy(header.magic, MAGIC, sizeof(MAGIC));
+  header.version = VERSION;
+  header.block = std::uint32_t(block);
+  header.ny = ny;
+  header.nx = nx;
+  header.checksum = FNV_OFFSET;
+  // The checksum is filled in after the single pass over the image
+  bool ok = std::fwrite(&header, sizeof(header), 1, f) == 1;
+
+  // Sums above the current row at each grid column, written out whenever
+  // the current row is on the grid.
+  const int gx = grid_size(nx, block);
+  std::vector<double> acc(3 * (gx + 1), 0.0);
+  ok = ok && std::fwrite(acc.data(), sizeof(double), acc.size(), f) ==
+                 acc.size();
+  for (int y = 0; y < ny && ok; y++) {
+    const float *in = data + std::size_t(3) * nx * y;
+    double row[3] = {0.0, 0.0, 0.0};
+    for (int x = 0; x < nx; x++) {
+      for (int c = 0; c < 3; c++) {
+        row[c] += in[3 * x + c];
+      }
+      if ((x + 1) % block == 0 || x + 1 == nx) {
+        double *out = &acc[3 * grid_size(x + 1, block)];
+        for (int c = 0; c < 3; c++) {
+          out[c] += row[c];
+        }
+      }
+    }
+    header.checksum =
+        checksum_values(header.checksum, in, std::size_t(3) * nx);
+    if ((y + 1) % block == 0 || y + 1 == ny) {
+      ok = std::fwrite(acc.data(), sizeof(double), acc.size(), f) ==
+           acc.size();
+    }
+  }
+  ok = ok && std::fseek(f, 0, SEEK_SET) == 0 &&
+       std::fwrite(&header, sizeof(header), 1, f) == 1;
+  if (std::fclose(f) != 0 || !ok) {
+    throw io_error("cannot write", path);
+  }
+}
+
+IndexFile::IndexFile(const std::string &path) : addr(nullptr), size(0) {
+  const int fd = open(path.c_str(), O_RDONLY);
+  if (fd < 0) {
+    throw io_error("cannot open", path);
+  }
+  struct stat st;
+  if (fstat(fd, &st) != 0) {
+    close(fd);
+    throw io_error("cannot stat", path);
+  }
+  IndexHeader header;
+  if (std::size_t(st.st_size) < sizeof(header) ||
+      pread(fd, &header, sizeof(header), 0) != sizeof(header) ||
+      std::memcmp(header.magic, MAGIC, sizeof(MAGIC)) != 0) {
+    close(fd);
+    throw std::runtime_error(path + " is not an index file");
+  }
+  if (header.version != VERSION) {
+    close(fd);
+    throw std::runtime_error(path + " has index version " +
+                             std::to_string(header.version) + ", expected " +
+                             std::to_string(VERSION));
+  }
+  if (header.ny < 1 || header.nx < 1 || header.block < 1 ||
+      header.block > std::uint32_t(INT_MAX) ||
+      std::size_t(st.st_size) !=
+          index_size(header.ny, header.nx, int(header.block))) {
+    close(fd);
+    throw std::runtime_error(path + " has " + std::to_string(st.st_size) +
+                             " bytes, which does not match its header");
+  }
+  size = st.st_size;
+  addr = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, fd, 0);
+  if (addr == MAP_FAILED) {
+    close(fd);
+    throw io_error("cannot map", path);
+  }
+  close(fd);
+  rows = header.ny;
+  cols = header.nx;
+  step = int(header.block);
+  grid_nx = grid_size(cols, step);
+  sum = header.checksum;
+  sums = reinterpret_cast<const double *>(static_cast<const char *>(addr) +
+                                          sizeof(IndexHeader));
+}
+
+IndexFile::~IndexFile() { munmap(addr, size); }
+
+Result IndexFile::calculate(int y0, int x0, int y1, int x1,
+                            const float *data) const {
+  // Tiles [i0, i1) x [j0, j1) lie between grid lines i0 and i1, j0 and j1
+  return calculate_tiled(
+      rows, cols, step, data, y0, x0, y1, x1,
+      [this](int i0, int j0, int i1, int j1, double sum[3]) {
+        for (int c = 0; c < 3; c++) {
+          sum[c] +=
+              at(i1, j1)[c] - at(i0, j1)[c] - at(i1, j0)[c] + at(i0, j0)[c];
+        }
+      });
+}
@@ -0,0 +1,64 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <string>
+
+#include "average.h"
+
+// Index files hold the summed-area table of an ny x nx RGB image, so that a
+// process can answer queries about the image without reading it first. The
+// file starts with a header with the dimensions, the block size and a
+// checksum of the image, followed by (gy + 1) x (gx + 1) x 3 doubles: the
+// per-channel sums of all pixels above and left of each grid point, where
+// the grid lines are every block rows and columns plus the last row and
+// column of the image. With block 1 this is the full integral image, 24
+// bytes per pixel; larger blocks shrink it by block * block. Values are
+// stored in native byte order. All functions throw std::runtime_error on
+// I/O errors and malformed files.
+
+// Checksum of the 3 * ny * nx floats of an image, as stored in the header.
+std::uint64_t image_checksum(int ny, int nx, const float *data);
+
+// Build the index of an image with the given block size and write it to
+// path. Only one row of grid points is held in memory.
+void write_index(const std::string &path, int ny, int nx, const float *data,
+                 int block = 1);
+
+// An index file mapped read-only into memory. Opening it only checks the
+// header against the file size, and queries read the mapping directly.
+class IndexFile {
+public:
+  explicit IndexFile(const std::string &path);
+  ~IndexFile();
+  IndexFile(const IndexFile &) = delete;
+  IndexFile &operator=(const IndexFile &) = delete;
+
+  int ny() const { return rows; }
+  int nx() const { return cols; }
+  int block() const { return step; }
+  std::uint64_t checksum() const { return sum; }
+
+  // Average of the rectangle. The part of it aligned to the grid comes from
+  // the index; data, the image the index was built from, is read for the
+  // strips along the edges that are not, and may be null for rectangles on
+  // the grid and for indexes with block 1. Throws std::invalid_argument if
+  // data is needed but null.
+  Result calculate(int y0, int x0, int y1, int x1,
+                   const float *data = nullptr) const;
+
+private:
+  // Sums at grid point (i, j).
+  const double *at(int i, int j) const {
+    return sums + 3 * (std::size_t(i) * (grid_nx + 1) + j);
+  }
+
+  void *addr;
+  std::size_t size;
+  int rows;
+  int cols;
+  int step;
+  int grid_nx;
+  std::uint64_t sum;
+  const double *sums;
+};
@@ -0,0 +1,33 @@
+#include "average.h"
+
+IntegralImage::IntegralImage(int ny, int nx, const float *data)
+    : ny(ny), nx(nx), sums(std::size_t(3) * (ny + 1) * (nx + 1)) {
+  const std::size_t pitch = std::size_t(3) * (nx + 1);
+  for (int y = 0; y < ny; y++) {
+    // Running sum along the row, added on top of the previous row, so each
+    // entry is a single double addition away from its neighbours.
+    double row[3] = {0.0, 0.0, 0.0};
+    const float *in = data + std::size_t(3) * nx * y;
+    const double *above = sums.data() + pitch * y;
+    double *out = sums.data() + pitch * (y + 1);
+    for (int x = 0; x < nx; x++) {
+      for (int c = 0; c < 3; c++) {
+        row[c] += in[3 * x + c];
+        out[3 * (x + 1) + c] = above[3 * (x + 1) + c] + row[c];
+      }
+    }
+  }
+}
+
+Result IntegralImage::calculate(int y0, int x0, int y1, int x1) const {
+  const std::size_t pitch = std::size_t(3) * (nx + 1);
+  const double *s = sums.data();
+  const double area = double(y1 - y0) * double(x1 - x0);
+  Result result;
+  for (int c = 0; c < 3; c++) {
+    double sum = s[pitch * y1 + 3 * x1 + c] - s[pitch * y0 + 3 * x1 + c] -
+                 s[pitch * y1 + 3 * x0 + c] + s[pitch * y0 + 3 * x0 + c];
+    result.avg[c] = float(sum / area);
+  }
+  return result;
+}
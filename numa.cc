@@ -0,0 +1,145 @@
+#include "numa.h"
+
+#include "average.h"
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <cstdint>
+#include <cstring>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <sched.h>
+#include <sys/mman.h>
+#include <sys/syscall.h>
+#include <unistd.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+ImageBuffer::ImageBuffer(int ny, int nx, int y0, int y1)
+    : values(nullptr), size(std::size_t(3) * ny * nx * sizeof(float)) {
+  if (size == 0) {
+    return;
+  }
+  // Mapped directly rather than taken from the heap, so that no page has
+  // been touched before
+  void *addr = mmap(nullptr, size, PROT_READ | PROT_WRITE,
+                    MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+  if (addr == MAP_FAILED) {
+    throw std::runtime_error(std::string("cannot map image buffer: ") +
+                             std::strerror(errno));
+  }
+  values = static_cast<float *>(addr);
+  const auto zero = [this, nx](int y0, int y1) {
+    std::fill(values + std::size_t(3) * nx * y0,
+              values + std::size_t(3) * nx * y1, 0.0f);
+  };
+  // The rectangle first, so that the pages it shares with the rows next to
+  // it go with its threads
+  for_each_row_block(nx, y0, y1, zero);
+  for_each_row_block(nx, 0, y0, zero);
+  for_each_row_block(nx, y1, ny, zero);
+}
+
+ImageBuffer::~ImageBuffer() {
+  if (values != nullptr) {
+    munmap(values, size);
+  }
+}
+
+// CPUs the process was allowed to run on before any thread was pinned.
+static const std::vector<int> &allowed_cpus() {
+  static const std::vector<int> cpus = [] {
+    std::vector<int> list;
+    cpu_set_t set;
+    CPU_ZERO(&set);
+    if (sched_getaffinity(0, sizeof(set), &set) == 0) {
+      for (int cpu = 0; cpu < CPU_SETSIZE; cpu++) {
+        if (CPU_ISSET(cpu, &set)) {
+          list.push_back(cpu);
+        }
+      }
+    }
+    return list;
+  }();
+  return cpus;
+}
+
+bool pin_threads() {
+  const std::vector<int> &cpus = allowed_cpus();
+  if (cpus.empty()) {
+    return false;
+  }
+  std::atomic<bool> ok{true};
+#pragma omp parallel num_threads(thread_count())
+  {
+#ifdef _OPENMP
+    const int thread = omp_get_thread_num();
+#else
+    const int thread = 0;
+#endif
+    cpu_set_t set;
+    CPU_ZERO(&set);
+    CPU_SET(cpus[thread % cpus.size()], &set);
+    if (sched_setaffinity(0, sizeof(set), &set) != 0) {
+      ok = false;
+    }
+  }
+  return ok;
+}
+
+// NUMA node of the CPU the calling thread runs on, or -1.
+static int current_node() {
+  unsigned cpu;
+  unsigned node;
+  if (syscall(SYS_getcpu, &cpu, &node, nullptr) != 0) {
+    return -1;
+  }
+  return int(node);
+}
+
+PagePlacement page_placement(int nx, const float *data, int y0, int y1) {
+  const std::uintptr_t page = sysconf(_SC_PAGESIZE);
+  const std::uintptr_t start = reinterpret_cast<std::uintptr_t>(data);
+  std::atomic<long long> local{0};
+  std::atomic<long long> remote{0};
+  std::atomic<long long> unknown{0};
+  for_each_row_block(nx, y0, y1, [&](int by0, int by1) {
+    // Each page is counted by the block its first byte is in, and the
+    // first page of the rows by the first block
+    const std::size_t row = std::size_t(3) * nx * sizeof(float);
+    const std::uintptr_t begin = start + row * by0;
+    const std::uintptr_t end = start + row * by1;
+    std::uintptr_t p = by0 == y0 ? begin / page * page
+                                 : (begin + page - 1) / page * page;
+    const int node = current_node();
+    // move_pages() without target nodes only reports where pages are
+    std::vector<void *> pages;
+    std::vector<int> status;
+    while (p < end) {
+      pages.clear();
+      for (; p < end && pages.size() < 1024; p += page) {
+        pages.push_back(reinterpret_cast<void *>(p));
+      }
+      status.assign(pages.size(), -1);
+      if (syscall(SYS_move_pages, 0, pages.size(), pages.data(), nullptr,
+                  status.data(), 0) != 0) {
+        std::fill(status.begin(), status.end(), -1);
+      }
+      for (int s : status) {
+        if (s < 0 || node < 0) {
+          unknown++;
+        } else if (s == node) {
+          local++;
+        } else {
+          remote++;
+        }
+      }
+    }
+  });
+  return {local, remote, unknown};
+}
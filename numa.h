@@ -0,0 +1,55 @@
+#pragma once
+
+#include <cstddef>
+
+// Memory placement on machines with several NUMA nodes. Linux puts a page
+// on the node of the thread that first touches it, so an image written by
+// a single thread lives on one node, and the threads of calculate() on the
+// other nodes read it across the interconnect. These helpers place the
+// pages with the threads that sum them instead. On a single node they do no
+// harm. All of them use the partition of for_each_row_block() (see
+// average.h), which matches calculate() for a rectangle of the given rows.
+
+// Buffer for the 3 * ny * nx floats of an RGB image, zeroed by the threads
+// of calculate(), so that each page is on the node of the thread that sums
+// it. The rows [y0, y1) of the rectangle that is going to be queried, the
+// whole image by default, are zeroed in the partition of that query, and
+// the rows above and below it in the partition of queries of their own.
+// Writing the values afterwards, from any thread, does not move the pages.
+// Throws std::runtime_error if the memory cannot be mapped.
+class ImageBuffer {
+public:
+  ImageBuffer(int ny, int nx) : ImageBuffer(ny, nx, 0, ny) {}
+  ImageBuffer(int ny, int nx, int y0, int y1);
+  ~ImageBuffer();
+  ImageBuffer(const ImageBuffer &) = delete;
+  ImageBuffer &operator=(const ImageBuffer &) = delete;
+
+  float *data() { return values; }
+  const float *data() const { return values; }
+
+private:
+  float *values;
+  std::size_t size;
+};
+
+// Pin OpenMP thread i of the thread_count() threads of calculate() to the
+// i-th CPU the process may run on, so that threads stay on the node where
+// their pages are. OpenMP keeps the same threads for later parallel
+// regions of the same size, so this is done once, before allocating.
+// OMP_PROC_BIND=close with OMP_PLACES=cores has the same effect without
+// code. Returns false if the affinity could not be set.
+bool pin_threads();
+
+// Pages of the rows [y0, y1) of an image by where they are, as seen from
+// the thread that sums the rows they hold in a query of those rows.
+struct PagePlacement {
+  // On the node of that thread
+  long long local;
+  // On another node
+  long long remote;
+  // Not yet touched, or the kernel cannot tell
+  long long unknown;
+};
+
+PagePlacement page_placement(int nx, const float *data, int y0, int y1);
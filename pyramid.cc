@@ -0,0 +1,115 @@
+#include "average.h"
+
+#include <algorithm>
+#include <cstddef>
+#include <stdexcept>
+#include <utility>
+
+// Number of tiles of size block along a dimension of n pixels, the last one
+// possibly smaller.
+static int tile_count(int n, int block) { return (n + block - 1) / block; }
+
+BlockPyramid::BlockPyramid(int ny, int nx, const float *data, int block)
+    : ny(ny), nx(nx), data(data), block(block) {
+  if (block < 1) {
+    throw std::invalid_argument("pyramid block size should be positive");
+  }
+  Level base = {tile_count(ny, block), tile_count(nx, block), {}};
+  base.sums.assign(std::size_t(3) * base.ny * base.nx, 0.0);
+  // Each thread sums whole rows of tiles, so the result does not depend on
+  // the thread count
+#pragma omp parallel for schedule(static) num_threads(thread_count())
+  for (int i = 0; i < base.ny; i++) {
+    double *out = &base.sums[std::size_t(3) * base.nx * i];
+    const int y1 = std::min((i + 1) * block, ny);
+    for (int y = i * block; y < y1; y++) {
+      const float *in = data + std::size_t(3) * nx * y;
+      for (int j = 0; j < base.nx; j++) {
+        const int x1 = std::min((j + 1) * block, nx);
+        double part[3] = {0.0, 0.0, 0.0};
+        for (int x = j * block; x < x1; x++) {
+          part[0] += in[3 * x + 0];
+          part[1] += in[3 * x + 1];
+          part[2] += in[3 * x + 2];
+        }
+        out[3 * j + 0] += part[0];
+        out[3 * j + 1] += part[1];
+        out[3 * j + 2] += part[2];
+      }
+    }
+  }
+  levels.push_back(std::move(base));
+
+  while (levels.back().ny > 1 || levels.back().nx > 1) {
+    const Level &fine = levels.back();
+    Level coarse = {tile_count(fine.ny, 2), tile_count(fine.nx, 2), {}};
+    coarse.sums.assign(std::size_t(3) * coarse.ny * coarse.nx, 0.0);
+    for (int i = 0; i < fine.ny; i++) {
+      for (int j = 0; j < fine.nx; j++) {
+        const double *in = &fine.sums[3 * (std::size_t(fine.nx) * i + j)];
+        double *out =
+            &coarse.sums[3 * (std::size_t(coarse.nx) * (i / 2) + j / 2)];
+        out[0] += in[0];
+        out[1] += in[1];
+        out[2] += in[2];
+      }
+    }
+    levels.push_back(std::move(coarse));
+  }
+}
+
+std::size_t BlockPyramid::memory() const {
+  std::size_t bytes = sizeof(*this);
+  for (const Level &level : levels) {
+    bytes += sizeof(Level) + level.sums.capacity() * sizeof(double);
+  }
+  return bytes;
+}
+
+// Add the tiles [r0, r1) x [c0, c1) of the level to sum: the tiles of the
+// next level that fit in the range, and the tiles of this level around
+// them.
+void BlockPyramid::add_tiles(std::size_t level, int r0, int c0, int r1,
+                             int c1, double sum[3]) const {
+  const Level &l = levels[level];
+  // Range of the next level, and its extent in tiles of this level
+  const int nr0 = tile_count(r0, 2);
+  const int nr1 = r1 == l.ny ? tile_count(l.ny, 2) : r1 / 2;
+  const int nc0 = tile_count(c0, 2);
+  const int nc1 = c1 == l.nx ? tile_count(l.nx, 2) : c1 / 2;
+  const int fr0 = std::min(2 * nr0, l.ny);
+  const int fr1 = std::min(2 * nr1, l.ny);
+  const int fc0 = std::min(2 * nc0, l.nx);
+  const int fc1 = std::min(2 * nc1, l.nx);
+
+  Rect parts[4];
+  int n = 0;
+  if (level + 1 < levels.size() && fr0 < fr1 && fc0 < fc1) {
+    add_tiles(level + 1, nr0, nc0, nr1, nc1, sum);
+    parts[n++] = {r0, c0, fr0, c1};
+    parts[n++] = {fr1, c0, r1, c1};
+    parts[n++] = {fr0, c0, fr1, fc0};
+    parts[n++] = {fr0, fc1, fr1, c1};
+  } else {
+    parts[n++] = {r0, c0, r1, c1};
+  }
+  for (int k = 0; k < n; k++) {
+    const Rect &p = parts[k];
+    for (int i = p.y0; i < p.y1; i++) {
+      const double *row = &l.sums[std::size_t(3) * l.nx * i];
+      for (int j = p.x0; j < p.x1; j++) {
+        sum[0] += row[3 * j + 0];
+        sum[1] += row[3 * j + 1];
+        sum[2] += row[3 * j + 2];
+      }
+    }
+  }
+}
+
+Result BlockPyramid::calculate(int y0, int x0, int y1, int x1) const {
+  return calculate_tiled(ny, nx, block, data, y0, x0, y1, x1,
+                         [this](int i0, int j0, int i1, int j1,
+                                double sum[3]) {
+                           add_tiles(0, i0, j0, i1, j1, sum);
+                         });
+}
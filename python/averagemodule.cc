@@ -0,0 +1,332 @@
+// Python extension module around calculate(), built with make python.
+//
+//   import average
+//   average.calculate(image, y0, x0, y1, x1) -> (r, g, b)
+//   average.calculate_many(image, rects) -> memoryview of shape (N, 3)
+//
+// image is any object with the buffer protocol of shape (ny, nx, channels):
+// float32 with any strides and at least 3 channels, or C-contiguous uint8 or
+// float16 with 3 channels, such as a NumPy array. It is read in place, and
+// the GIL is released while the averages are computed. rects is an (N, 4)
+// buffer of integers y0, x0, y1, x1. The result of calculate_many() can be
+// wrapped without copying, for example with numpy.asarray().
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <cstring>
+#include <stdexcept>
+#include <vector>
+
+#include "average.h"
+
+namespace {
+
+// A buffer obtained with PyObject_GetBuffer(), released with the object.
+// Its strides are in strides, also for a C-contiguous buffer that leaves
+// them out of view, as ctypes arrays do.
+class Buffer {
+public:
+  Buffer() { view.obj = nullptr; }
+  ~Buffer() {
+    if (view.obj != nullptr) {
+      PyBuffer_Release(&view);
+    }
+  }
+  Buffer(const Buffer &) = delete;
+  Buffer &operator=(const Buffer &) = delete;
+
+  bool get(PyObject *obj, int flags) {
+    if (PyObject_GetBuffer(obj, &view, flags) != 0) {
+      return false;
+    }
+    strides.assign(view.ndim, view.itemsize);
+    for (int i = view.ndim - 1; i >= 0; i--) {
+      if (view.strides != nullptr) {
+        strides[i] = view.strides[i];
+      } else if (i + 1 < view.ndim) {
+        strides[i] = strides[i + 1] * view.shape[i + 1];
+      }
+    }
+    return true;
+  }
+
+  Py_buffer view;
+  std::vector<Py_ssize_t> strides;
+};
+
+// Type code of a buffer format, without the byte order prefix, or 0 if the
+// format is not a single native-sized value.
+char format_code(const Py_buffer &view) {
+  const char *format = view.format != nullptr ? view.format : "B";
+  if (*format == '@' || *format == '=' || *format == '<') {
+    format++;
+  }
+  return std::strlen(format) == 1 ? format[0] : 0;
+}
+
+enum class PixelType { f32, u8, f16 };
+
+struct Image {
+  Buffer buffer;
+  PixelType type;
+  ImageView view;
+};
+
+// Set up image from a Python object, or raise an exception and return
+// false.
+bool get_image(PyObject *obj, Image &image) {
+  if (!image.buffer.get(obj, PyBUF_STRIDES | PyBUF_FORMAT)) {
+    return false;
+  }
+  const Py_buffer &view = image.buffer.view;
+  if (view.ndim != 3) {
+    PyErr_SetString(PyExc_ValueError, "image should have shape (ny, nx, 3)");
+    return false;
+  }
+  const char code = format_code(view);
+  if (code == 'f' && view.itemsize == 4) {
+    image.type = PixelType::f32;
+  } else if (code == 'B' && view.itemsize == 1) {
+    image.type = PixelType::u8;
+  } else if (code == 'e' && view.itemsize == 2) {
+    image.type = PixelType::f16;
+  } else {
+    PyErr_SetString(PyExc_TypeError,
+                    "image should be float32, uint8 or float16");
+    return false;
+  }
+  if (view.shape[0] < 1 || view.shape[1] < 1 || view.shape[2] < 3 ||
+      view.shape[0] > INT_MAX || view.shape[1] > INT_MAX ||
+      view.shape[2] > INT_MAX) {
+    PyErr_SetString(PyExc_ValueError,
+                    "image should have shape (ny, nx, channels) with at "
+                    "least 3 channels");
+    return false;
+  }
+  const std::vector<Py_ssize_t> &strides = image.buffer.strides;
+  for (int i = 0; i < 3; i++) {
+    if (strides[i] % view.itemsize != 0) {
+      PyErr_SetString(PyExc_ValueError,
+                      "image strides should be multiples of the item size");
+      return false;
+    }
+  }
+  const int ny = int(view.shape[0]);
+  const int nx = int(view.shape[1]);
+  const int channels = int(view.shape[2]);
+  image.view = {static_cast<const float *>(view.buf), ny, nx,
+                {channels, strides[2] / view.itemsize,
+                 strides[1] / view.itemsize, strides[0] / view.itemsize}};
+  if (image.type != PixelType::f32 &&
+      (channels != 3 || !PyBuffer_IsContiguous(&view, 'C'))) {
+    PyErr_SetString(PyExc_ValueError,
+                    "uint8 and float16 images should be C-contiguous with "
+                    "3 channels");
+    return false;
+  }
+  return true;
+}
+
+bool check_rect(const ImageView &image, const Rect &r) {
+  if (0 <= r.y0 && r.y0 < r.y1 && r.y1 <= image.ny && 0 <= r.x0 &&
+      r.x0 < r.x1 && r.x1 <= image.nx) {
+    return true;
+  }
+  PyErr_Format(PyExc_ValueError,
+               "rectangle (%d, %d, %d, %d) is not a non-empty part of the "
+               "%d x %d image",
+               r.y0, r.x0, r.y1, r.x1, image.ny, image.nx);
+  return false;
+}
+
+// Interleaved float32 rows without gaps, the layout of calculate().
+bool is_dense(const ImageView &image) {
+  const Layout &layout = image.layout;
+  return layout.channels == 3 && layout.channel_stride == 1 &&
+         layout.pixel_stride == 3 && layout.row_pitch == 3 * image.nx;
+}
+
+Result average(const Image &image, const Rect &r) {
+  const ImageView &view = image.view;
+  switch (image.type) {
+  case PixelType::u8:
+    return calculate(view.ny, view.nx,
+                     static_cast<const std::uint8_t *>(image.buffer.view.buf),
+                     r.y0, r.x0, r.y1, r.x1);
+  case PixelType::f16:
+    return calculate_half(
+        view.ny, view.nx,
+        static_cast<const std::uint16_t *>(image.buffer.view.buf), r.y0, r.x0,
+        r.y1, r.x1);
+  case PixelType::f32:
+    break;
+  }
+  return calculate(view, r.y0, r.x0, r.y1, r.x1);
+}
+
+PyObject *py_calculate(PyObject *, PyObject *args) {
+  PyObject *obj;
+  Rect r;
+  if (!PyArg_ParseTuple(args, "Oiiii:calculate", &obj, &r.y0, &r.x0, &r.y1,
+                        &r.x1)) {
+    return nullptr;
+  }
+  Image image;
+  if (!get_image(obj, image) || !check_rect(image.view, r)) {
+    return nullptr;
+  }
+  Result result;
+  Py_BEGIN_ALLOW_THREADS
+  result = average(image, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("(fff)", result.avg[0], result.avg[1], result.avg[2]);
+}
+
+// Read an (N, 4) buffer of integers into rects.
+bool get_rects(PyObject *obj, const ImageView &image,
+               std::vector<Rect> &rects) {
+  Buffer buffer;
+  if (!buffer.get(obj, PyBUF_STRIDES | PyBUF_FORMAT)) {
+    return false;
+  }
+  const Py_buffer &view = buffer.view;
+  const char code = format_code(view);
+  const bool is_int = code == 'b' || code == 'h' || code == 'i' ||
+                      code == 'l' || code == 'q';
+  if (!is_int || view.ndim != 2 || view.shape[1] != 4) {
+    PyErr_SetString(PyExc_ValueError,
+                    "rects should be an (N, 4) array of signed integers");
+    return false;
+  }
+  rects.resize(view.shape[0]);
+  const char *base = static_cast<const char *>(view.buf);
+  for (Py_ssize_t i = 0; i < view.shape[0]; i++) {
+    long long v[4];
+    for (int j = 0; j < 4; j++) {
+      const char *p = base + i * buffer.strides[0] + j * buffer.strides[1];
+      switch (view.itemsize) {
+      case 1:
+        v[j] = *reinterpret_cast<const std::int8_t *>(p);
+        break;
+      case 2:
+        v[j] = *reinterpret_cast<const std::int16_t *>(p);
+        break;
+      case 4:
+        v[j] = *reinterpret_cast<const std::int32_t *>(p);
+        break;
+      default:
+        v[j] = *reinterpret_cast<const std::int64_t *>(p);
+        break;
+      }
+      if (v[j] < INT_MIN || v[j] > INT_MAX) {
+        PyErr_SetString(PyExc_OverflowError, "rectangle out of range");
+        return false;
+      }
+    }
+    rects[i] = {int(v[0]), int(v[1]), int(v[2]), int(v[3])};
+    if (!check_rect(image, rects[i])) {
+      return false;
+    }
+  }
+  return true;
+}
+
+// An empty (0, 3) float32 memoryview. memoryview.cast() does not accept
+// shapes with a zero, so it is made from a buffer of static storage.
+PyObject *empty_results() {
+  static float none[3];
+  static char format[] = "f";
+  static Py_ssize_t shape[2] = {0, 3};
+  static Py_ssize_t strides[2] = {3 * sizeof(float), sizeof(float)};
+  Py_buffer view = {};
+  view.buf = none;
+  view.len = 0;
+  view.itemsize = sizeof(float);
+  view.readonly = 1;
+  view.ndim = 2;
+  view.format = format;
+  view.shape = shape;
+  view.strides = strides;
+  return PyMemoryView_FromBuffer(&view);
+}
+
+PyObject *py_calculate_many(PyObject *, PyObject *args) {
+  PyObject *obj;
+  PyObject *rects_obj;
+  if (!PyArg_ParseTuple(args, "OO:calculate_many", &obj, &rects_obj)) {
+    return nullptr;
+  }
+  Image image;
+  std::vector<Rect> rects;
+  if (!get_image(obj, image) || !get_rects(rects_obj, image.view, rects)) {
+    return nullptr;
+  }
+  const Py_ssize_t n = Py_ssize_t(rects.size());
+  if (n == 0) {
+    return empty_results();
+  }
+  PyObject *bytes = PyByteArray_FromStringAndSize(nullptr, n * sizeof(Result));
+  if (bytes == nullptr) {
+    return nullptr;
+  }
+  static_assert(sizeof(Result) == 3 * sizeof(float), "Result is padded");
+  Result *results = reinterpret_cast<Result *>(PyByteArray_AS_STRING(bytes));
+  Py_BEGIN_ALLOW_THREADS
+  if (image.type == PixelType::f32 && is_dense(image.view)) {
+    calculate_batch(image.view.ny, image.view.nx, image.view.data, int(n),
+                    rects.data(), results);
+  } else {
+    for (Py_ssize_t i = 0; i < n; i++) {
+      results[i] = average(image, rects[i]);
+    }
+  }
+  Py_END_ALLOW_THREADS
+  PyObject *flat = PyMemoryView_FromObject(bytes);
+  Py_DECREF(bytes);
+  if (flat == nullptr) {
+    return nullptr;
+  }
+  PyObject *shaped = PyObject_CallMethod(flat, "cast", "s(nn)", "f", n,
+                                         Py_ssize_t(3));
+  Py_DECREF(flat);
+  return shaped;
+}
+
+PyMethodDef methods[] = {
+    {"calculate", py_calculate, METH_VARARGS,
+     "calculate(image, y0, x0, y1, x1) -> (r, g, b)\n\n"
+     "Average color of the rectangle [y0, y1) x [x0, x1) of an (ny, nx, 3)\n"
+     "image."},
+    {"calculate_many", py_calculate_many, METH_VARARGS,
+     "calculate_many(image, rects) -> memoryview\n\n"
+     "Average colors of the rectangles in an (N, 4) array of y0, x0, y1, x1,\n"
+     "as an (N, 3) float32 memoryview."},
+    {nullptr, nullptr, 0, nullptr},
+};
+
+PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    "average",
+    "Average color of rectangles of RGB images.",
+    -1,
+    methods,
+    nullptr,
+    nullptr,
+    nullptr,
+    nullptr,
+};
+
+} // namespace
+
+PyMODINIT_FUNC PyInit_average() {
+  try {
+    default_kernel();
+    thread_count();
+    simd_target();
+  } catch (const std::invalid_argument &e) {
+    PyErr_SetString(PyExc_ValueError, e.what());
+    return nullptr;
+  }
+  return PyModule_Create(&module);
+}
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# Smoke test of the average module, run by make python:
+#
+#   python3 python/check_average.py <directory of average.so>
+#
+# Images and rectangles are made with array, memoryview and ctypes, so that
+# NumPy is not needed.
+
+import array
+import ctypes
+import random
+import sys
+
+sys.path.insert(0, sys.argv[1] if len(sys.argv) > 1 else '.')
+
+import average
+
+NY, NX = 7, 5
+TOLERANCE = 1e-5
+
+
+def image(values, code, channels):
+    return memoryview(array.array(code, values)).cast('B').cast(code, (NY, NX, channels))
+
+
+def expected(values, channels, y0, x0, y1, x1):
+    sums = [0.0, 0.0, 0.0]
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            for c in range(3):
+                sums[c] += values[c + channels * (x + NX * y)]
+    area = (y1 - y0) * (x1 - x0)
+    return [s / area for s in sums]
+
+
+def check(name, got, want):
+    for g, w in zip(got, want):
+        if abs(g - w) > TOLERANCE * max(1.0, abs(w)):
+            sys.exit("{}: got {}, expected {}".format(name, list(got), want))
+
+
+def main():
+    rng = random.Random(1)
+    rgb = [rng.random() for _ in range(NY * NX * 3)]
+    rgba = [rng.random() for _ in range(NY * NX * 4)]
+    u8 = [rng.randrange(256) for _ in range(NY * NX * 3)]
+    rects = [(0, 0, NY, NX), (1, 2, 3, 4), (6, 4, 7, 5), (2, 0, 5, 3)]
+
+    for r in rects:
+        check("float32", average.calculate(image(rgb, 'f', 3), *r), expected(rgb, 3, *r))
+        check("rgba", average.calculate(image(rgba, 'f', 4), *r), expected(rgba, 4, *r))
+        check("uint8", average.calculate(image(u8, 'B', 3), *r), expected(u8, 3, *r))
+        # ctypes arrays leave out the strides of their buffers
+        check("ctypes", average.calculate((ctypes.c_float * 3 * NX * NY).from_buffer(array.array('f', rgb)), *r),
+              expected(rgb, 3, *r))
+
+    # calculate_many() with int64 and int32 rectangles
+    for ctype in [ctypes.c_int64, ctypes.c_int32]:
+        buffer = (ctype * 4 * len(rects))(*[(ctype * 4)(*r) for r in rects])
+        results = average.calculate_many(image(rgb, 'f', 3), buffer)
+        if results.shape != (len(rects), 3) or results.format != 'f':
+            sys.exit("calculate_many: shape {} and format {}".format(results.shape, results.format))
+        for r, got in zip(rects, results.tolist()):
+            check("calculate_many", got, expected(rgb, 3, *r))
+
+    empty = average.calculate_many(image(rgb, 'f', 3), (ctypes.c_int64 * 4 * 0)())
+    if empty.shape != (0, 3) or empty.tolist() != []:
+        sys.exit("calculate_many: shape {} for no rectangles".format(empty.shape))
+
+    for r in [(0, 0, 0, 1), (0, 0, NY + 1, 1), (-1, 0, 1, 1)]:
+        try:
+            average.calculate(image(rgb, 'f', 3), *r)
+        except ValueError:
+            continue
+        sys.exit("calculate: no error for rectangle {}".format(r))
+
+    print("average module OK")
+
+
+main()
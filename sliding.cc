@@ -0,0 +1,61 @@
+#include "average.h"
+
+#include <cstddef>
+#include <cstdlib>
+
+SlidingWindow::SlidingWindow(int ny, int nx, const float *data, int y0,
+                             int x0, int height, int width)
+    : ny(ny), nx(nx), data(data), y0(y0), x0(x0), height(height),
+      width(width) {
+  reset();
+}
+
+void SlidingWindow::add(int ya, int xa, int yb, int xb, double sign) {
+  double part[3] = {0.0, 0.0, 0.0};
+  for (int y = ya; y < yb; y++) {
+    const float *row = data + std::size_t(3) * nx * y;
+    for (int x = xa; x < xb; x++) {
+      part[0] += row[3 * x + 0];
+      part[1] += row[3 * x + 1];
+      part[2] += row[3 * x + 2];
+    }
+  }
+  sum[0] += sign * part[0];
+  sum[1] += sign * part[1];
+  sum[2] += sign * part[2];
+}
+
+void SlidingWindow::reset() {
+  sum[0] = sum[1] = sum[2] = 0.0;
+  add(y0, x0, y0 + height, x0 + width, 1.0);
+}
+
+void SlidingWindow::move(int dy, int dx) {
+  if (std::abs(dy) >= height || std::abs(dx) >= width) {
+    y0 += dy;
+    x0 += dx;
+    reset();
+    return;
+  }
+  if (dx > 0) {
+    add(y0, x0, y0 + height, x0 + dx, -1.0);
+    add(y0, x0 + width, y0 + height, x0 + width + dx, 1.0);
+  } else if (dx < 0) {
+    add(y0, x0 + width + dx, y0 + height, x0 + width, -1.0);
+    add(y0, x0 + dx, y0 + height, x0, 1.0);
+  }
+  x0 += dx;
+  if (dy > 0) {
+    add(y0, x0, y0 + dy, x0 + width, -1.0);
+    add(y0 + height, x0, y0 + height + dy, x0 + width, 1.0);
+  } else if (dy < 0) {
+    add(y0 + height + dy, x0, y0 + height, x0 + width, -1.0);
+    add(y0 + dy, x0, y0, x0 + width, 1.0);
+  }
+  y0 += dy;
+}
+
+Result SlidingWindow::average() const {
+  const double area = double(height) * double(width);
+  return {{float(sum[0] / area), float(sum[1] / area), float(sum[2] / area)}};
+}
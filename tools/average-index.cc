@@ -0,0 +1,94 @@
+// Build and inspect index files (see index.h) of raw image files.
+//
+//   average-index build <image> <ny> <nx> <index> [<block>]
+//   average-index info <index>
+//   average-index verify <index> <image>
+//   average-index query <index> <y0> <x0> <y1> <x1> [<image>]
+
+#include <cstdlib>
+#include <iomanip>
+#include <iostream>
+#include <memory>
+#include <stdexcept>
+#include <string>
+
+#include "average.h"
+#include "image.h"
+#include "index.h"
+
+static const char USAGE[] =
+    "Usage:\n"
+    "  average-index build <image> <ny> <nx> <index> [<block>]\n"
+    "  average-index info <index>\n"
+    "  average-index verify <index> <image>\n"
+    "  average-index query <index> <y0> <x0> <y1> <x1> [<image>]\n"
+    "\n"
+    "The image is needed by queries that are not aligned to the blocks of\n"
+    "an index built with block > 1.\n";
+
+[[noreturn]] static void error(const std::string &msg) {
+  std::cerr << msg;
+  if (!msg.empty() && msg.back() != '\n') {
+    std::cerr << '\n';
+  }
+  std::cerr << std::flush;
+  std::exit(EXIT_FAILURE);
+}
+
+static void print_info(const IndexFile &index) {
+  std::cout << "ny " << index.ny() << "\nnx " << index.nx() << "\nblock "
+            << index.block() << "\nchecksum " << std::hex << std::setw(16)
+            << std::setfill('0') << index.checksum() << std::dec << '\n';
+}
+
+static int run(int argc, const char **argv) {
+  const std::string command = argc >= 2 ? argv[1] : "";
+  if (command == "build" && (argc == 6 || argc == 7)) {
+    const int ny = std::stoi(argv[3]);
+    const int nx = std::stoi(argv[4]);
+    const int block = argc == 7 ? std::stoi(argv[6]) : 1;
+    const MappedImage image(argv[2], ny, nx);
+    write_index(argv[5], ny, nx, image.data(), block);
+  } else if (command == "info" && argc == 3) {
+    print_info(IndexFile(argv[2]));
+  } else if (command == "verify" && argc == 4) {
+    const IndexFile index(argv[2]);
+    const MappedImage image(argv[3], index.ny(), index.nx());
+    if (image_checksum(index.ny(), index.nx(), image.data()) !=
+        index.checksum()) {
+      error(std::string(argv[2]) + " is not an index of " + argv[3]);
+    }
+  } else if (command == "query" && (argc == 7 || argc == 8)) {
+    const IndexFile index(argv[2]);
+    const Rect r = {std::stoi(argv[3]), std::stoi(argv[4]), std::stoi(argv[5]),
+                    std::stoi(argv[6])};
+    if (r.y0 < 0 || r.y0 >= r.y1 || r.y1 > index.ny() || r.x0 < 0 ||
+        r.x0 >= r.x1 || r.x1 > index.nx()) {
+      error("rectangle outside the image");
+    }
+    std::unique_ptr<MappedImage> image;
+    if (argc == 8) {
+      image.reset(new MappedImage(argv[7], index.ny(), index.nx()));
+    }
+    const Result result =
+        index.calculate(r.y0, r.x0, r.y1, r.x1,
+                        image != nullptr ? image->data() : nullptr);
+    std::cout << std::setprecision(9) << result.avg[0] << ' ' << result.avg[1]
+              << ' ' << result.avg[2] << '\n';
+  } else {
+    error(USAGE);
+  }
+  return EXIT_SUCCESS;
+}
+
+int main(int argc, const char **argv) {
+  try {
+    return run(argc, argv);
+  } catch (const std::logic_error &e) {
+    // std::invalid_argument and std::out_of_range, from the library or from
+    // std::stoi
+    error(e.what());
+  } catch (const std::runtime_error &e) {
+    error(e.what());
+  }
+}
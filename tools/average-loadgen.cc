@@ -0,0 +1,308 @@
+// Load generator for average-server: loads one image into a server
+// listening on a Unix socket, sends it queries from several connections at
+// once and reports the throughput and the latency distribution.
+//
+//   average-loadgen <socket> <image> <ny> <nx> [options]
+//
+// Each connection sends --requests queries of --rects rectangles each and
+// keeps up to --pipeline of them waiting for an answer. Rectangles are
+// --size pixels square at random positions, or of random size with size 0.
+// The latency of a query is the time from sending it until its response has
+// been read.
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <chrono>
+#include <cstdlib>
+#include <cstring>
+#include <iomanip>
+#include <iostream>
+#include <random>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+#include <thread>
+#include <vector>
+
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <unistd.h>
+
+#include "json.h"
+
+using Clock = std::chrono::steady_clock;
+
+static const char USAGE[] =
+    "Usage:\n"
+    "  average-loadgen <socket> <image> <ny> <nx> [options]\n"
+    "\n"
+    "Options:\n"
+    "  --connections <n>  concurrent connections (default 4)\n"
+    "  --requests <n>     queries per connection (default 1000)\n"
+    "  --pipeline <n>     queries in flight per connection (default 1)\n"
+    "  --rects <n>        rectangles per query (default 1)\n"
+    "  --size <n>         side of the rectangles, 0 for random (default 0)\n"
+    "  --index <kind>     pyramid, integral or none (default pyramid)\n"
+    "  --block <n>        block size of the pyramid (default 16)\n";
+
+[[noreturn]] static void error(const std::string &msg) {
+  std::cerr << msg;
+  if (!msg.empty() && msg.back() != '\n') {
+    std::cerr << '\n';
+  }
+  std::cerr << std::flush;
+  std::exit(EXIT_FAILURE);
+}
+
+// A connection to the server, sending and receiving whole lines.
+class Client {
+public:
+  explicit Client(const std::string &path)
+      : fd(socket(AF_UNIX, SOCK_STREAM, 0)) {
+    sockaddr_un address = {};
+    address.sun_family = AF_UNIX;
+    if (path.size() >= sizeof(address.sun_path)) {
+      error("socket path too long: " + path);
+    }
+    std::strcpy(address.sun_path, path.c_str());
+    if (fd < 0 || connect(fd, reinterpret_cast<sockaddr *>(&address),
+                          sizeof(address)) != 0) {
+      error("cannot connect to " + path + ": " + std::strerror(errno));
+    }
+  }
+  ~Client() { close(fd); }
+  Client(const Client &) = delete;
+  Client &operator=(const Client &) = delete;
+
+  void send(const std::string &line) {
+    const std::string text = line + '\n';
+    const char *p = text.data();
+    std::size_t left = text.size();
+    while (left > 0) {
+      const ssize_t n = write(fd, p, left);
+      if (n < 0 && errno == EINTR) {
+        continue;
+      }
+      if (n <= 0) {
+        error(std::string("cannot send: ") + std::strerror(errno));
+      }
+      p += n;
+      left -= n;
+    }
+  }
+
+  std::string receive() {
+    while (true) {
+      const std::size_t end = buffer.find('\n');
+      if (end != std::string::npos) {
+        std::string line = buffer.substr(0, end);
+        buffer.erase(0, end + 1);
+        return line;
+      }
+      char chunk[65536];
+      const ssize_t n = read(fd, chunk, sizeof(chunk));
+      if (n < 0 && errno == EINTR) {
+        continue;
+      }
+      if (n <= 0) {
+        error("connection closed by the server");
+      }
+      buffer.append(chunk, n);
+    }
+  }
+
+  // Send a request and return its response, for requests that are
+  // answered in order.
+  Json call(const std::string &request) {
+    send(request);
+    Json response = JsonParser::parse(receive());
+    const Json *ok = response.find("ok");
+    if (ok == nullptr || !ok->boolean) {
+      const Json *message = response.find("error");
+      error("request failed: " +
+            (message != nullptr ? message->string : request));
+    }
+    return response;
+  }
+
+private:
+  int fd;
+  std::string buffer;
+};
+
+struct Options {
+  std::string socket;
+  std::string image;
+  int ny;
+  int nx;
+  int connections = 4;
+  int requests = 1000;
+  int pipeline = 1;
+  int rects = 1;
+  int size = 0;
+  std::string index = "pyramid";
+  int block = 16;
+};
+
+static std::string random_query(std::mt19937 &rng, const Options &options,
+                                long long id) {
+  std::ostringstream query;
+  query << "{\"id\": " << id << ", \"op\": \"query\", \"name\": \"loadgen\", "
+        << "\"rects\": [";
+  for (int i = 0; i < options.rects; i++) {
+    int r[4];
+    const int n[2] = {options.ny, options.nx};
+    for (int d = 0; d < 2; d++) {
+      const int s = std::min(options.size, n[d]);
+      if (s > 0) {
+        r[d] = std::uniform_int_distribution<int>(0, n[d] - s)(rng);
+        r[d + 2] = r[d] + s;
+      } else {
+        int a = std::uniform_int_distribution<int>(0, n[d] - 1)(rng);
+        int b = std::uniform_int_distribution<int>(0, n[d] - 1)(rng);
+        r[d] = std::min(a, b);
+        r[d + 2] = std::max(a, b) + 1;
+      }
+    }
+    query << (i > 0 ? ", " : "") << '[' << r[0] << ", " << r[1] << ", "
+          << r[2] << ", " << r[3] << ']';
+  }
+  query << "]}";
+  return query.str();
+}
+
+// Send the queries of one connection, writing the latency of each query in
+// seconds to latencies.
+static void run_connection(const Options &options, int connection,
+                           std::vector<double> &latencies,
+                           std::atomic<long long> &failures) {
+  Client client(options.socket);
+  std::mt19937 rng(connection + 1);
+  std::vector<Clock::time_point> sent(options.requests);
+  latencies.assign(options.requests, 0.0);
+  int next = 0;
+  for (int received = 0; received < options.requests; received++) {
+    while (next < options.requests && next - received < options.pipeline) {
+      const std::string query = random_query(rng, options, next);
+      sent[next] = Clock::now();
+      client.send(query);
+      next++;
+    }
+    const std::string line = client.receive();
+    const Clock::time_point now = Clock::now();
+    const Json response = JsonParser::parse(line);
+    const Json *id = response.find("id");
+    const Json *ok = response.find("ok");
+    if (id == nullptr || id->type != Json::Type::number || id->number < 0 ||
+        id->number >= options.requests) {
+      error("unexpected response: " + line);
+    }
+    const int i = int(id->number);
+    latencies[i] = std::chrono::duration<double>(now - sent[i]).count();
+    if (ok == nullptr || !ok->boolean) {
+      failures++;
+    }
+  }
+}
+
+// Latency at quantile q of the sorted latencies, in milliseconds.
+static double percentile(const std::vector<double> &sorted, double q) {
+  const std::size_t i = std::min(sorted.size() - 1,
+                                 std::size_t(q * sorted.size()));
+  return sorted[i] * 1e3;
+}
+
+int main(int argc, const char **argv) {
+  if (argc < 5 || argc % 2 == 0) {
+    error(USAGE);
+  }
+  Options options;
+  try {
+    options.socket = argv[1];
+    options.image = argv[2];
+    options.ny = std::stoi(argv[3]);
+    options.nx = std::stoi(argv[4]);
+    for (int i = 5; i < argc; i += 2) {
+      const std::string option = argv[i];
+      const std::string value = argv[i + 1];
+      if (option == "--connections") {
+        options.connections = std::stoi(value);
+      } else if (option == "--requests") {
+        options.requests = std::stoi(value);
+      } else if (option == "--pipeline") {
+        options.pipeline = std::stoi(value);
+      } else if (option == "--rects") {
+        options.rects = std::stoi(value);
+      } else if (option == "--size") {
+        options.size = std::stoi(value);
+      } else if (option == "--index") {
+        options.index = value;
+      } else if (option == "--block") {
+        options.block = std::stoi(value);
+      } else {
+        error(USAGE);
+      }
+    }
+  } catch (const std::logic_error &e) {
+    error(e.what());
+  }
+  if (options.ny < 1 || options.nx < 1 || options.connections < 1 ||
+      options.requests < 1 || options.pipeline < 1 || options.rects < 1 ||
+      options.size < 0) {
+    error("ny, nx, --connections, --requests, --pipeline and --rects should "
+          "be positive");
+  }
+
+  Client control(options.socket);
+  Json path;
+  path.type = Json::Type::string;
+  path.string = options.image;
+  std::string load = "{\"op\": \"load\", \"name\": \"loadgen\", \"path\": ";
+  write_json(load, path);
+  load += ", \"ny\": " + std::to_string(options.ny) +
+          ", \"nx\": " + std::to_string(options.nx) + ", \"index\": \"" +
+          options.index + "\", \"block\": " + std::to_string(options.block) +
+          "}";
+  const auto load_start = Clock::now();
+  control.call(load);
+  const double load_seconds =
+      std::chrono::duration<double>(Clock::now() - load_start).count();
+
+  std::vector<std::vector<double>> latencies(options.connections);
+  std::atomic<long long> failures{0};
+  const auto start = Clock::now();
+  std::vector<std::thread> threads;
+  for (int c = 0; c < options.connections; c++) {
+    threads.emplace_back([&, c] {
+      run_connection(options, c, latencies[c], failures);
+    });
+  }
+  for (std::thread &thread : threads) {
+    thread.join();
+  }
+  const double seconds =
+      std::chrono::duration<double>(Clock::now() - start).count();
+
+  std::vector<double> all;
+  for (const std::vector<double> &l : latencies) {
+    all.insert(all.end(), l.begin(), l.end());
+  }
+  std::sort(all.begin(), all.end());
+  std::string stats;
+  write_json(stats, control.call("{\"op\": \"stats\"}"));
+  control.call("{\"op\": \"drop\", \"name\": \"loadgen\"}");
+
+  std::cout << std::fixed << std::setprecision(3);
+  std::cout << "load\t" << load_seconds * 1e3 << " ms\n";
+  std::cout << "queries\t" << all.size() << " (" << failures << " failed)\n";
+  std::cout << "throughput\t" << std::setprecision(0)
+            << all.size() / seconds << " queries/s\t"
+            << double(all.size()) * options.rects / seconds << " rects/s\n";
+  std::cout << std::setprecision(3) << "latency ms\tp50 "
+            << percentile(all, 0.5) << "\tp90 " << percentile(all, 0.9)
+            << "\tp99 " << percentile(all, 0.99) << "\tp99.9 "
+            << percentile(all, 0.999) << "\tmax " << all.back() * 1e3 << '\n';
+  std::cout << "server\t" << stats << std::endl;
+  return failures == 0 ? EXIT_SUCCESS : EXIT_FAILURE;
+}
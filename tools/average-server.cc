@@ -0,0 +1,666 @@
+// Long-running server that answers average color queries about raw image
+// files (see image.h), so that images and their indexes are loaded once and
+// reused by many requests.
+//
+//   average-server [--socket <path>] [--workers <n>] [--cache-mb <mb>]
+//
+// Requests and responses are JSON objects, one per line, read from stdin
+// and written to stdout, or exchanged over connections to a Unix socket
+// with --socket. Every response has "ok" and echoes the "id" of its
+// request, null if it has none; failed requests get an "error" message.
+//
+//   {"op": "load", "name": N, "path": P, "ny": NY, "nx": NX,
+//    "index": "pyramid" | "integral" | "none", "block": B}
+//     Register the raw image file P under the name N, replacing any image
+//     of that name, and load it. The index defaults to a BlockPyramid with
+//     block 16. Answers "bytes", the memory the image takes in the cache.
+//   {"op": "query", "name": N, "rects": [[y0, x0, y1, x1], ...]}
+//     Answers "avg": [[r, g, b], ...], one per rectangle.
+//   {"op": "drop", "name": N}
+//   {"op": "stats"}
+//     Answers counters of the cache and of the workers.
+//
+// Queries run on a fixed pool of worker threads, and responses to them may
+// arrive in a different order than the requests; the other requests are
+// answered in order by the thread reading the connection. A worker takes
+// all waiting queries about the same image at once and answers them with a
+// single lookup in the cache. Loaded images and their indexes are kept in
+// a least recently used cache within a memory budget; an image that has
+// been evicted is loaded again by the next query that needs it.
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <climits>
+#include <condition_variable>
+#include <csignal>
+#include <cstdlib>
+#include <cstring>
+#include <deque>
+#include <iostream>
+#include <list>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <stdexcept>
+#include <string>
+#include <thread>
+#include <unordered_map>
+#include <vector>
+
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <unistd.h>
+
+#include "average.h"
+#include "image.h"
+#include "json.h"
+
+// Largest number of rectangles a worker answers in one batch.
+static constexpr std::size_t MAX_BATCH_RECTS = 1 << 16;
+
+static const char USAGE[] =
+    "Usage:\n"
+    "  average-server [--socket <path>] [--workers <n>] [--cache-mb <mb>]\n";
+
+[[noreturn]] static void error(const std::string &msg) {
+  std::cerr << msg;
+  if (!msg.empty() && msg.back() != '\n') {
+    std::cerr << '\n';
+  }
+  std::cerr << std::flush;
+  std::exit(EXIT_FAILURE);
+}
+
+static Json number(double value) {
+  Json v;
+  v.type = Json::Type::number;
+  v.number = value;
+  return v;
+}
+
+static Json boolean(bool value) {
+  Json v;
+  v.type = Json::Type::boolean;
+  v.boolean = value;
+  return v;
+}
+
+static Json string(const std::string &value) {
+  Json v;
+  v.type = Json::Type::string;
+  v.string = value;
+  return v;
+}
+
+// A client: lines are read from in and responses written to out, which are
+// the same socket for socket connections.
+class Connection {
+public:
+  Connection(int in, int out, bool owned) : in(in), out(out), owned(owned) {}
+  ~Connection() {
+    if (owned) {
+      close(in);
+    }
+  }
+  Connection(const Connection &) = delete;
+  Connection &operator=(const Connection &) = delete;
+
+  // Next line without the newline, false at the end of the input.
+  bool read_line(std::string &line) {
+    while (true) {
+      const std::size_t end = buffer.find('\n');
+      if (end != std::string::npos) {
+        line = buffer.substr(0, end);
+        buffer.erase(0, end + 1);
+        return true;
+      }
+      char chunk[65536];
+      const ssize_t n = read(in, chunk, sizeof(chunk));
+      if (n < 0 && errno == EINTR) {
+        continue;
+      }
+      if (n <= 0) {
+        line = std::move(buffer);
+        buffer.clear();
+        return !line.empty();
+      }
+      buffer.append(chunk, n);
+    }
+  }
+
+  // Write one response line. Responses of a client that has gone away are
+  // dropped.
+  void send(const Json &response) {
+    std::string line;
+    write_json(line, response);
+    line += '\n';
+    std::lock_guard<std::mutex> lock(write_mutex);
+    const char *p = line.data();
+    std::size_t left = line.size();
+    while (left > 0) {
+      const ssize_t n = write(out, p, left);
+      if (n < 0 && errno == EINTR) {
+        continue;
+      }
+      if (n <= 0) {
+        return;
+      }
+      p += n;
+      left -= n;
+    }
+  }
+
+private:
+  int in;
+  int out;
+  bool owned;
+  std::string buffer;
+  std::mutex write_mutex;
+};
+
+enum class IndexKind { none, integral, pyramid };
+
+// A registered image: where to load it from and which index to build.
+struct Source {
+  std::string name;
+  std::string path;
+  int ny;
+  int nx;
+  IndexKind index;
+  int block;
+  // Held while the image is loaded, so that it is only loaded once
+  std::mutex load_mutex;
+};
+
+// An image in memory with its index.
+struct Loaded {
+  explicit Loaded(const Source &source)
+      : image(source.path, source.ny, source.nx), ny(source.ny),
+        nx(source.nx) {
+    switch (source.index) {
+    case IndexKind::none:
+      break;
+    case IndexKind::integral:
+      table.reset(new IntegralImage(ny, nx, image.data()));
+      break;
+    case IndexKind::pyramid:
+      pyramid.reset(new BlockPyramid(ny, nx, image.data(), source.block));
+      break;
+    }
+    bytes = std::size_t(3) * ny * nx * sizeof(float);
+    bytes += table != nullptr ? table->memory() : 0;
+    bytes += pyramid != nullptr ? pyramid->memory() : 0;
+  }
+
+  // Averages of n rectangles.
+  void calculate(int n, const Rect *rects, Result *results) const {
+    if (table != nullptr || pyramid != nullptr) {
+      for (int i = 0; i < n; i++) {
+        const Rect &r = rects[i];
+        results[i] = table != nullptr
+                         ? table->calculate(r.y0, r.x0, r.y1, r.x1)
+                         : pyramid->calculate(r.y0, r.x0, r.y1, r.x1);
+      }
+    } else {
+      calculate_batch(ny, nx, image.data(), n, rects, results);
+    }
+  }
+
+  MappedImage image;
+  int ny;
+  int nx;
+  std::unique_ptr<IntegralImage> table;
+  std::unique_ptr<BlockPyramid> pyramid;
+  std::size_t bytes;
+};
+
+// Least recently used cache of loaded images, within a budget of bytes.
+// The most recently used image is always kept, even if it alone is over
+// the budget. Evicted images stay alive while a worker is still using them.
+class ImageCache {
+public:
+  explicit ImageCache(std::size_t budget) : budget(budget) {}
+
+  std::shared_ptr<const Loaded> get(const std::shared_ptr<Source> &source) {
+    if (std::shared_ptr<const Loaded> loaded = lookup(source.get())) {
+      return loaded;
+    }
+    std::lock_guard<std::mutex> load_lock(source->load_mutex);
+    // Another worker may have loaded it in the meantime
+    if (std::shared_ptr<const Loaded> loaded = lookup(source.get())) {
+      return loaded;
+    }
+    std::shared_ptr<const Loaded> loaded(new Loaded(*source));
+    std::lock_guard<std::mutex> lock(mutex);
+    misses++;
+    lru.emplace_front(source, loaded);
+    entries[source.get()] = lru.begin();
+    bytes += loaded->bytes;
+    while (bytes > budget && lru.size() > 1) {
+      bytes -= lru.back().second->bytes;
+      entries.erase(lru.back().first.get());
+      lru.pop_back();
+      evictions++;
+    }
+    return loaded;
+  }
+
+  void drop(const Source *source) {
+    std::lock_guard<std::mutex> lock(mutex);
+    const auto it = entries.find(source);
+    if (it != entries.end()) {
+      bytes -= it->second->second->bytes;
+      lru.erase(it->second);
+      entries.erase(it);
+    }
+  }
+
+  void add_stats(Json &stats) {
+    std::lock_guard<std::mutex> lock(mutex);
+    stats.fields.emplace_back("cached", number(double(lru.size())));
+    stats.fields.emplace_back("cached_bytes", number(double(bytes)));
+    stats.fields.emplace_back("budget_bytes", number(double(budget)));
+    stats.fields.emplace_back("hits", number(double(hits)));
+    stats.fields.emplace_back("misses", number(double(misses)));
+    stats.fields.emplace_back("evictions", number(double(evictions)));
+  }
+
+private:
+  // The source is held so that its address, the key, is not reused by
+  // another source while the entry exists
+  using Entry =
+      std::pair<std::shared_ptr<Source>, std::shared_ptr<const Loaded>>;
+
+  std::shared_ptr<const Loaded> lookup(const Source *source) {
+    std::lock_guard<std::mutex> lock(mutex);
+    const auto it = entries.find(source);
+    if (it == entries.end()) {
+      return nullptr;
+    }
+    lru.splice(lru.begin(), lru, it->second);
+    hits++;
+    return lru.front().second;
+  }
+
+  std::mutex mutex;
+  std::size_t budget;
+  std::size_t bytes = 0;
+  // Most recently used first
+  std::list<Entry> lru;
+  std::unordered_map<const Source *, std::list<Entry>::iterator> entries;
+  long long hits = 0;
+  long long misses = 0;
+  long long evictions = 0;
+};
+
+// A query waiting for a worker.
+struct Job {
+  std::shared_ptr<Connection> connection;
+  Json id;
+  std::shared_ptr<Source> source;
+  std::vector<Rect> rects;
+};
+
+class WorkerPool {
+public:
+  WorkerPool(int workers, ImageCache &cache) : cache(cache) {
+    for (int i = 0; i < workers; i++) {
+      threads.emplace_back([this] { run(); });
+    }
+  }
+
+  // Answers every job submitted so far before returning.
+  ~WorkerPool() {
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      stopping = true;
+    }
+    waiting.notify_all();
+    for (std::thread &thread : threads) {
+      thread.join();
+    }
+  }
+
+  void submit(Job job) {
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      queue.push_back(std::move(job));
+    }
+    waiting.notify_one();
+  }
+
+  void add_stats(Json &stats) {
+    stats.fields.emplace_back("workers", number(double(threads.size())));
+    stats.fields.emplace_back("queries", number(double(queries)));
+    stats.fields.emplace_back("batches", number(double(batches)));
+  }
+
+private:
+  // Take the first job and every other waiting job about the same image.
+  std::vector<Job> take_batch() {
+    std::vector<Job> batch;
+    batch.push_back(std::move(queue.front()));
+    queue.pop_front();
+    std::size_t rects = batch[0].rects.size();
+    for (auto it = queue.begin();
+         it != queue.end() && rects < MAX_BATCH_RECTS;) {
+      if (it->source == batch[0].source) {
+        rects += it->rects.size();
+        batch.push_back(std::move(*it));
+        it = queue.erase(it);
+      } else {
+        ++it;
+      }
+    }
+    return batch;
+  }
+
+  void run() {
+    // The workers are the parallelism; each sums on its own thread only
+    set_thread_limit(1);
+    while (true) {
+      std::vector<Job> batch;
+      {
+        std::unique_lock<std::mutex> lock(mutex);
+        waiting.wait(lock, [this] { return stopping || !queue.empty(); });
+        if (queue.empty()) {
+          return;
+        }
+        batch = take_batch();
+      }
+      answer(batch);
+    }
+  }
+
+  void answer(std::vector<Job> &batch) {
+    std::vector<Rect> rects;
+    for (const Job &job : batch) {
+      rects.insert(rects.end(), job.rects.begin(), job.rects.end());
+    }
+    std::vector<Result> results(rects.size());
+    std::string failure;
+    try {
+      const std::shared_ptr<const Loaded> loaded = cache.get(batch[0].source);
+      loaded->calculate(int(rects.size()), rects.data(), results.data());
+    } catch (const std::exception &e) {
+      failure = e.what();
+    }
+    queries += batch.size();
+    batches++;
+    std::size_t next = 0;
+    for (const Job &job : batch) {
+      Json response;
+      response.type = Json::Type::object;
+      response.fields.emplace_back("id", job.id);
+      response.fields.emplace_back("ok", boolean(failure.empty()));
+      if (failure.empty()) {
+        Json avg;
+        avg.type = Json::Type::array;
+        for (std::size_t i = 0; i < job.rects.size(); i++) {
+          Json color;
+          color.type = Json::Type::array;
+          for (int c = 0; c < 3; c++) {
+            color.items.push_back(number(results[next + i].avg[c]));
+          }
+          avg.items.push_back(std::move(color));
+        }
+        response.fields.emplace_back("avg", std::move(avg));
+      } else {
+        response.fields.emplace_back("error", string(failure));
+      }
+      next += job.rects.size();
+      job.connection->send(response);
+    }
+  }
+
+  ImageCache &cache;
+  std::mutex mutex;
+  std::condition_variable waiting;
+  std::deque<Job> queue;
+  bool stopping = false;
+  std::atomic<long long> queries{0};
+  std::atomic<long long> batches{0};
+  std::vector<std::thread> threads;
+};
+
+class Server {
+public:
+  Server(int workers, std::size_t budget)
+      : cache(budget), pool(workers, cache) {}
+
+  // Answer the requests of a connection until it ends.
+  void serve(const std::shared_ptr<Connection> &connection) {
+    std::string line;
+    while (connection->read_line(line)) {
+      if (line.find_first_not_of(" \t\r") == std::string::npos) {
+        continue;
+      }
+      Job job;
+      job.connection = connection;
+      Json response;
+      response.type = Json::Type::object;
+      response.fields.emplace_back("id", Json());
+      try {
+        const Json request = JsonParser::parse(line);
+        if (const Json *id = request.find("id")) {
+          job.id = *id;
+          response.fields[0].second = *id;
+        }
+        if (handle(request, job, response)) {
+          continue;
+        }
+      } catch (const std::exception &e) {
+        response.fields.emplace_back("ok", boolean(false));
+        response.fields.emplace_back("error", string(e.what()));
+      }
+      connection->send(response);
+    }
+  }
+
+private:
+  // Submit a query to the pool and return true, or fill in the response of
+  // any other request. Throws on invalid requests.
+  bool handle(const Json &request, Job &job, Json &response) {
+    const std::string op = text_field(request, "op");
+    if (op == "query") {
+      job.source = find(text_field(request, "name"));
+      const Json *rects = request.find("rects");
+      if (rects == nullptr || rects->type != Json::Type::array) {
+        throw std::invalid_argument("rects should be an array");
+      }
+      for (const Json &r : rects->items) {
+        if (r.items.size() != 4) {
+          throw std::invalid_argument("each rectangle should be "
+                                      "[y0, x0, y1, x1]");
+        }
+        const Rect rect = {int_value(r.items[0]), int_value(r.items[1]),
+                           int_value(r.items[2]), int_value(r.items[3])};
+        if (rect.y0 < 0 || rect.y0 >= rect.y1 || rect.y1 > job.source->ny ||
+            rect.x0 < 0 || rect.x0 >= rect.x1 || rect.x1 > job.source->nx) {
+          throw std::invalid_argument("rectangle outside the image");
+        }
+        job.rects.push_back(rect);
+      }
+      pool.submit(std::move(job));
+      return true;
+    }
+    if (op == "load") {
+      std::shared_ptr<Source> source(new Source);
+      source->name = text_field(request, "name");
+      source->path = text_field(request, "path");
+      source->ny = int_value(field(request, "ny"));
+      source->nx = int_value(field(request, "nx"));
+      const std::string kind = request.find("index") != nullptr
+                                   ? text_field(request, "index")
+                                   : "pyramid";
+      if (kind == "none") {
+        source->index = IndexKind::none;
+      } else if (kind == "integral") {
+        source->index = IndexKind::integral;
+      } else if (kind == "pyramid") {
+        source->index = IndexKind::pyramid;
+      } else {
+        throw std::invalid_argument("index should be pyramid, integral or "
+                                    "none");
+      }
+      const Json *block = request.find("block");
+      source->block = block != nullptr ? int_value(*block) : 16;
+      if (source->ny < 1 || source->nx < 1 || source->block < 1) {
+        throw std::invalid_argument("ny, nx and block should be positive");
+      }
+      const std::size_t bytes = cache.get(source)->bytes;
+      drop(source->name);
+      {
+        std::lock_guard<std::mutex> lock(mutex);
+        sources[source->name] = source;
+      }
+      response.fields.emplace_back("ok", boolean(true));
+      response.fields.emplace_back("bytes", number(double(bytes)));
+    } else if (op == "drop") {
+      if (!drop(text_field(request, "name"))) {
+        throw std::invalid_argument("no image " +
+                                    text_field(request, "name"));
+      }
+      response.fields.emplace_back("ok", boolean(true));
+    } else if (op == "stats") {
+      response.fields.emplace_back("ok", boolean(true));
+      {
+        std::lock_guard<std::mutex> lock(mutex);
+        response.fields.emplace_back("images",
+                                     number(double(sources.size())));
+      }
+      cache.add_stats(response);
+      pool.add_stats(response);
+    } else {
+      throw std::invalid_argument("unknown op " + op);
+    }
+    return false;
+  }
+
+  static const Json &field(const Json &request, const char *name) {
+    const Json *value = request.find(name);
+    if (value == nullptr) {
+      throw std::invalid_argument(std::string("missing ") + name);
+    }
+    return *value;
+  }
+
+  static std::string text_field(const Json &request, const char *name) {
+    const Json &value = field(request, name);
+    if (value.type != Json::Type::string) {
+      throw std::invalid_argument(std::string(name) + " should be a string");
+    }
+    return value.string;
+  }
+
+  static int int_value(const Json &value) {
+    // Out of range or NaN first, as converting those to int is undefined
+    if (value.type != Json::Type::number ||
+        !(value.number >= INT_MIN && value.number <= INT_MAX) ||
+        value.number != int(value.number)) {
+      throw std::invalid_argument("expected an integer");
+    }
+    return int(value.number);
+  }
+
+  std::shared_ptr<Source> find(const std::string &name) {
+    std::lock_guard<std::mutex> lock(mutex);
+    const auto it = sources.find(name);
+    if (it == sources.end()) {
+      throw std::invalid_argument("no image " + name);
+    }
+    return it->second;
+  }
+
+  // Unregister an image and evict it; queries already waiting for it are
+  // still answered.
+  bool drop(const std::string &name) {
+    std::shared_ptr<Source> source;
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      const auto it = sources.find(name);
+      if (it == sources.end()) {
+        return false;
+      }
+      source = it->second;
+      sources.erase(it);
+    }
+    cache.drop(source.get());
+    return true;
+  }
+
+  std::mutex mutex;
+  std::map<std::string, std::shared_ptr<Source>> sources;
+  ImageCache cache;
+  WorkerPool pool;
+};
+
+static int listen_on(const std::string &path) {
+  sockaddr_un address = {};
+  address.sun_family = AF_UNIX;
+  if (path.size() >= sizeof(address.sun_path)) {
+    error("socket path too long: " + path);
+  }
+  std::strcpy(address.sun_path, path.c_str());
+  const int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  unlink(path.c_str());
+  if (fd < 0 ||
+      bind(fd, reinterpret_cast<sockaddr *>(&address), sizeof(address)) != 0 ||
+      listen(fd, 64) != 0) {
+    error("cannot listen on " + path + ": " + std::strerror(errno));
+  }
+  return fd;
+}
+
+int main(int argc, const char **argv) {
+  std::string socket_path;
+  int workers = std::max(1u, std::thread::hardware_concurrency());
+  double cache_mb = 1024;
+  try {
+    default_kernel();
+    thread_count();
+    simd_target();
+    for (int i = 1; i < argc; i += 2) {
+      const std::string option = argv[i];
+      if (i + 1 == argc) {
+        error(USAGE);
+      } else if (option == "--socket") {
+        socket_path = argv[i + 1];
+      } else if (option == "--workers") {
+        workers = std::stoi(argv[i + 1]);
+      } else if (option == "--cache-mb") {
+        cache_mb = std::stod(argv[i + 1]);
+      } else {
+        error(USAGE);
+      }
+    }
+  } catch (const std::logic_error &e) {
+    error(e.what());
+  }
+  if (workers < 1 || cache_mb < 0) {
+    error("--workers should be positive and --cache-mb not negative");
+  }
+  // Clients that go away are noticed by failing writes
+  std::signal(SIGPIPE, SIG_IGN);
+
+  Server server(workers, std::size_t(cache_mb * 1048576));
+  if (socket_path.empty()) {
+    server.serve(std::make_shared<Connection>(STDIN_FILENO, STDOUT_FILENO,
+                                              false));
+    return EXIT_SUCCESS;
+  }
+  const int listener = listen_on(socket_path);
+  while (true) {
+    const int fd = accept(listener, nullptr, nullptr);
+    if (fd < 0) {
+      if (errno == EINTR || errno == ECONNABORTED) {
+        continue;
+      }
+      error(std::string("accept failed: ") + std::strerror(errno));
+    }
+    std::thread([&server, fd] {
+      server.serve(std::make_shared<Connection>(fd, fd, true));
+    }).detach();
+  }
+}
@@ -0,0 +1,252 @@
+#pragma once
+
+// The small subset of JSON used by the line protocol of average-server:
+// enough to parse one request or response per line and to write them back.
+
+#include <cmath>
+#include <cstdio>
+#include <cstdlib>
+#include <stdexcept>
+#include <string>
+#include <utility>
+#include <vector>
+
+struct Json {
+  enum class Type { null, boolean, number, string, array, object };
+
+  Type type = Type::null;
+  bool boolean = false;
+  double number = 0.0;
+  std::string string;
+  std::vector<Json> items;
+  std::vector<std::pair<std::string, Json>> fields;
+
+  // Field of an object, or nullptr if there is none.
+  const Json *find(const std::string &key) const {
+    for (const auto &field : fields) {
+      if (field.first == key) {
+        return &field.second;
+      }
+    }
+    return nullptr;
+  }
+};
+
+// Parse a whole JSON text. Throws std::invalid_argument on syntax errors.
+class JsonParser {
+public:
+  static Json parse(const std::string &text) {
+    JsonParser parser(text);
+    Json value = parser.value();
+    parser.space();
+    if (parser.pos != text.size()) {
+      parser.fail("trailing characters");
+    }
+    return value;
+  }
+
+private:
+  explicit JsonParser(const std::string &text) : text(text), pos(0) {}
+
+  [[noreturn]] void fail(const std::string &what) const {
+    throw std::invalid_argument("invalid JSON at offset " +
+                                std::to_string(pos) + ": " + what);
+  }
+
+  void space() {
+    while (pos < text.size() && (text[pos] == ' ' || text[pos] == '\t' ||
+                                 text[pos] == '\r' || text[pos] == '\n')) {
+      pos++;
+    }
+  }
+
+  bool consume(char c) {
+    space();
+    if (pos < text.size() && text[pos] == c) {
+      pos++;
+      return true;
+    }
+    return false;
+  }
+
+  void expect(char c) {
+    if (!consume(c)) {
+      fail(std::string("expected '") + c + "'");
+    }
+  }
+
+  bool literal(const char *word) {
+    const std::string w = word;
+    if (text.compare(pos, w.size(), w) == 0) {
+      pos += w.size();
+      return true;
+    }
+    return false;
+  }
+
+  Json value() {
+    space();
+    if (pos == text.size()) {
+      fail("unexpected end");
+    }
+    Json v;
+    const char c = text[pos];
+    if (c == '{') {
+      v.type = Json::Type::object;
+      pos++;
+      if (!consume('}')) {
+        do {
+          space();
+          std::string key = string();
+          expect(':');
+          v.fields.emplace_back(std::move(key), value());
+        } while (consume(','));
+        expect('}');
+      }
+    } else if (c == '[') {
+      v.type = Json::Type::array;
+      pos++;
+      if (!consume(']')) {
+        do {
+          v.items.push_back(value());
+        } while (consume(','));
+        expect(']');
+      }
+    } else if (c == '"') {
+      v.type = Json::Type::string;
+      v.string = string();
+    } else if (literal("true") || literal("false")) {
+      v.type = Json::Type::boolean;
+      v.boolean = c == 't';
+    } else if (literal("null")) {
+      v.type = Json::Type::null;
+    } else {
+      v.type = Json::Type::number;
+      const char *start = text.c_str() + pos;
+      char *end;
+      v.number = std::strtod(start, &end);
+      if (end == start) {
+        fail("unexpected character");
+      }
+      pos += end - start;
+    }
+    return v;
+  }
+
+  std::string string() {
+    if (pos == text.size() || text[pos] != '"') {
+      fail("expected a string");
+    }
+    pos++;
+    std::string s;
+    while (pos < text.size() && text[pos] != '"') {
+      char c = text[pos++];
+      if (c == '\\') {
+        if (pos == text.size()) {
+          break;
+        }
+        c = text[pos++];
+        switch (c) {
+        case 'n':
+          c = '\n';
+          break;
+        case 't':
+          c = '\t';
+          break;
+        case 'r':
+          c = '\r';
+          break;
+        case 'b':
+          c = '\b';
+          break;
+        case 'f':
+          c = '\f';
+          break;
+        case '"':
+        case '\\':
+        case '/':
+          break;
+        default:
+          // \uXXXX is not needed for file names and image names
+          fail("unsupported escape");
+        }
+      }
+      s += c;
+    }
+    if (pos == text.size()) {
+      fail("unterminated string");
+    }
+    pos++;
+    return s;
+  }
+
+  const std::string &text;
+  std::size_t pos;
+};
+
+// Append value to out as JSON. Whole numbers are written in full, others
+// with the 9 digits that read back as the same float.
+inline void write_json(std::string &out, const Json &value) {
+  switch (value.type) {
+  case Json::Type::null:
+    out += "null";
+    break;
+  case Json::Type::boolean:
+    out += value.boolean ? "true" : "false";
+    break;
+  case Json::Type::number: {
+    char buf[32];
+    if (value.number == std::floor(value.number) &&
+        std::abs(value.number) < 1e15) {
+      std::snprintf(buf, sizeof(buf), "%.0f", value.number);
+    } else {
+      std::snprintf(buf, sizeof(buf), "%.9g", value.number);
+    }
+    out += buf;
+    break;
+  }
+  case Json::Type::string:
+    out += '"';
+    for (char c : value.string) {
+      if (c == '"' || c == '\\') {
+        out += '\\';
+        out += c;
+      } else if (c == '\n') {
+        out += "\\n";
+      } else if (static_cast<unsigned char>(c) < 0x20) {
+        char buf[8];
+        std::snprintf(buf, sizeof(buf), "\\u%04x", c);
+        out += buf;
+      } else {
+        out += c;
+      }
+    }
+    out += '"';
+    break;
+  case Json::Type::array:
+    out += '[';
+    for (std::size_t i = 0; i < value.items.size(); i++) {
+      if (i > 0) {
+        out += ", ";
+      }
+      write_json(out, value.items[i]);
+    }
+    out += ']';
+    break;
+  case Json::Type::object:
+    out += '{';
+    for (std::size_t i = 0; i < value.fields.size(); i++) {
+      if (i > 0) {
+        out += ", ";
+      }
+      Json key;
+      key.type = Json::Type::string;
+      key.string = value.fields[i].first;
+      write_json(out, key);
+      out += ": ";
+      write_json(out, value.fields[i].second);
+    }
+    out += '}';
+    break;
+  }
+}